@@ -1,24 +1,27 @@
+from s3_copy_engine import DEFAULT_WORKERS, upload_directory
 
-def sync_to_s3(source_directory, s3_bucket, s3_prefix=""):
+def sync_to_s3(source_directory, s3_bucket, s3_prefix="", workers=DEFAULT_WORKERS):
     """
-    Synchronize a local directory with an S3 bucket using AWS CLI's 'aws s3 sync' command.
+    Synchronize a local directory with an S3 bucket, uploading new and changed files concurrently.
     Args:
         source_directory (str): The local directory to sync.
         s3_bucket (str): The S3 bucket to sync to.
         s3_prefix (str, optional): The S3 prefix (path) within the bucket. Default is an empty string.
+        workers (int, optional): Concurrent uploads, sharing one sized connection pool.
+    Returns:
+        dict: Upload summary (counts, bytes and throughput) with the failed uploads under 'Failures'.
     """
     # Construct the AWS S3 URI
     s3_uri = f"s3://{s3_bucket}/{s3_prefix}"
 
-    # Formulate the 'aws s3 sync' command
-    command = ["aws", "s3", "sync", source_directory, s3_uri]
-
     try:
-        # Run the command using subprocess
-        subprocess.run(command, check=True)
-        print(f"Synced '{source_directory}' to '{s3_uri}' successfully.")
-    except subprocess.CalledProcessError as e:
-        print(f"Error syncing to S3: {e}")
+        outcomes, summary = upload_directory(source_directory, s3_bucket, s3_prefix, workers)
+        failures = [o for o in outcomes if o['Status'] == 'failed']
+        if failures:
+            print(f"Error syncing to S3: {len(failures)} of {summary['Objects']} uploads to '{s3_uri}' failed")
+        else:
+            print(f"Synced '{source_directory}' to '{s3_uri}' successfully: {summary}")
+        return {**summary, 'Failures': failures}
     except Exception as ex:
         print(f"An unexpected error occurred: {ex}")
 
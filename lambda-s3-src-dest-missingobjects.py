@@ -3,6 +3,10 @@ import logging
 import os
 import json
 
+from s3_inventory import iter_inventory, load_manifest
+from s3_listing import iter_versions
+from s3_version_index import build_index, event_flag
+
 s3 = boto3.client('s3')
 sns = boto3.client('sns')
 logger = logging.getLogger()
@@ -11,6 +15,18 @@ logger.setLevel(logging.INFO)
 # SNS topic ARN for missing objects alert
 SNS_TOPIC_ARN = os.environ.get('SNS_TOPIC_ARN', 'arn:aws:sns:region:account-id:topic-name')
 
+# Concurrent shards used when listing object versions, overridable per event with "list_workers"
+LIST_WORKERS = int(os.environ.get('LIST_WORKERS', '1'))
+
+# Spill the destination index to local disk behind a Bloom filter, for buckets too big for Lambda memory.
+# Overridable per event with "use_bloom" and "expected_versions" (sizes the Bloom filter)
+USE_BLOOM = os.environ.get('USE_BLOOM', 'false').lower() == 'true'
+EXPECTED_VERSIONS = int(os.environ.get('EXPECTED_VERSIONS', '50000000'))
+SPILL_DIR = os.environ.get('SPILL_DIR', '/tmp')
+
+# Source versions checked against the destination index per batch
+CHECK_BATCH = 1000
+
 
 def send_sns_alert_missing_object(source_bucket, dest_bucket, key, version_id):
     """Send SNS alert for missing object/version in destination bucket"""
@@ -32,34 +48,59 @@ def send_sns_alert_missing_object(source_bucket, dest_bucket, key, version_id):
         logger.error(f"Failed to send SNS alert: {str(e)}")
 
 
-def get_all_versions(bucket):
-    """Return dict: {key: [version_ids]} including delete markers"""
-    versions = {}
-    paginator = s3.get_paginator('list_object_versions')
-    for page in paginator.paginate(Bucket=bucket):
-        for obj in page.get('Versions', []):
-            versions.setdefault(obj['Key'], []).append(obj['VersionId'])
-        for obj in page.get('DeleteMarkers', []):
-            versions.setdefault(obj['Key'], []).append(obj['VersionId'])
-    return versions
+def get_all_versions(bucket, list_workers=LIST_WORKERS):
+    """Yield (key, version_id) for every version and delete marker"""
+    for obj in iter_versions(s3, bucket, list_workers=list_workers, ordered=False):
+        yield obj['Key'], obj['VersionId']
+
+
+def get_inventory_versions(manifest_location, workers=8):
+    """Yield (key, version_id) read from an S3 Inventory manifest instead of listing"""
+    for obj in iter_inventory(s3, load_manifest(s3, manifest_location), workers):
+        yield obj['Key'], obj['VersionId']
+
+
+def build_dest_index(dest_versions, use_bloom=USE_BLOOM, expected_versions=EXPECTED_VERSIONS):
+    """Index destination versions, in memory or spilled to local disk behind a Bloom filter"""
+    return build_index(dest_versions, SPILL_DIR if use_bloom else None, expected_versions)
+
+
+def _batches(pairs, size=CHECK_BATCH):
+    batch = []
+    for pair in pairs:
+        batch.append(pair)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 def lambda_handler(event, context):
     source_bucket = event['source_bucket']
     dest_bucket = event['dest_bucket']
+    list_workers = int(event.get('list_workers', LIST_WORKERS))
 
-    source_versions = get_all_versions(source_bucket)
-    dest_versions = get_all_versions(dest_bucket)
+    if event.get('source_manifest') and event.get('dest_manifest'):
+        source_versions = get_inventory_versions(event['source_manifest'])
+        dest_versions = get_inventory_versions(event['dest_manifest'])
+    else:
+        source_versions = get_all_versions(source_bucket, list_workers)
+        dest_versions = get_all_versions(dest_bucket, list_workers)
 
-    missing = []
+    # Only the destination is held, the source is streamed against it
+    dest_index = build_dest_index(dest_versions, event_flag(event.get('use_bloom', USE_BLOOM)),
+                                  int(event.get('expected_versions', EXPECTED_VERSIONS)))
 
-    for key, version_ids in source_versions.items():
-        dest_version_ids = dest_versions.get(key, [])
-        for vid in version_ids:
-            if vid not in dest_version_ids:
+    missing = []
+    try:
+        for batch in _batches(source_versions):
+            for key, vid in dest_index.find_missing(batch):
                 missing.append({'Key': key, 'VersionId': vid})
                 # Send SNS alert for each missing version
                 send_sns_alert_missing_object(source_bucket, dest_bucket, key, vid)
+    finally:
+        dest_index.close()
 
     if missing:
         logger.info(f"Objects missing in destination bucket ({len(missing)}):")
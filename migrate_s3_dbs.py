@@ -25,6 +25,8 @@ from botocore.exceptions import ClientError
 import numpy as np
 
 from data_sync import data_sync_move_data
+from s3_bulk_delete import delete_objects
+from s3_rate_limiter import PrefixGovernor, governed_client
 
 env = 'prod'
 PROFILE_NAME="<insert profile name>"
@@ -36,7 +38,8 @@ DATABASE_NAME_TEMPLATE =  f"<insert database prefix prefix>_<s3_database_prefix>
 
 session = boto3.Session(profile_name=PROFILE_NAME')
 
-s3_client = session.client('s3')
+# Deletes back off per prefix on SlowDown instead of failing the whole prefix delete
+s3_client = governed_client(PrefixGovernor(), session=session)
 glue_client = session.client('glue')
 datasync_client = session.client('datasync')
 
@@ -84,25 +87,18 @@ def chunkify(lst: List[Any], num_chunks: int = 1, max_length: Optional[int] = No
 
 
 def batch_delete_objects(s3_client, s3_bucket, s3_file_names: List[str]):
-    """Batch delete objects."""
-    chunks: List[Any] = chunkify(lst=s3_file_names, max_length=100)
-
+    """Batch delete objects, 1,000 keys per DeleteObjects request with several requests in flight."""
     response = []
-    for chunk in chunks:  # pylint: disable=too-many-nested-blocks
-        keys = [{"Key": x} for x in chunk]
-        response.extend(_batch_delete_objects(s3_client=s3_client, s3_bucket=s3_bucket, keys=keys))
+    failed = []
+    for outcome in delete_objects(s3_client, s3_bucket, s3_file_names):
+        (response if outcome["Status"] == "deleted" else failed).append(outcome)
     logger.info("Deleted files in paths: {files}".format(files=list(set([os.path.dirname(x["Key"])
                                                                          for x in response]))))
+    if failed:
+        raise ServiceApiError(f"Failed to delete {len(failed)} objects from {s3_bucket}, "
+                              f"e.g. {failed[0]['Key']}: {failed[0]['Error']}")
     return response
 
-def _batch_delete_objects(s3_client, s3_bucket, keys: List[Any]):
-    """Batch delete objects with retry."""
-    try:
-        return s3_client.delete_objects(Bucket=s3_bucket, Delete={"Objects": keys})["Deleted"]
-    except ClientError as ce:
-        if ce.response["Error"]["Code"] == "SlowDown":
-            raise ce
-        raise ce
 
 def check_already_exists_error_glue_response(res: Any) -> None:
     """Check for AlreadyExistsException and raise."""
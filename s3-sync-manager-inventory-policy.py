@@ -1,3 +1,4 @@
+import argparse
 import boto3
 import csv
 import os
@@ -5,32 +6,27 @@ import time
 import logging
 from datetime import datetime
 
+from s3_listing import iter_versions
+from s3_version_store import load_versions
+
 s3 = boto3.client('s3')
 iam = boto3.client('iam')
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
-def get_all_versions(bucket):
-    """Get all objects with version IDs and delete markers"""
-    versions = []
-    paginator = s3.get_paginator('list_object_versions')
-    for page in paginator.paginate(Bucket=bucket):
-        for obj in page.get('Versions', []):
-            versions.append(obj)
-        for dm in page.get('DeleteMarkers', []):
-            versions.append(dm)
-    return versions
+def get_all_versions(bucket, list_workers=1, ordered=False):
+    """Yield all object versions and delete markers, in listing order if ordered"""
+    return iter_versions(s3, bucket, list_workers=list_workers, ordered=ordered)
 
-def compare_buckets(src_bucket, dest_bucket):
+def compare_buckets(src_bucket, dest_bucket, list_workers=1):
     """Compare src and dest buckets by version ID"""
-    src_versions = get_all_versions(src_bucket)
-    dest_versions = get_all_versions(dest_bucket)
-    
-    dest_dict = {(v['Key'], v['VersionId']): True for v in dest_versions}
+    src_versions = get_all_versions(src_bucket, list_workers)
+    # Only key and version ID are needed for the lookup, kept column-wise in listing order
+    dest_versions = load_versions(s3, dest_bucket, fields=('VersionId',), list_workers=list_workers)
     
     missing = []
     for v in src_versions:
-        if (v['Key'], v['VersionId']) not in dest_dict:
+        if (v['Key'], v['VersionId']) not in dest_versions:
             missing.append({'Key': v['Key'], 'VersionId': v['VersionId'], 'IsLatest': v['IsLatest']})
     logger.info(f"Found {len(missing)} missing objects in destination bucket")
     return missing
@@ -60,7 +56,7 @@ def sync_buckets(src_bucket, dest_bucket):
     subprocess.run(cmd, check=True)
     logger.info("Sync complete")
 
-def create_inventory(bucket):
+def create_inventory(bucket, list_workers=1):
     """Create CSV inventory including versions, delete markers, size, encryption, metadata"""
     timestamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
     filename = f"{bucket}-{timestamp}-inventory.csv"
@@ -72,7 +68,7 @@ def create_inventory(bucket):
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writeheader()
         
-        versions = get_all_versions(bucket)
+        versions = get_all_versions(bucket, list_workers)
         for v in versions:
             key = v['Key']
             version_id = v['VersionId']
@@ -119,9 +115,9 @@ def backup_bucket_policy(bucket):
         logger.warning(f"No policy found for bucket {bucket}")
         return None
 
-def bucket_migration_handler(src_bucket, dest_bucket, min_size_bytes=0):
+def bucket_migration_handler(src_bucket, dest_bucket, min_size_bytes=0, list_workers=1):
     # Step 1: Compare buckets
-    missing_objects = compare_buckets(src_bucket, dest_bucket)
+    missing_objects = compare_buckets(src_bucket, dest_bucket, list_workers)
     
     # Step 2: List large objects in destination bucket
     large_objects = list_large_objects(dest_bucket, min_size_bytes) if min_size_bytes > 0 else []
@@ -130,7 +126,7 @@ def bucket_migration_handler(src_bucket, dest_bucket, min_size_bytes=0):
     sync_buckets(src_bucket, dest_bucket)
     
     # Step 4: Create inventory
-    inventory_file = create_inventory(dest_bucket)
+    inventory_file = create_inventory(dest_bucket, list_workers)
     
     # Step 5: Backup bucket policy
     policy_file = backup_bucket_policy(dest_bucket)
@@ -143,11 +139,16 @@ def bucket_migration_handler(src_bucket, dest_bucket, min_size_bytes=0):
     }
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare, sync and inventory S3 buckets")
+    parser.add_argument('--list-workers', type=int, default=1,
+                        help="Concurrent shards used when listing object versions (default: 1)")
+    args = parser.parse_args()
+
     # Example usage
     src_bucket = input("Enter source bucket name: ")
     dest_bucket = input("Enter destination bucket name: ")
     min_size_gb = float(input("Enter minimum size in GB to list (0 to skip): "))
     min_size_bytes = int(min_size_gb * 1024**3)
     
-    result = bucket_migration_handler(src_bucket, dest_bucket, min_size_bytes)
+    result = bucket_migration_handler(src_bucket, dest_bucket, min_size_bytes, args.list_workers)
     print(result)
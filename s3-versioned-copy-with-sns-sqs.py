@@ -2,15 +2,23 @@ import boto3
 import os
 import json
 import logging
+from botocore.config import Config
 
-s3 = boto3.client('s3')
+from s3_copy_engine import MAX_PARTS_IN_FLIGHT, MULTIPART_THRESHOLD, multipart_copy, source_part_sizes
+from s3_rate_limiter import PrefixGovernor, governed_client
+
+# Concurrent upload_part_copy requests per multipart copy
+PARTS_IN_FLIGHT = int(os.environ.get('PARTS_IN_FLIGHT', MAX_PARTS_IN_FLIGHT))
+
+# Copy with the source's exact part layout so destination ETags equal source ETags
+PRESERVE_PART_LAYOUT = os.environ.get('PRESERVE_PART_LAYOUT', 'false').lower() == 'true'
+
+# Part copies of one object share a prefix; SlowDown backs them off together instead of failing parts
+s3 = governed_client(PrefixGovernor(), Config(max_pool_connections=PARTS_IN_FLIGHT))
 sns = boto3.client('sns')
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Threshold for multipart copy (5GB)
-MULTIPART_THRESHOLD = 5 * 1024 * 1024 * 1024  # 5GB
-
 # SNS topic ARN (create SNS topic and subscribe your team)
 SNS_TOPIC_ARN = os.environ.get('SNS_TOPIC_ARN', 'arn:aws:sns:region:account-id:topic-name')
 
@@ -48,7 +56,14 @@ def copy_object_version(source_bucket, dest_bucket, key, version_id):
             'VersionId': version_id
         }
 
-        if size < MULTIPART_THRESHOLD:
+        part_sizes = None
+        if PRESERVE_PART_LAYOUT:
+            part_sizes = source_part_sizes(s3, copy_source, size, head['ETag'])
+            multipart = part_sizes is not None
+        else:
+            multipart = size >= MULTIPART_THRESHOLD
+
+        if not multipart:
             # Simple copy
             s3.copy_object(
                 Bucket=dest_bucket,
@@ -58,32 +73,10 @@ def copy_object_version(source_bucket, dest_bucket, key, version_id):
             )
             logger.info(f"Copied {key} version {version_id} (size={size}) to {dest_bucket}")
         else:
-            # Multipart copy for large objects
-            mp = s3.create_multipart_upload(Bucket=dest_bucket, Key=key)
-            upload_id = mp['UploadId']
-
-            part_size = 100 * 1024 * 1024  # 100MB parts
-            parts = []
-            for i in range(0, size, part_size):
-                end = min(i + part_size - 1, size - 1)
-                part_number = len(parts) + 1
-                part = s3.upload_part_copy(
-                    Bucket=dest_bucket,
-                    Key=key,
-                    PartNumber=part_number,
-                    UploadId=upload_id,
-                    CopySource=copy_source,
-                    CopySourceRange=f"bytes={i}-{end}"
-                )
-                parts.append({'ETag': part['CopyPartResult']['ETag'], 'PartNumber': part_number})
-
-            s3.complete_multipart_upload(
-                Bucket=dest_bucket,
-                Key=key,
-                UploadId=upload_id,
-                MultipartUpload={'Parts': parts}
-            )
-            logger.info(f"Multipart copied {key} version {version_id} to {dest_bucket}")
+            # Multipart copy for large objects, parts sized to stay within 10,000 and copied concurrently
+            parts = multipart_copy(s3, copy_source, dest_bucket, key, size, head=head,
+                                   max_in_flight=PARTS_IN_FLIGHT, part_sizes=part_sizes)
+            logger.info(f"Multipart copied {key} version {version_id} (size={size}, parts={parts}) to {dest_bucket}")
 
     except Exception as e:
         logger.error(f"Failed to copy {key} version {version_id}: {str(e)}")
@@ -0,0 +1,217 @@
+"""
+Throughput autotuner for copy concurrency.
+
+The best number of concurrent copies differs wildly between buckets: small
+objects are bound by request latency and keep gaining from more workers, large
+objects saturate bandwidth with few. ConcurrencyTuner measures objects/s and
+bytes/s of completed copies over sliding windows and hill-climbs the number of
+copies in flight toward the throughput plateau:
+
+- throughput rose by more than GAIN: keep moving the same way
+- throughput fell by more than GAIN: reverse, with a smaller step
+- otherwise the plateau is reached: undo the last move if it gained nothing,
+  then hold, probing upwards now and then
+- error rate above MAX_ERROR_RATE, or median latency beyond LATENCY_FACTOR
+  times the best seen without a throughput gain: back off
+
+The settings reached are logged and saved per bucket pair in a JSON file, and
+the next run between the same buckets starts from them:
+
+    tuner = ConcurrencyTuner('src-bucket->dest-bucket')
+    engine = CopyEngine('src-bucket', 'dest-bucket', tuner=tuner)
+"""
+import json
+import logging
+import os
+import statistics
+import threading
+import time
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SETTINGS_PATH = os.environ.get('S3_AUTOTUNE', 's3-autotune.json')
+
+DEFAULT_WORKERS = 64
+MIN_WORKERS = 4
+MAX_WORKERS = 512
+
+# Seconds, and completed copies, a measurement window needs at least
+WINDOW_SECONDS = 10.0
+MIN_SAMPLES = 20
+
+# Relative throughput change counted as a gain or loss, and the back-off thresholds
+GAIN = 0.05
+MAX_ERROR_RATE = 0.02
+LATENCY_FACTOR = 2.0
+
+# Worker count multiplier per step: the first step, the smallest one, and the back-off factor
+STEP = 1.5
+MIN_STEP = 1.1
+BACKOFF = 0.75
+
+# Flat windows after which the tuner probes upwards again
+PROBE_AFTER = 6
+
+
+def load_settings(path=DEFAULT_SETTINGS_PATH):
+    """Saved settings by bucket pair, {} if none were saved"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_settings(pair, settings, path=DEFAULT_SETTINGS_PATH):
+    """Save the settings of one bucket pair, keeping the others"""
+    saved = load_settings(path)
+    saved[pair] = settings
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(saved, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _ratio(current, previous):
+    return current / previous if previous else 1.0
+
+
+class ConcurrencyTuner:
+    def __init__(self, pair, workers=DEFAULT_WORKERS, min_workers=MIN_WORKERS, max_workers=MAX_WORKERS,
+                 window=WINDOW_SECONDS, path=DEFAULT_SETTINGS_PATH):
+        """
+        Tune the copies in flight of one run
+
+        Args:
+            pair: Name of the bucket pair settings are saved under, e.g. 'src-bucket->dest-bucket'
+            workers: Starting copies in flight when nothing was saved for pair
+            min_workers: Lowest copies in flight
+            max_workers: Highest copies in flight; the engine's thread and connection pools are sized to it
+            window: Seconds per measurement window
+            path: JSON settings file
+        """
+        self.pair = pair
+        self.path = path
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.window = window
+        saved = load_settings(path).get(pair)
+        if saved:
+            logger.info(f"Starting {pair} from saved settings: {saved}")
+            workers = saved['Workers']
+        self.workers = max(min_workers, min(max_workers, workers))
+        self.history = []
+        self._lock = threading.Lock()
+        self._direction = 1
+        # Saved settings are already near the plateau: measure them before moving
+        self._step = MIN_STEP if saved else STEP
+        self._saved = bool(saved)
+        self._flat = 0
+        self._moved_from = None
+        self._previous = None
+        self._best_latency = None
+        self._reset(time.monotonic())
+
+    def _reset(self, now):
+        self._window_started = now
+        self._objects = 0
+        self._bytes = 0
+        self._errors = 0
+        self._latencies = []
+
+    def limit(self):
+        """Copies to keep in flight now"""
+        return self.workers
+
+    def record(self, outcome):
+        """Count a finished copy, adjusting the worker count at the end of a window"""
+        with self._lock:
+            self._objects += 1
+            if outcome['Status'] == 'failed':
+                self._errors += 1
+            elif outcome['Status'] != 'skipped':
+                self._bytes += outcome.get('Size') or 0
+            if outcome.get('Seconds') is not None:
+                self._latencies.append(outcome['Seconds'])
+            now = time.monotonic()
+            if now - self._window_started >= self.window and self._objects >= MIN_SAMPLES:
+                self._adjust(now)
+
+    def _move(self, direction, factor):
+        self._moved_from = self.workers
+        workers = round(self.workers * factor) if direction > 0 else round(self.workers / factor)
+        if workers == self.workers:
+            workers += direction
+        self.workers = max(self.min_workers, min(self.max_workers, workers))
+
+    def _adjust(self, now):
+        seconds = now - self._window_started
+        window = {'Workers': self.workers, 'ObjectsPerSecond': self._objects / seconds,
+                  'BytesPerSecond': self._bytes / seconds, 'ErrorRate': self._errors / self._objects,
+                  'Latency': statistics.median(self._latencies) if self._latencies else None}
+        self._reset(now)
+        previous, self._previous = self._previous, window
+        if window['Latency'] is not None:
+            self._best_latency = min(self._best_latency or window['Latency'], window['Latency'])
+        if previous is None:
+            change = 0.0
+        else:
+            # Geometric mean of both rates, so neither small-object nor large-object throughput dominates
+            change = (_ratio(window['ObjectsPerSecond'], previous['ObjectsPerSecond'])
+                      * _ratio(window['BytesPerSecond'], previous['BytesPerSecond'])) ** 0.5 - 1
+        latency_high = (window['Latency'] is not None and self._best_latency
+                        and window['Latency'] > LATENCY_FACTOR * self._best_latency)
+        moved_from, self._moved_from = self._moved_from, None
+        if window['ErrorRate'] > MAX_ERROR_RATE or (latency_high and change < GAIN):
+            decision = 'back off'
+            self.workers = max(self.min_workers, round(self.workers * BACKOFF))
+            self._direction, self._step, self._flat = 1, max(MIN_STEP, self._step ** 0.5), 0
+        elif previous is None and self._saved:
+            decision = 'measure'
+        elif previous is None or change >= GAIN:
+            decision = 'climb'
+            self._flat = 0
+            self._move(self._direction, self._step)
+        elif change <= -GAIN:
+            decision = 'reverse'
+            self._flat = 0
+            self._direction = -self._direction
+            self._step = max(MIN_STEP, self._step ** 0.5)
+            self._move(self._direction, self._step)
+        elif moved_from is not None:
+            # The last move gained nothing: the plateau is reached, with fewer workers
+            decision = 'settle'
+            self._flat = 0
+            self.workers = moved_from
+        else:
+            self._flat += 1
+            decision = 'hold'
+            if self._flat >= PROBE_AFTER:
+                decision = 'probe'
+                self._flat = 0
+                self._direction = 1
+                self._move(1, MIN_STEP)
+        window['Decision'] = decision
+        self.history.append(window)
+        logger.info(f"Autotune {self.pair}: {window['Workers']} workers, {window['ObjectsPerSecond']:.1f} objects/s, "
+                    f"{window['BytesPerSecond']:.0f} bytes/s, {window['ErrorRate']:.1%} errors -> {decision}, "
+                    f"{self.workers} workers")
+
+    def settings(self):
+        """Settings reached: workers and the last window's throughput"""
+        last = self._previous or {}
+        return {'Workers': self.workers,
+                'ObjectsPerSecond': round(last.get('ObjectsPerSecond', 0), 1),
+                'BytesPerSecond': round(last.get('BytesPerSecond', 0)),
+                'UpdatedAt': datetime.now(timezone.utc).isoformat()}
+
+    def save(self):
+        """Log the settings reached and save them for the next run of the pair, once a window was measured"""
+        if not self.history:
+            logger.info(f"Autotune {self.pair}: run too short to measure, settings not saved")
+            return None
+        settings = self.settings()
+        logger.info(f"Autotune {self.pair} settled on {settings}")
+        save_settings(self.pair, settings, self.path)
+        return settings
@@ -0,0 +1,130 @@
+"""
+Bulk deletes with batched, concurrent DeleteObjects requests.
+
+Keys (or {'Key', 'VersionId'} dicts) are streamed into DeleteObjects requests
+of up to 1,000 entries and several requests run at once. Deleting a key
+without a version ID in a versioned bucket creates a delete marker, so the same
+path recreates delete markers for a replay and purges prefixes.
+
+delete_objects() yields one outcome per entry, in the CopyEngine shape:
+
+    {'Key', 'VersionId', 'Status': 'deleted' | 'failed', 'DeleteMarker', 'DeleteMarkerVersionId', 'Error'}
+
+With quiet=True (the default) S3 only reports errors, which keeps responses
+small; entries without an error are reported as deleted without the marker
+details.
+"""
+import logging
+from itertools import islice
+
+from botocore.exceptions import ClientError
+
+from s3_copy_engine import run_bounded
+from s3_listing import iter_versions
+
+logger = logging.getLogger(__name__)
+
+# DeleteObjects accepts at most 1,000 entries per request
+MAX_KEYS_PER_REQUEST = 1000
+DEFAULT_WORKERS = 8
+
+
+def _entry(item):
+    if isinstance(item, str):
+        return {'Key': item}
+    entry = {'Key': item['Key']}
+    if item.get('VersionId'):
+        entry['VersionId'] = item['VersionId']
+    return entry
+
+
+def _batches(entries, batch_size):
+    entries = iter(entries)
+    while True:
+        batch = list(islice(entries, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _outcome(entry, status, deleted=None, error=None):
+    deleted = deleted or {}
+    return {'Key': entry['Key'], 'VersionId': entry.get('VersionId'), 'Status': status,
+            'DeleteMarker': deleted.get('DeleteMarker', False),
+            'DeleteMarkerVersionId': deleted.get('DeleteMarkerVersionId'), 'Error': error}
+
+
+def _delete_batch(s3, bucket, batch, quiet):
+    try:
+        response = s3.delete_objects(Bucket=bucket, Delete={'Objects': batch, 'Quiet': quiet})
+    except Exception as e:
+        if isinstance(e, ClientError):
+            error = f"{e.response['Error'].get('Code')}: {e.response['Error'].get('Message')}"
+        else:
+            error = str(e)
+        logger.error(f"DeleteObjects request of {len(batch)} keys in {bucket} failed: {error}")
+        return [_outcome(entry, 'failed', error=error) for entry in batch]
+    errors = {(e['Key'], e.get('VersionId')): f"{e.get('Code')}: {e.get('Message')}"
+              for e in response.get('Errors', [])}
+    deleted = {(d['Key'], d.get('VersionId')): d for d in response.get('Deleted', [])}
+    outcomes = []
+    for entry in batch:
+        ident = (entry['Key'], entry.get('VersionId'))
+        if ident in errors:
+            outcomes.append(_outcome(entry, 'failed', error=errors[ident]))
+        else:
+            outcomes.append(_outcome(entry, 'deleted', deleted.get(ident)))
+    return outcomes
+
+
+def delete_objects(s3, bucket, objects, workers=DEFAULT_WORKERS, quiet=True, batch_size=MAX_KEYS_PER_REQUEST,
+                   journal=None):
+    """
+    Delete keys or versions in batched, concurrent DeleteObjects requests
+
+    Args:
+        s3: S3 client; its connection pool should allow `workers` requests
+        bucket: Bucket to delete from
+        objects: Iterable of keys, or dicts with Key and optionally VersionId (a listing works as is)
+        workers: DeleteObjects requests in flight
+        quiet: Ask S3 to report only errors
+        batch_size: Entries per request, at most 1,000
+        journal: s3_journal.Journal recording completed deletes; entries it already holds are skipped
+
+    Yields:
+        One outcome per entry, as requests complete
+    """
+    batch_size = min(batch_size, MAX_KEYS_PER_REQUEST)
+    entries = (_entry(item) for item in objects)
+    if journal is not None:
+        entries = journal.pending(entries)
+    failed = 0
+    for outcomes in run_bounded(lambda batch: _delete_batch(s3, bucket, batch, quiet), _batches(entries, batch_size),
+                                workers):
+        for outcome in outcomes:
+            if outcome['Status'] == 'failed':
+                failed += 1
+            elif journal is not None:
+                journal.record(outcome, 'deleted')
+            yield outcome
+    if failed:
+        logger.warning(f"{failed} deletes in {bucket} failed")
+
+
+def purge_prefix(s3, bucket, prefix, all_versions=False, workers=DEFAULT_WORKERS, list_workers=1, journal=None):
+    """
+    Delete everything under prefix
+
+    Args:
+        all_versions: Permanently delete every version and delete marker; otherwise only the
+            current keys are deleted, which in a versioned bucket leaves a delete marker on each
+
+    Yields:
+        One outcome per deleted entry
+    """
+    if all_versions:
+        objects = iter_versions(s3, bucket, prefix, list_workers=list_workers, ordered=False)
+    else:
+        objects = (obj['Key'] for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix)
+                   for obj in page.get('Contents', []))
+    yield from delete_objects(s3, bucket, objects, workers, journal=journal)
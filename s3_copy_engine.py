@@ -0,0 +1,482 @@
+"""
+In-process, concurrent S3 copy engine.
+
+Replaces shelling out to `aws s3 sync`: the versions to copy come straight
+from the diff/listing stream, and every copy is a server-side CopyObject (or
+a parallel UploadPartCopy for objects over MULTIPART_THRESHOLD) run on a
+bounded thread pool. All workers share one client whose HTTP connection pool is sized
+to the pool, so connections are reused instead of re-established.
+
+With preserve_parts, copies reproduce the source's part layout (read with
+GetObjectAttributes, or HeadObject PartNumber), so every destination ETag
+equals its source ETag and copies can be verified from metadata alone. This
+holds for SSE-S3 and unencrypted objects; SSE-KMS ETags are not MD5-based.
+
+CopyEngine.run() yields one outcome per version as copies finish:
+
+    {'Key', 'VersionId', 'Status': 'copied' | 'failed', 'Size', 'Seconds', 'Error'}
+
+and keeps aggregate counts and throughput in CopyEngine.stats.
+"""
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from itertools import accumulate
+from urllib.parse import quote, urlencode
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+from s3_copy_scheduler import SizeTieredScheduler
+from s3_rate_limiter import GovernedClient, governed, governed_client
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 64
+
+# CopyObject handles objects up to 5GiB, but a single request copies at one request's speed,
+# so objects from this size up are copied as concurrent parts
+MULTIPART_THRESHOLD = 100 * 1024 ** 2
+
+# S3 multipart limits
+MAX_COPY_OBJECT_SIZE = 5 * 1024 ** 3
+MAX_PARTS = 10000
+MAX_PART_SIZE = 5 * 1024 ** 3
+
+# Smallest part used; larger objects get larger parts so they stay within MAX_PARTS
+MIN_PART_SIZE = 64 * 1024 ** 2
+
+# Part copies in flight per object, and attempts per part on top of botocore's own retries
+MAX_PARTS_IN_FLIGHT = 8
+PART_ATTEMPTS = 3
+
+_RETRYABLE_CODES = {'RequestTimeout', 'SlowDown', 'Throttling', 'ThrottlingException', 'InternalError',
+                    'ServiceUnavailable'}
+
+
+def client(workers=DEFAULT_WORKERS, governor=None):
+    """
+    S3 client whose connection pool can serve `workers` concurrent requests
+
+    With a s3_rate_limiter.PrefixGovernor, object requests are rate-limited per prefix and retried by
+    the governor alone: botocore does not retry them, and its client-wide adaptive rate limiting, which
+    would slow every prefix down for one hot one, is off.
+    """
+    if governor is None:
+        return boto3.client('s3', config=Config(max_pool_connections=workers,
+                                                retries={'max_attempts': 10, 'mode': 'adaptive'}))
+    return governed_client(governor, Config(max_pool_connections=workers, retries={'mode': 'standard'}))
+
+
+def run_bounded(fn, items, workers, limit=None):
+    """
+    Yield fn(item) for every item as calls finish, with at most 2 * workers items in flight
+
+    With limit, a function returning the items to keep in flight (at most workers), the bound
+    follows it as it changes, e.g. ConcurrencyTuner.limit.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        try:
+            for item in items:
+                pending.add(pool.submit(fn, item))
+                while len(pending) >= (limit() if limit else 2 * workers):
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def part_size_for(size, min_part_size=MIN_PART_SIZE):
+    """Part size (whole MiB) that copies size bytes in at most MAX_PARTS parts"""
+    mib = 1024 ** 2
+    part_size = max(min_part_size, math.ceil(size / MAX_PARTS / mib) * mib)
+    if part_size > MAX_PART_SIZE:
+        raise ValueError(f"{size} bytes cannot be copied in {MAX_PARTS} parts of at most {MAX_PART_SIZE} bytes")
+    return part_size
+
+
+def _even_parts(size, part_size=None):
+    """Part sizes of size bytes split into parts of part_size, by default part_size_for(size)"""
+    part_size = part_size or part_size_for(size)
+    return [min(part_size, size - offset) for offset in range(0, size, part_size)]
+
+
+def _parts_count(etag):
+    """Part count encoded in a multipart ETag ("<md5 of part md5s>-<parts>"), None for single-part ETags"""
+    etag = etag.strip('"')
+    return int(etag.rsplit('-', 1)[1]) if '-' in etag else None
+
+
+def _part_sizes_by_head(s3, source, size, count):
+    """Size of every part from HeadObject PartNumber, None if the sizes do not add up to the object"""
+    with ThreadPoolExecutor(max_workers=MAX_PARTS_IN_FLIGHT) as pool:
+        sizes = list(pool.map(lambda n: s3.head_object(**source, PartNumber=n)['ContentLength'],
+                              range(1, count + 1)))
+    return sizes if sum(sizes) == size else None
+
+
+def source_part_sizes(s3, source, size, etag=None):
+    """
+    Exact part sizes of a multipart source object, None for single-part objects
+
+    GetObjectAttributes only lists parts of objects uploaded with additional
+    checksums; for the others every part is HEADed with PartNumber, concurrently,
+    since the first and last parts do not prove the sizes of the ones between.
+    When neither gives a layout adding up to the object, the default part
+    sizes are returned: the copy is then intact but its ETag differs.
+    """
+    if etag is None:
+        etag = s3.head_object(**source)['ETag']
+    count = _parts_count(etag)
+    if count is None:
+        return None
+    kwargs = {**source, 'ObjectAttributes': ['ObjectParts'], 'MaxParts': 1000}
+    sizes = []
+    try:
+        while True:
+            parts = s3.get_object_attributes(**kwargs).get('ObjectParts', {})
+            sizes.extend(part['Size'] for part in parts.get('Parts', []))
+            if not parts.get('IsTruncated'):
+                break
+            kwargs['PartNumberMarker'] = parts['NextPartNumberMarker']
+    except ClientError as e:
+        logger.warning(f"GetObjectAttributes failed for {source['Key']}, reading part sizes with HEAD: {e}")
+        sizes = []
+    if len(sizes) == count and sum(sizes) == size:
+        return sizes
+    sizes = _part_sizes_by_head(s3, source, size, count)
+    if sizes is None:
+        logger.warning(f"Part sizes of {source['Key']} do not add up to its size, copying with default parts")
+        sizes = _even_parts(size)
+    return sizes
+
+
+def _retryable(e):
+    """Whether a failed request may succeed again: 5xx, throttling and timeout codes, or a lost connection"""
+    if isinstance(e, ClientError):
+        error = e.response.get('Error', {})
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return status >= 500 or error.get('Code') in _RETRYABLE_CODES
+    return isinstance(e, (ConnectionError, HTTPClientError))
+
+
+def _copy_part(s3, dest_bucket, dest_key, upload_id, source, number, first, last, attempts):
+    for attempt in range(1, attempts + 1):
+        try:
+            part = s3.upload_part_copy(Bucket=dest_bucket, Key=dest_key, PartNumber=number, UploadId=upload_id,
+                                       CopySource=source, CopySourceRange=f"bytes={first}-{last}")
+            return {'ETag': part['CopyPartResult']['ETag'], 'PartNumber': number}
+        except Exception as e:
+            if attempt == attempts or not _retryable(e):
+                raise
+            logger.warning(f"Retrying part {number} of {dest_key} (attempt {attempt} failed: {e})")
+            time.sleep(0.5 * 2 ** attempt)
+
+
+# HeadObject fields CreateMultipartUpload takes as they are, so a multipart copy keeps what CopyObject keeps
+_COPIED_FIELDS = ('ContentType', 'ContentEncoding', 'ContentDisposition', 'ContentLanguage', 'CacheControl',
+                  'Expires', 'WebsiteRedirectLocation', 'StorageClass', 'ObjectLockMode',
+                  'ObjectLockRetainUntilDate', 'ObjectLockLegalHoldStatus')
+
+
+def _copied_fields(s3, source, head):
+    """CreateMultipartUpload arguments carrying the source's metadata, headers and tags"""
+    kwargs = {'Metadata': head.get('Metadata', {})}
+    kwargs.update((field, head[field]) for field in _COPIED_FIELDS if head.get(field))
+    # Tags are not in the HEAD response, only their count
+    if head.get('TagCount'):
+        tags = s3.get_object_tagging(**source)['TagSet']
+        kwargs['Tagging'] = urlencode([(tag['Key'], tag['Value']) for tag in tags], quote_via=quote)
+    return kwargs
+
+
+def multipart_copy(s3, source, dest_bucket, dest_key, size, head=None, acl=None, part_size=None,
+                   max_in_flight=MAX_PARTS_IN_FLIGHT, attempts=PART_ATTEMPTS, part_sizes=None, extra_args=None,
+                   submit=None):
+    """
+    Copy an object with concurrent UploadPartCopy requests
+
+    Args:
+        s3: S3 client; its connection pool should allow max_in_flight requests
+        source: CopySource dict (Bucket, Key and optionally VersionId)
+        dest_bucket: Destination bucket
+        dest_key: Destination key
+        size: Object size in bytes
+        head: head_object response of the source, fetched when None; its metadata, headers, storage
+            class, object lock settings and tags are copied
+        acl: Canned ACL of the copy
+        part_size: Part size, by default part_size_for(size)
+        max_in_flight: Part copies running at the same time
+        attempts: Attempts per part before the upload is aborted
+        part_sizes: Exact size of every part, e.g. source_part_sizes() to reproduce the source ETag
+        extra_args: Further CreateMultipartUpload arguments, e.g. {'ServerSideEncryption': 'AES256'}
+        submit: submit(fn, *args) returning a future, to run the part copies in a shared pool
+            (s3_copy_scheduler) instead of max_in_flight threads of their own
+
+    Returns:
+        Number of parts copied
+    """
+    if head is None:
+        head = s3.head_object(**source)
+    if part_sizes is None:
+        part_sizes = _even_parts(size, part_size)
+    kwargs = {'Bucket': dest_bucket, 'Key': dest_key, **_copied_fields(s3, source, head)}
+    if acl:
+        kwargs['ACL'] = acl
+    kwargs.update(extra_args or {})
+    upload_id = s3.create_multipart_upload(**kwargs)['UploadId']
+    try:
+        offsets = [0, *accumulate(part_sizes[:-1])]
+        ranges = [(offset, offset + part - 1) for offset, part in zip(offsets, part_sizes)]
+        with ThreadPoolExecutor(max_workers=max_in_flight) if submit is None else nullcontext() as pool:
+            submit = submit or pool.submit
+            futures = [submit(_copy_part, s3, dest_bucket, dest_key, upload_id, source, number, first, last, attempts)
+                       for number, (first, last) in enumerate(ranges, start=1)]
+            try:
+                parts = [future.result() for future in futures]
+            finally:
+                for future in futures:
+                    future.cancel()
+        s3.complete_multipart_upload(Bucket=dest_bucket, Key=dest_key, UploadId=upload_id,
+                                     MultipartUpload={'Parts': parts})
+    except Exception:
+        s3.abort_multipart_upload(Bucket=dest_bucket, Key=dest_key, UploadId=upload_id)
+        raise
+    return len(ranges)
+
+
+class CopyStats:
+    """Aggregate outcome counts and throughput of a copy run"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counts = {}
+        self.bytes = 0
+
+    def add(self, outcome):
+        with self._lock:
+            self.counts[outcome['Status']] = self.counts.get(outcome['Status'], 0) + 1
+            if outcome['Status'] not in ('failed', 'skipped'):
+                self.bytes += outcome.get('Size') or 0
+
+    def summary(self):
+        seconds = max(time.monotonic() - self.started, 1e-9)
+        objects = sum(self.counts.values())
+        return {
+            'Objects': objects,
+            **{status.capitalize(): count for status, count in sorted(self.counts.items())},
+            'Bytes': self.bytes,
+            'Seconds': round(seconds, 3),
+            'ObjectsPerSecond': round(objects / seconds, 1),
+            'BytesPerSecond': round(self.bytes / seconds),
+        }
+
+
+class CopyEngine:
+    def __init__(self, src_bucket, dest_bucket, workers=DEFAULT_WORKERS, s3=None, acl=None,
+                 multipart_threshold=MULTIPART_THRESHOLD, max_parts_in_flight=MAX_PARTS_IN_FLIGHT,
+                 preserve_parts=False, extra_args=None, journal=None, governor=None, tuner=None,
+                 part_workers=None):
+        """
+        Set up a copy run between two buckets
+
+        Args:
+            src_bucket: Bucket versions are copied from
+            dest_bucket: Bucket versions are copied to, under the same key
+            workers: Concurrent copies
+            s3: S3 client, by default one with a connection pool sized to workers and their parts
+            acl: Canned ACL of the copies, e.g. 'bucket-owner-full-control'
+            multipart_threshold: Objects at least this large are copied with UploadPartCopy
+            max_parts_in_flight: Concurrent part copies per multipart object
+            preserve_parts: Mirror the source part layout (CopyObject for single-part sources) so
+                destination ETags equal the source ETags; multipart_threshold is then ignored
+            extra_args: Further CopyObject/CreateMultipartUpload arguments, e.g. {'ServerSideEncryption': 'AES256'}
+            journal: s3_journal.Journal recording completed copies; versions it already holds are skipped
+            governor: s3_rate_limiter.PrefixGovernor shared with other engines; every HEAD, copy and
+                delete made through the engine's client is then rate-limited per prefix
+            tuner: s3_autotune.ConcurrencyTuner adjusting the copies in flight during the run, up to its
+                max_workers (workers is then ignored); its settings are saved when the run ends
+            part_workers: Part copies in flight across all multipart copies; run() then schedules by
+                size tier (s3_copy_scheduler), starting the largest objects first
+        """
+        self.src_bucket = src_bucket
+        self.dest_bucket = dest_bucket
+        self.workers = tuner.max_workers if tuner else workers
+        self.s3 = (governed(s3, governor) if s3
+                   else client(self.workers + (part_workers or max_parts_in_flight), governor))
+        self.acl = acl
+        self.multipart_threshold = multipart_threshold
+        self.max_parts_in_flight = max_parts_in_flight
+        self.preserve_parts = preserve_parts
+        self.extra_args = extra_args or {}
+        self.journal = journal
+        self.tuner = tuner
+        self.part_workers = part_workers
+        self.stats = CopyStats()
+
+    def _copy_source(self, v):
+        source = {'Bucket': self.src_bucket, 'Key': v['Key']}
+        if v.get('VersionId'):
+            source['VersionId'] = v['VersionId']
+        return source
+
+    def _requests(self, v):
+        return [('write', self.dest_bucket, v['Key']), ('read', self.src_bucket, v['Key'])]
+
+    def multipart(self, v):
+        """Whether a version of known size is copied in parts"""
+        if v.get('Size') is None:
+            return False
+        if self.preserve_parts:
+            return v.get('ETag') is not None and _parts_count(v['ETag']) is not None
+        return v['Size'] >= self.multipart_threshold
+
+    def copy(self, v, submit=None):
+        """Copy one version (a listing or diff entry) in the entry's StorageClass, if it has one; returns its size"""
+        source = self._copy_source(v)
+        size, etag = v.get('Size'), v.get('ETag')
+        if size is None:
+            head = self.s3.head_object(**source)
+            size, etag = head['ContentLength'], head['ETag']
+        if self.preserve_parts:
+            part_sizes = source_part_sizes(self.s3, source, size, etag)
+            multipart = part_sizes is not None
+        else:
+            part_sizes = None
+            multipart = size >= self.multipart_threshold
+        # CopyObject writes STANDARD unless told otherwise; extra_args still take precedence
+        extra_args = self.extra_args
+        if v.get('StorageClass'):
+            extra_args = {'StorageClass': v['StorageClass'], **extra_args}
+        if multipart:
+            multipart_copy(self.s3, source, self.dest_bucket, v['Key'], size, acl=self.acl,
+                           max_in_flight=self.max_parts_in_flight, part_sizes=part_sizes,
+                           extra_args=extra_args, submit=submit)
+        else:
+            kwargs = {'Bucket': self.dest_bucket, 'Key': v['Key'], 'CopySource': source,
+                      'MetadataDirective': 'COPY'}
+            if self.acl:
+                kwargs['ACL'] = self.acl
+            self.s3.copy_object(**kwargs, **extra_args)
+        return size
+
+    def _outcome(self, v, submit=None):
+        started = time.monotonic()
+        outcome = {'Key': v['Key'], 'VersionId': v.get('VersionId'), 'Status': 'copied', 'Size': v.get('Size'),
+                   'Error': None}
+        try:
+            outcome['Size'] = self.copy(v, submit)
+            if self.journal is not None:
+                self.journal.record(v, 'copied')
+        except Exception as e:
+            logger.error(f"Failed to copy {v['Key']} version {v.get('VersionId')}: {e}")
+            outcome['Status'] = 'failed'
+            outcome['Error'] = str(e)
+        outcome['Seconds'] = round(time.monotonic() - started, 3)
+        self.record(outcome)
+        return outcome
+
+    def record(self, outcome):
+        """Count an outcome in the stats and the tuner"""
+        self.stats.add(outcome)
+        if self.tuner is not None:
+            self.tuner.record(outcome)
+
+    def small_limit(self):
+        """Copies kept in flight: the tuner's limit, or 2 * workers queued for the pool"""
+        return self.tuner.limit() if self.tuner else 2 * self.workers
+
+    def bounded(self, fn, items):
+        """run_bounded over the engine's workers, following the tuner when there is one"""
+        return run_bounded(fn, items, self.workers, self.tuner.limit if self.tuner else None)
+
+    def run(self, versions):
+        """Copy every version, yielding outcomes in completion order"""
+        if self.journal is not None:
+            versions = self.journal.pending(versions)
+        if isinstance(self.s3, GovernedClient):
+            versions = self.s3.governor.admit(versions, self._requests)
+        if self.part_workers:
+            yield from SizeTieredScheduler(self, self.part_workers).run(versions)
+        else:
+            yield from self.bounded(self._outcome, versions)
+        logger.info(f"Copy {self.src_bucket} -> {self.dest_bucket}: {self.stats.summary()}")
+        if self.tuner is not None:
+            self.tuner.save()
+        if isinstance(self.s3, GovernedClient) and self.s3.governor.summary():
+            logger.info(f"Throttled prefixes: {self.s3.governor.summary()}")
+
+
+def _upload_outcome(s3, directory, bucket, prefix, path, config):
+    key = prefix + os.path.relpath(path, directory).replace(os.sep, '/')
+    started = time.monotonic()
+    outcome = {'Key': key, 'VersionId': None, 'Status': 'uploaded', 'Size': os.path.getsize(path), 'Error': None}
+    try:
+        s3.upload_file(path, bucket, key, Config=config)
+    except Exception as e:
+        logger.error(f"Failed to upload {path} to s3://{bucket}/{key}: {e}")
+        outcome['Status'] = 'failed'
+        outcome['Error'] = str(e)
+    outcome['Seconds'] = round(time.monotonic() - started, 3)
+    return outcome
+
+
+def upload_directory(directory, bucket, prefix='', workers=DEFAULT_WORKERS, s3=None, part_workers=1):
+    """
+    Upload the files of a local directory that are new or changed, like `aws s3 sync`
+
+    A file is uploaded when its key is missing, its size differs, or it was
+    modified after the object. At most workers * part_workers requests are in
+    flight, which is what the default client's connection pool is sized to.
+
+    Args:
+        directory: Local directory to upload
+        bucket: Destination bucket
+        prefix: Key prefix the directory is uploaded under
+        workers: Files uploaded at the same time
+        s3: S3 client, by default one with a connection pool sized to workers * part_workers
+        part_workers: Concurrent part uploads per multipart file upload
+
+    Returns:
+        (list of per-file outcomes, CopyStats summary)
+    """
+    s3 = s3 or client(workers * part_workers)
+    # upload_file would otherwise run 10 part uploads per file, on top of the workers
+    config = TransferConfig(max_concurrency=part_workers, use_threads=part_workers > 1)
+    prefix = prefix.rstrip('/') + '/' if prefix else ''
+    existing = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            existing[obj['Key']] = (obj['Size'], obj['LastModified'].timestamp())
+
+    def changed():
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                key = prefix + os.path.relpath(path, directory).replace(os.sep, '/')
+                stat = os.stat(path)
+                current = existing.get(key)
+                if current is None or current[0] != stat.st_size or stat.st_mtime > current[1]:
+                    yield path
+
+    stats = CopyStats()
+    outcomes = []
+    for outcome in run_bounded(lambda path: _upload_outcome(s3, directory, bucket, prefix, path, config),
+                               changed(), workers):
+        stats.add(outcome)
+        outcomes.append(outcome)
+    return outcomes, stats.summary()
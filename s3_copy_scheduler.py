@@ -0,0 +1,144 @@
+"""
+Size-tiered scheduling of copy work.
+
+With one FIFO of objects a run ends in a long tail: a huge object met late
+in the listing starts last and copies alone, MAX_PARTS_IN_FLIGHT parts at a
+time, while every other worker idles. SizeTieredScheduler splits the work:
+
+- CopyObject-sized versions go to the object pool (the engine's workers)
+- multipart versions are held in a heap by size and started largest first
+  (largest-processing-time-first) whenever the part pool runs short of work
+- the parts of every multipart copy share one part pool, ordered by object
+  size, so the largest object's parts run first and parts interleave with
+  small-object copies instead of waiting behind them
+
+The last huge object is then copied by the whole part pool, and wall time
+approaches total bytes over bandwidth. The listing is not buffered: multipart
+versions are started largest first among those read so far (at least
+LARGE_LOOKAHEAD of them, or all of a shorter listing), and a huge object's parts
+overtake those of smaller objects already queued. At most LARGE_LOOKAHEAD
+multipart versions are held; reading waits while the part pool is busy.
+"""
+import heapq
+import itertools
+import logging
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+# Multipart copies coordinated at once; each waits for its parts in the part pool
+MAX_LARGE_IN_FLIGHT = 16
+
+# Multipart versions gathered before the largest is started, unless small copies have to be waited for
+# anyway, and the most held waiting for the part pool
+LARGE_LOOKAHEAD = 64
+
+
+class PriorityPool:
+    """Thread pool running submitted calls lowest priority first"""
+
+    def __init__(self, workers):
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, priority, fn, *args):
+        future = Future()
+        self._queue.put((priority, next(self._order), future, fn, args))
+        return future
+
+    def backlog(self):
+        """Calls waiting for a thread"""
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            _, _, future, fn, args = self._queue.get()
+            if future is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def shutdown(self):
+        # Sorts after every call, so queued calls still run first
+        for _ in self._threads:
+            self._queue.put(((float('inf'),), next(self._order), None, None, None))
+        for thread in self._threads:
+            thread.join()
+
+
+class SizeTieredScheduler:
+    def __init__(self, engine, part_workers, max_large_in_flight=MAX_LARGE_IN_FLIGHT):
+        """
+        Schedule a CopyEngine's versions by size tier
+
+        Args:
+            engine: CopyEngine whose copy settings, client, stats and tuner are used
+            part_workers: Part copies in flight across all multipart copies
+            max_large_in_flight: Multipart copies coordinated at once
+        """
+        self.engine = engine
+        self.part_workers = part_workers
+        self.max_large_in_flight = max_large_in_flight
+
+    def run(self, versions):
+        """Copy every version, yielding outcomes in completion order"""
+        engine = self.engine
+        parts = PriorityPool(self.part_workers)
+        large = []
+        order = itertools.count()
+        small_pending, large_pending = set(), set()
+
+        def start_large(large_pool):
+            # Only as many large copies as keep the part pool busy, so larger ones found later still go first
+            while large and len(large_pending) < self.max_large_in_flight and parts.backlog() < self.part_workers:
+                _, _, v = heapq.heappop(large)
+                submit = _part_submitter(parts, v['Size'], next(order))
+                large_pending.add(large_pool.submit(engine._outcome, v, submit))
+
+        def finished(timeout=None):
+            done, _ = wait(small_pending | large_pending, timeout, return_when=FIRST_COMPLETED)
+            small_pending.difference_update(done)
+            large_pending.difference_update(done)
+            return [future.result() for future in done]
+
+        with ThreadPoolExecutor(max_workers=engine.workers) as small_pool, \
+                ThreadPoolExecutor(max_workers=self.max_large_in_flight) as large_pool:
+            try:
+                for v in versions:
+                    if engine.multipart(v):
+                        heapq.heappush(large, (-v['Size'], next(order), v))
+                    else:
+                        # Versions of unknown size may still turn out multipart; their parts join the part pool
+                        submit = _part_submitter(parts, 0, next(order))
+                        small_pending.add(small_pool.submit(engine._outcome, v, submit))
+                    if len(large) >= LARGE_LOOKAHEAD:
+                        start_large(large_pool)
+                    # The heap is full: stop reading until the part pool takes the largest
+                    while len(large) >= LARGE_LOOKAHEAD:
+                        yield from finished(timeout=1.0)
+                        start_large(large_pool)
+                    while len(small_pending) >= engine.small_limit():
+                        yield from finished()
+                        start_large(large_pool)
+                while large or small_pending or large_pending:
+                    start_large(large_pool)
+                    # Parts finishing free the part pool without finishing a copy; look again regularly
+                    yield from finished(timeout=1.0 if large else None)
+            finally:
+                for future in small_pending | large_pending:
+                    future.cancel()
+                parts.shutdown()
+
+
+def _part_submitter(parts, size, order):
+    """submit(fn, *args) queueing an object's parts behind those of larger objects"""
+    return lambda fn, *args: parts.submit((-size, order), fn, *args)
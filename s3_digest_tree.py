@@ -0,0 +1,231 @@
+"""
+Per-prefix digest trees (Merkle trees) of S3 version listings.
+
+Nightly reconciliation only needs to know which prefixes diverged. A digest
+tree hashes every version (key, version ID, ETag, size, delete marker) into
+the directory that holds it and rolls directory digests up to the bucket
+root, one level per '/'. Two trees are compared top-down, descending only into
+subtrees whose digests differ, so a bucket with a handful of changes is
+settled after looking at a handful of nodes.
+
+Every node keeps two digests:
+
+  * digest       - everything under the prefix (its files and child digests)
+  * files_digest - only the keys stored directly under the prefix; at
+                   max_depth this covers every deeper key as well
+
+so a diverged node tells whether its own keys differ or only some children.
+Trees are built from a key-ordered listing in one pass and can be stored in
+the listing cache database next to the cached listing. The next run updates
+the stored tree instead of building it again: only the top-level prefixes
+ListingCache.refresh() found changed are read, and the root is recombined
+from its own keys and the top-level digests.
+"""
+import hashlib
+import heapq
+import sqlite3
+import time
+from contextlib import contextmanager
+from itertools import groupby
+from operator import itemgetter
+
+from s3_listing_cache import DEFAULT_CACHE_PATH
+
+DEFAULT_MAX_DEPTH = 4
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests (
+    bucket TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    files_digest TEXT NOT NULL,
+    versions INTEGER NOT NULL,
+    max_depth INTEGER NOT NULL,
+    built_at REAL NOT NULL,
+    PRIMARY KEY (bucket, prefix)
+) WITHOUT ROWID;
+"""
+
+
+class _Node:
+    __slots__ = ('prefix', 'digest', 'files_digest', 'versions')
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.digest = hashlib.sha256()
+        self.files_digest = hashlib.sha256()
+        self.versions = 0
+
+
+def _parent(prefix):
+    return prefix[:prefix.rstrip('/').rfind('/') + 1]
+
+
+def _dirs(key, max_depth):
+    """Directory prefixes of key below the root, at most max_depth of them"""
+    dirs = []
+    start = 0
+    while len(dirs) < max_depth:
+        i = key.find('/', start)
+        if i < 0:
+            break
+        dirs.append(key[:i + 1])
+        start = i + 1
+    return dirs
+
+
+def _top(prefix):
+    """Top-level prefix a prefix lies under"""
+    return prefix[:prefix.find('/') + 1]
+
+
+def _leaf(v):
+    return (f"{v['Key']}\0{v['VersionId']}\0{v.get('ETag', '')}\0{v.get('Size', 0)}\0"
+            f"{int(v.get('DeleteMarker', False))}\n").encode('utf-8')
+
+
+class DigestTree:
+    def __init__(self, nodes, max_depth=DEFAULT_MAX_DEPTH):
+        """
+        Args:
+            nodes: {prefix: (digest, files_digest, versions)}, '' being the bucket root
+            max_depth: Deepest directory level that has its own node
+        """
+        self.nodes = nodes
+        self.max_depth = max_depth
+        self.children = {}
+        for prefix in nodes:
+            if prefix:
+                self.children.setdefault(_parent(prefix), []).append(prefix)
+
+    @classmethod
+    def build(cls, versions, max_depth=DEFAULT_MAX_DEPTH):
+        """Build the tree of a listing in key order (get_all_versions with ordered=True)"""
+        nodes = {}
+        stack = [_Node('')]
+
+        def close():
+            node = stack.pop()
+            digest = node.digest.hexdigest()
+            nodes[node.prefix] = (digest, node.files_digest.hexdigest(), node.versions)
+            if stack:
+                stack[-1].digest.update(f"{node.prefix}\0{digest}\n".encode('utf-8'))
+                stack[-1].versions += node.versions
+
+        for key, group in groupby(versions, key=itemgetter('Key')):
+            while len(stack) > 1 and not key.startswith(stack[-1].prefix):
+                close()
+            for prefix in _dirs(key, max_depth)[len(stack) - 1:]:
+                stack.append(_Node(prefix))
+            node = stack[-1]
+            # Versions of a key are hashed in version ID order, so equal LastModified ties cannot reorder them
+            for v in sorted(group, key=itemgetter('VersionId')):
+                leaf = _leaf(v)
+                node.digest.update(leaf)
+                node.files_digest.update(leaf)
+                node.versions += 1
+        while stack:
+            close()
+        return cls(nodes, max_depth)
+
+    @classmethod
+    def update(cls, stored, changed, prefixes, listing, max_depth=DEFAULT_MAX_DEPTH):
+        """
+        Update a stored tree, listing only the top-level prefixes that changed
+
+        Args:
+            stored: Tree saved by the last run, None to build from a full listing
+            changed: Top-level prefixes ('logs/') whose contents changed since, e.g. ListingCache.refresh()'s result
+            prefixes: Every top-level prefix the bucket holds now
+            listing: Function of (prefix, delimiter) returning the versions under prefix in key order
+        """
+        if stored is None or stored.max_depth != max_depth or max_depth < 1:
+            return cls.build(listing('', None), max_depth)
+        changed, prefixes = set(changed), set(prefixes)
+        nodes = {p: node for p, node in stored.nodes.items()
+                 if p and _top(p) in prefixes and _top(p) not in changed}
+        for prefix in sorted(changed & prefixes):
+            nodes.update((p, node) for p, node in cls.build(listing(prefix, None), max_depth).nodes.items() if p)
+
+        # The root hashes its own keys and the top-level digests in key order, as build() does
+        root = _Node('')
+        keys = ((key, list(group)) for key, group in groupby(listing('', '/'), key=itemgetter('Key')))
+        children = ((p, None) for p in sorted(p for p in nodes if p.count('/') == 1))
+        for name, group in heapq.merge(keys, children, key=itemgetter(0)):
+            if group is None:
+                digest, _, versions = nodes[name]
+                root.digest.update(f"{name}\0{digest}\n".encode('utf-8'))
+                root.versions += versions
+                continue
+            for v in sorted(group, key=itemgetter('VersionId')):
+                leaf = _leaf(v)
+                root.digest.update(leaf)
+                root.files_digest.update(leaf)
+                root.versions += 1
+        nodes[''] = (root.digest.hexdigest(), root.files_digest.hexdigest(), root.versions)
+        return cls(nodes, max_depth)
+
+    def diverged(self, other):
+        """
+        Walk both trees top-down and return the prefixes whose contents differ
+
+        Returns:
+            List of (prefix, scope); scope 'direct' means only the keys directly
+            under prefix differ, 'all' means the whole subtree must be compared
+        """
+        result = []
+        pending = ['']
+        while pending:
+            prefix = pending.pop()
+            mine, theirs = self.nodes.get(prefix), other.nodes.get(prefix)
+            if mine is not None and theirs is not None and mine[0] == theirs[0]:
+                continue
+            if mine is None or theirs is None or prefix.count('/') >= min(self.max_depth, other.max_depth):
+                result.append((prefix, 'all'))
+                continue
+            if mine[1] != theirs[1]:
+                result.append((prefix, 'direct'))
+            pending.extend(set(self.children.get(prefix, [])) | set(other.children.get(prefix, [])))
+        return sorted(result)
+
+
+class DigestStore:
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        """
+        Open the digest table, by default inside the listing cache database
+
+        Args:
+            path: SQLite database file
+        """
+        self.path = path
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connection(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def save(self, bucket, tree):
+        """Replace the stored tree of bucket"""
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute("DELETE FROM digests WHERE bucket = ?", (bucket,))
+            conn.executemany("INSERT INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             ((bucket, prefix, digest, files_digest, versions, tree.max_depth, now)
+                              for prefix, (digest, files_digest, versions) in tree.nodes.items()))
+
+    def load(self, bucket):
+        """Return the stored tree of bucket, or None"""
+        with self._connection() as conn:
+            rows = conn.execute("SELECT prefix, digest, files_digest, versions, max_depth FROM digests "
+                                "WHERE bucket = ?", (bucket,)).fetchall()
+        if not rows:
+            return None
+        return DigestTree({prefix: (digest, files_digest, versions) for prefix, digest, files_digest, versions, _ in rows},
+                          rows[0][4])
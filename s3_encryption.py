@@ -0,0 +1,239 @@
+"""
+Server-side encryption of object versions, for the CSV inventory.
+
+A listing does not report encryption, and HEADing every version one after
+another costs a round trip each: about 3 days for 50M versions. The
+EncryptionEnricher answers without a request where it can and runs the
+remaining HEADs on a bounded thread pool:
+
+1. delete markers have no encryption
+2. rows of an S3 Inventory report carry EncryptionStatus
+3. with assume_default, the bucket's default encryption is reported for every
+   object (objects uploaded with their own encryption headers, or before the
+   default was set, are then misreported, so this is opt-in)
+4. versions already HEADed by an earlier run are read from the EncryptionCache,
+   a table in the listing cache database; a version's encryption never changes,
+   and the LastModified stored with it catches overwritten 'null' versions
+5. everything else is HEADed, WORKERS at a time
+
+Versions are passed through in the order they were added.
+"""
+import logging
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from s3_listing_cache import DEFAULT_CACHE_PATH
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 64
+
+# Versions looked up in the cache per query, and HEADs queued per worker before add() waits
+LOOKUP_BATCH = 500
+QUEUED_PER_WORKER = 4
+
+# S3 Inventory EncryptionStatus -> HeadObject ServerSideEncryption
+ENCRYPTION_STATUS = {'NOT-SSE': '', 'SSE-S3': 'AES256', 'SSE-KMS': 'aws:kms', 'DSSE-KMS': 'aws:kms:dsse', 'SSE-C': ''}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS encryption (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    version_id TEXT NOT NULL,
+    last_modified REAL,
+    sse TEXT NOT NULL,
+    PRIMARY KEY (bucket, key, version_id)
+) WITHOUT ROWID;
+"""
+
+
+def default_encryption(s3, bucket):
+    """SSEAlgorithm of the bucket's default encryption, None if it has none"""
+    try:
+        rules = s3.get_bucket_encryption(Bucket=bucket)['ServerSideEncryptionConfiguration']['Rules']
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'ServerSideEncryptionConfigurationNotFoundError':
+            return None
+        raise
+    for rule in rules:
+        algorithm = rule.get('ApplyServerSideEncryptionByDefault', {}).get('SSEAlgorithm')
+        if algorithm:
+            return algorithm
+    return None
+
+
+def _timestamp(v):
+    return v['LastModified'].timestamp() if v.get('LastModified') else None
+
+
+class EncryptionCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, commit_batch=10000):
+        """
+        Open the encryption table, by default inside the listing cache database
+
+        Args:
+            path: SQLite database file
+            commit_batch: Recorded versions per commit
+        """
+        self.path = path
+        self.commit_batch = commit_batch
+        self._lock = threading.Lock()
+        self._pending = []
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def lookup(self, bucket, versions):
+        """{(key, version_id): sse} of the versions cached with the same LastModified"""
+        keys = list({v['Key'] for v in versions})
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT key, version_id, last_modified, sse FROM encryption WHERE bucket = ? "
+                f"AND key IN ({', '.join(['?'] * len(keys))})", [bucket] + keys).fetchall()
+        stored = {(key, version_id): (last_modified, sse) for key, version_id, last_modified, sse in rows}
+        found = {}
+        for v in versions:
+            hit = stored.get((v['Key'], v['VersionId']))
+            if hit is not None and hit[0] == _timestamp(v):
+                found[(v['Key'], v['VersionId'])] = hit[1]
+        return found
+
+    def record(self, bucket, v, sse):
+        with self._lock:
+            self._pending.append((bucket, v['Key'], v['VersionId'], _timestamp(v), sse))
+            if len(self._pending) >= self.commit_batch:
+                self._commit()
+
+    def _commit(self):
+        if self._pending:
+            self._conn.executemany('INSERT OR REPLACE INTO encryption VALUES (?, ?, ?, ?, ?)', self._pending)
+            self._conn.commit()
+            self._pending = []
+
+    def seed(self, bucket, rows):
+        """Cache the EncryptionStatus of S3 Inventory rows, returns the number of versions cached"""
+        count = 0
+        for v in rows:
+            if v.get('EncryptionStatus') in ENCRYPTION_STATUS and not v.get('DeleteMarker'):
+                self.record(bucket, v, ENCRYPTION_STATUS[v['EncryptionStatus']])
+                count += 1
+        self.flush()
+        logger.info(f"Cached the encryption of {count} versions of {bucket} from its inventory")
+        return count
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+
+def _done(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class EncryptionEnricher:
+    def __init__(self, s3, bucket, workers=DEFAULT_WORKERS, cache=None, assume_default=False):
+        """
+        Resolve the ServerSideEncryption of a bucket's versions
+
+        Args:
+            workers: Concurrent HEADs
+            cache: EncryptionCache of earlier results, None to HEAD every version without an answer
+            assume_default: Report the bucket's default encryption for every object instead of HEADing it
+        """
+        self.s3 = s3
+        self.bucket = bucket
+        self.workers = workers
+        self.cache = cache
+        self.default = default_encryption(s3, bucket) if assume_default else None
+        self.counts = {'inventory': 0, 'default': 0, 'cache': 0, 'head': 0, 'failed': 0}
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._unresolved = []
+        self._queue = deque()
+        if assume_default:
+            logger.info(f"Reporting the default encryption of {bucket}, {self.default or 'none'}, for every object")
+
+    def _known(self, v):
+        """Encryption answered without a request, or None"""
+        if v.get('DeleteMarker'):
+            return ''
+        if v.get('EncryptionStatus') in ENCRYPTION_STATUS:
+            self.counts['inventory'] += 1
+            return ENCRYPTION_STATUS[v['EncryptionStatus']]
+        if self.default is not None:
+            self.counts['default'] += 1
+            return self.default
+        return None
+
+    def _head(self, v):
+        try:
+            head = self.s3.head_object(Bucket=self.bucket, Key=v['Key'], VersionId=v['VersionId'])
+        except Exception as e:
+            # Left empty as before, and not cached so the next run tries again
+            logger.debug(f"HEAD of {v['Key']} version {v['VersionId']} failed: {e}")
+            with self._lock:
+                self.counts['failed'] += 1
+            return ''
+        sse = head.get('ServerSideEncryption', '')
+        with self._lock:
+            self.counts['head'] += 1
+        if self.cache is not None:
+            self.cache.record(self.bucket, v, sse)
+        return sse
+
+    def _resolve(self):
+        """Queue the buffered versions in order: known and cached answers as they are, the rest as HEADs"""
+        buffered, self._unresolved = self._unresolved, []
+        unknown = [v for v, sse in buffered if sse is None]
+        cached = self.cache.lookup(self.bucket, unknown) if self.cache is not None and unknown else {}
+        self.counts['cache'] += len(cached)
+        for v, sse in buffered:
+            if sse is None:
+                sse = cached.get((v['Key'], v['VersionId']))
+            self._queue.append((v, _done(sse) if sse is not None else self._pool.submit(self._head, v)))
+
+    def _pop(self, wait):
+        ready = []
+        while self._queue and (wait or self._queue[0][1].done()):
+            v, future = self._queue.popleft()
+            ready.append((v, future.result()))
+        return ready
+
+    def add(self, v):
+        """Add a version, returns the (version, sse) pairs resolved so far, in the order they were added"""
+        sse = self._known(v)
+        if sse is not None and not self._unresolved:
+            self._queue.append((v, _done(sse)))
+        else:
+            # Versions are buffered for a batched cache lookup; known ones wait behind them to keep the order
+            self._unresolved.append((v, sse))
+            if len(self._unresolved) >= LOOKUP_BATCH:
+                self._resolve()
+        ready = self._pop(wait=False)
+        # Bound the HEADs queued ahead of the writer
+        while len(self._queue) > self.workers * QUEUED_PER_WORKER:
+            v, future = self._queue.popleft()
+            ready.append((v, future.result()))
+        return ready
+
+    def drain(self):
+        """The (version, sse) pairs of every version added, waiting for their HEADs"""
+        self._resolve()
+        return self._pop(wait=True)
+
+    def close(self):
+        self._pool.shutdown()
+        if self.cache is not None:
+            self.cache.flush()
+        logger.info(f"Encryption of {self.bucket} versions answered by: {self.counts}")
@@ -0,0 +1,157 @@
+"""
+Reader for S3 Inventory reports.
+
+S3ReplicationManager.create_inventory configures daily inventories with
+IncludedObjectVersions=All. Each delivery is described by a manifest.json that
+lists the data files (CSV.gz, or Parquet when configured), so a full version
+listing can be read from the inventory bucket without a single
+ListObjectVersions call.
+
+Data files are fetched and decompressed concurrently and their rows are
+yielded as listing-shaped dicts (Key, VersionId, IsLatest, DeleteMarker, Size,
+ETag, StorageClass, LastModified), the same shape get_all_versions produces.
+Rows are NOT in key order: inventory data files are not sorted.
+"""
+import csv
+import gzip
+import io
+import json
+import logging
+from datetime import datetime
+from functools import partial
+from urllib.parse import unquote_plus
+
+from s3_listing import iter_concurrently
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet inventories need pyarrow, CSV ones do not
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+# Rows handed over per page from the reader threads
+ROWS_PER_PAGE = 5000
+
+# Inventory schema column -> listing field, for CSV (fileSchema) and Parquet column names
+_CSV_COLUMNS = {
+    'Key': 'Key',
+    'VersionId': 'VersionId',
+    'IsLatest': 'IsLatest',
+    'IsDeleteMarker': 'DeleteMarker',
+    'Size': 'Size',
+    'LastModifiedDate': 'LastModified',
+    'ETag': 'ETag',
+    'StorageClass': 'StorageClass',
+    'EncryptionStatus': 'EncryptionStatus',
+}
+_PARQUET_COLUMNS = {
+    'key': 'Key',
+    'version_id': 'VersionId',
+    'is_latest': 'IsLatest',
+    'is_delete_marker': 'DeleteMarker',
+    'size': 'Size',
+    'last_modified_date': 'LastModified',
+    'e_tag': 'ETag',
+    'storage_class': 'StorageClass',
+    'encryption_status': 'EncryptionStatus',
+}
+
+
+def _split_s3_url(url):
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def load_manifest(s3, location):
+    """Load an inventory manifest.json from a local path or an s3:// URL"""
+    if location.startswith('s3://'):
+        bucket, key = _split_s3_url(location)
+        manifest = json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+    else:
+        with open(location) as f:
+            manifest = json.load(f)
+    if manifest['fileFormat'] not in ('CSV', 'Parquet'):
+        raise ValueError(f"Unsupported inventory format: {manifest['fileFormat']}")
+    if manifest['fileFormat'] == 'Parquet' and pq is None:
+        raise ImportError("pyarrow is required to read Parquet inventories")
+    return manifest
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.lower() == 'true'
+    return bool(value)
+
+
+def _to_datetime(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return value
+
+
+def _normalize(row):
+    """Turn an inventory row (listing field -> raw value) into a listing-shaped dict"""
+    v = {
+        'Key': row['Key'],
+        'VersionId': row.get('VersionId') or 'null',
+        'IsLatest': _to_bool(row.get('IsLatest', True)),
+    }
+    if row.get('LastModified'):
+        v['LastModified'] = _to_datetime(row['LastModified'])
+    if row.get('EncryptionStatus'):
+        v['EncryptionStatus'] = row['EncryptionStatus']
+    if _to_bool(row.get('DeleteMarker', False)):
+        v['DeleteMarker'] = True
+        return v
+    etag = row.get('ETag') or ''
+    v.update({
+        'Size': int(row['Size']) if row.get('Size') not in (None, '') else 0,
+        # Listings quote ETags, inventories do not
+        'ETag': etag if etag.startswith('"') else f'"{etag}"',
+        'StorageClass': row.get('StorageClass') or '',
+    })
+    return v
+
+
+def _iter_csv_file(body, columns):
+    reader = csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=body), encoding='utf-8', newline=''))
+    page = []
+    for values in reader:
+        row = {field: value for field, value in zip(columns, values) if field}
+        # CSV inventories URL-encode object keys
+        row['Key'] = unquote_plus(row['Key'])
+        page.append(_normalize(row))
+        if len(page) >= ROWS_PER_PAGE:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def _iter_parquet_file(body):
+    parquet = pq.ParquetFile(io.BytesIO(body.read()))
+    wanted = [c for c in parquet.schema_arrow.names if c in _PARQUET_COLUMNS]
+    for batch in parquet.iter_batches(batch_size=ROWS_PER_PAGE, columns=wanted):
+        yield [_normalize({_PARQUET_COLUMNS[c]: value for c, value in record.items()})
+               for record in batch.to_pylist()]
+
+
+def _iter_data_file(s3, manifest, data_file):
+    """Yield pages of listing-shaped rows from one inventory data file"""
+    bucket = manifest['destinationBucket'].split(':::')[-1]
+    body = s3.get_object(Bucket=bucket, Key=data_file['key'])['Body']
+    if manifest['fileFormat'] == 'Parquet':
+        yield from _iter_parquet_file(body)
+    else:
+        columns = [_CSV_COLUMNS.get(c.strip()) for c in manifest['fileSchema'].split(',')]
+        yield from _iter_csv_file(body, columns)
+
+
+def iter_inventory(s3, manifest, workers=8):
+    """Yield every row of an inventory delivery, reading its data files concurrently"""
+    files = manifest['files']
+    logger.info(f"Reading {len(files)} inventory files of {manifest['sourceBucket']} with {workers} workers")
+    sources = [partial(_iter_data_file, s3, manifest, f) for f in files]
+    for page in iter_concurrently(sources, workers, ordered=False):
+        yield from page
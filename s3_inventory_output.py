@@ -0,0 +1,393 @@
+"""
+Writers for generated inventories: CSV, gzip CSV or Parquet, to a local file or
+streamed straight into an S3 multipart upload.
+
+inventory rows (the s3_migration_handler INVENTORY_FIELDS dicts) are written
+as the listing streams, so memory stays bounded by one gzip buffer, one
+Parquet row group and the parts in flight, whatever the bucket size:
+
+- 'csv': the CSV with a header row the handler always wrote
+- 'csv.gz': gzip CSV in the S3 Inventory layout (no header, Bucket first, keys
+  URL-encoded). Like S3 Inventory it lists delete markers too, so it serves as
+  an S3 Batch Operations manifest only for operations that accept them: a Copy
+  job fails on every delete-marker row
+- 'parquet': Parquet with the S3 Inventory column names and types, ROW_GROUP_ROWS
+  rows per row group, readable by Athena (needs pyarrow)
+
+With an s3:// destination the data file is uploaded in parts as it is written,
+at most PARTS_IN_FLIGHT at a time, and for 'csv.gz' and 'parquet'
+a manifest.json is put next to it the way S3 Inventory delivers one:
+
+    s3://bucket/prefix/data/<name>.csv.gz   (the Athena table LOCATION is .../data/)
+    s3://bucket/prefix/manifest.json        (s3_inventory reads it, as does Batch Operations)
+"""
+import csv
+import gzip
+import hashlib
+import io
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+from urllib.parse import quote
+
+from s3_encryption import ENCRYPTION_STATUS
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet output needs pyarrow, CSV output does not
+    pa = pq = None
+
+logger = logging.getLogger(__name__)
+
+INVENTORY_FORMATS = ('csv', 'csv.gz', 'parquet')
+
+# Multipart upload part size (at least 5 MiB but for the last part), doubled every PART_SIZE_DOUBLING parts
+# up to MAX_PART_SIZE so the 10,000 parts of an upload hold any object size S3 allows, and parts uploaded at once
+PART_SIZE = 16 * 1024 ** 2
+PART_SIZE_DOUBLING = 1000
+MAX_PART_SIZE = 5 * 1024 ** 3
+PARTS_IN_FLIGHT = 4
+
+# Rows buffered per Parquet row group
+ROW_GROUP_ROWS = 100000
+
+# Millisecond timestamps, as S3 Inventory writes them, are read by every Athena engine version
+_PARQUET_OPTIONS = {'compression': 'snappy', 'coerce_timestamps': 'ms', 'allow_truncated_timestamps': True}
+
+# S3 Inventory columns written by 'csv.gz', in fileSchema order, and their Parquet names
+INVENTORY_COLUMNS = ('Bucket', 'Key', 'VersionId', 'IsLatest', 'IsDeleteMarker', 'Size', 'LastModifiedDate', 'ETag',
+                     'StorageClass', 'EncryptionStatus')
+PARQUET_COLUMNS = ('bucket', 'key', 'version_id', 'is_latest', 'is_delete_marker', 'size', 'last_modified_date',
+                   'e_tag', 'storage_class', 'encryption_status')
+
+# HeadObject ServerSideEncryption -> S3 Inventory EncryptionStatus
+_ENCRYPTION_STATUS = {sse: status for status, sse in ENCRYPTION_STATUS.items() if status != 'SSE-C'}
+
+
+def _split_s3_url(url):
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+
+class FileSink:
+    """Local file, with the size and MD5 of what was written"""
+
+    def __init__(self, path):
+        self.location = path
+        self.size = 0
+        self._md5 = hashlib.md5()
+        self._file = open(path, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+        self._md5.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def writable(self):
+        return True
+
+    def readable(self):
+        return False
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        pass
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def md5(self):
+        return self._md5.hexdigest()
+
+    def close(self):
+        self._file.close()
+
+    def abort(self):
+        self._file.close()
+
+
+class MultipartSink(FileSink):
+    def __init__(self, s3, bucket, key, part_size=PART_SIZE, parts_in_flight=PARTS_IN_FLIGHT):
+        """
+        Stream writes into an S3 multipart upload
+
+        Args:
+            part_size: Bytes of the first parts, doubled every PART_SIZE_DOUBLING parts; writes are
+                buffered until a part is full
+            parts_in_flight: Parts uploaded at once; write() waits for the oldest beyond that
+        """
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.location = f"s3://{bucket}/{key}"
+        self.part_size = part_size
+        self.parts_in_flight = parts_in_flight
+        self.size = 0
+        self._md5 = hashlib.md5()
+        self._buffer = bytearray()
+        self._futures = []
+        self._closed = False
+        self._pool = ThreadPoolExecutor(max_workers=parts_in_flight)
+        self._upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+    def _upload(self, number, body):
+        etag = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id, PartNumber=number,
+                                   Body=body)['ETag']
+        return {'PartNumber': number, 'ETag': etag}
+
+    def _next_part_size(self):
+        return min(MAX_PART_SIZE, self.part_size * 2 ** (len(self._futures) // PART_SIZE_DOUBLING))
+
+    def _send(self, body):
+        self._futures.append(self._pool.submit(self._upload, len(self._futures) + 1, bytes(body)))
+        # Bound the parts held in memory
+        in_flight = [f for f in self._futures if not f.done()]
+        if len(in_flight) > self.parts_in_flight:
+            in_flight[0].result()
+
+    def write(self, data):
+        self._buffer += data
+        self._md5.update(data)
+        self.size += len(data)
+        try:
+            while len(self._buffer) >= self._next_part_size():
+                part_size = self._next_part_size()
+                self._send(self._buffer[:part_size])
+                del self._buffer[:part_size]
+        except BaseException:
+            self.abort()
+            raise
+        return len(data)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        """Upload the last part and complete the upload; the upload is aborted if that fails"""
+        if self._closed:
+            return
+        try:
+            if self._buffer or not self._futures:
+                self._send(self._buffer)
+                self._buffer = bytearray()
+            parts = [f.result() for f in self._futures]
+            self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                              MultipartUpload={'Parts': parts})
+        except BaseException:
+            self.abort()
+            raise
+        self._pool.shutdown()
+        self._closed = True
+
+    def abort(self):
+        if self._closed:
+            return
+        self._closed = True
+        for future in self._futures:
+            future.cancel()
+        self._pool.shutdown()
+        self._buffer = bytearray()
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+
+def _timestamp(value):
+    """ISO-8601 in UTC with milliseconds, as S3 Inventory writes LastModifiedDate"""
+    if not hasattr(value, 'astimezone'):
+        return value or ''
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.') + f"{value.microsecond // 1000:03d}Z"
+
+
+def _inventory_values(bucket, row):
+    """S3 Inventory column values of an inventory row, in INVENTORY_COLUMNS order"""
+    delete_marker = bool(row['DeleteMarker'])
+    return (bucket, row['Key'], row['VersionId'], bool(row['IsLatest']), delete_marker,
+            None if delete_marker else row['Size'], row['LastModified'] or None,
+            None if delete_marker else (row['ETag'] or '').strip('"'),
+            None if delete_marker else row['StorageClass'],
+            None if delete_marker else _ENCRYPTION_STATUS.get(row['ServerSideEncryption'], 'NOT-SSE'))
+
+
+class CsvWriter:
+    """CSV with a header row, the handler's original format"""
+
+    extension = 'csv'
+    file_format = None
+
+    def __init__(self, bucket, sink, fields):
+        self.sink = sink
+        self._text = io.TextIOWrapper(sink, encoding='utf-8', newline='', write_through=True)
+        self._writer = csv.DictWriter(self._text, fieldnames=fields)
+        self._writer.writeheader()
+
+    def write(self, row):
+        self._writer.writerow(row)
+
+    def close(self):
+        self._text.flush()
+        self._text.detach()
+
+
+class CsvGzWriter(CsvWriter):
+    """gzip CSV in the S3 Inventory layout: no header, keys URL-encoded, booleans as true/false"""
+
+    extension = 'csv.gz'
+    file_format = 'CSV'
+
+    def __init__(self, bucket, sink, fields=None):
+        self.bucket = bucket
+        self.sink = sink
+        self._gzip = gzip.GzipFile(fileobj=sink, mode='wb')
+        self._text = io.TextIOWrapper(self._gzip, encoding='utf-8', newline='')
+        self._writer = csv.writer(self._text, quoting=csv.QUOTE_ALL)
+
+    def write(self, row):
+        values = list(_inventory_values(self.bucket, row))
+        values[1] = quote(values[1], safe='/')
+        values[3], values[4] = str(values[3]).lower(), str(values[4]).lower()
+        values[6] = _timestamp(values[6])
+        self._writer.writerow(['' if value is None else value for value in values])
+
+    def close(self):
+        self._text.flush()
+        self._text.detach()
+        self._gzip.close()
+
+    @staticmethod
+    def file_schema():
+        return ', '.join(INVENTORY_COLUMNS)
+
+
+class ParquetWriter:
+    """Parquet with S3 Inventory column names and types, written a row group at a time"""
+
+    extension = 'parquet'
+    file_format = 'Parquet'
+
+    def __init__(self, bucket, sink, fields=None, row_group_rows=ROW_GROUP_ROWS):
+        if pq is None:
+            raise ImportError("pyarrow is required to write Parquet inventories")
+        self.bucket = bucket
+        self.sink = sink
+        self.row_group_rows = row_group_rows
+        self.schema = self.arrow_schema()
+        self._columns = [[] for _ in PARQUET_COLUMNS]
+        self._writer = pq.ParquetWriter(sink, self.schema, **_PARQUET_OPTIONS)
+
+    @staticmethod
+    def arrow_schema():
+        return pa.schema([pa.field('bucket', pa.string(), nullable=False), pa.field('key', pa.string(), nullable=False),
+                          ('version_id', pa.string()),
+                          ('is_latest', pa.bool_()), ('is_delete_marker', pa.bool_()), ('size', pa.int64()),
+                          ('last_modified_date', pa.timestamp('ms', tz='UTC')), ('e_tag', pa.string()),
+                          ('storage_class', pa.string()), ('encryption_status', pa.string())])
+
+    def write(self, row):
+        for column, value in zip(self._columns, _inventory_values(self.bucket, row)):
+            column.append(value)
+        if len(self._columns[0]) >= self.row_group_rows:
+            self._flush()
+
+    def _flush(self):
+        if self._columns[0]:
+            self._writer.write_table(pa.Table.from_arrays(self._columns, schema=self.schema))
+            self._columns = [[] for _ in PARQUET_COLUMNS]
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+    def file_schema(self):
+        """Parquet message type of the data file, as S3 Inventory puts in the manifest's fileSchema"""
+        # pyarrow exposes the Parquet schema only for a written file, so write an empty one the same way
+        buffer = io.BytesIO()
+        pq.write_table(self.schema.empty_table(), buffer, **_PARQUET_OPTIONS)
+        schema = pq.ParquetFile(pa.BufferReader(buffer.getvalue())).schema
+        fields = []
+        for column in (schema.column(i) for i in range(len(schema.names))):
+            repetition = 'required' if column.max_definition_level == 0 else 'optional'
+            annotation = f" ({column.converted_type})" if column.converted_type != 'NONE' else ''
+            physical_type = 'binary' if column.physical_type == 'BYTE_ARRAY' else column.physical_type.lower()
+            fields.append(f"{repetition} {physical_type} {column.name}{annotation}")
+        return f"message s3.inventory {{ {'; '.join(fields)}; }}"
+
+
+WRITERS = {'csv': CsvWriter, 'csv.gz': CsvGzWriter, 'parquet': ParquetWriter}
+
+
+class InventoryOutput:
+    def __init__(self, bucket, name, fmt='csv', destination=None, s3=None, fields=None):
+        """
+        Open an inventory output of bucket
+
+        Args:
+            name: Data file name without extension, e.g. 'bucket-20240101000000-inventory'
+            fmt: One of INVENTORY_FORMATS
+            destination: s3://bucket/prefix/ to stream the inventory to, by default the current directory
+            s3: S3 client, needed for an s3:// destination
+            fields: Columns of the 'csv' format
+        """
+        writer = WRITERS[fmt]
+        self.bucket = bucket
+        self.fmt = fmt
+        self.s3 = s3
+        self.destination = destination
+        filename = f"{name}.{writer.extension}"
+        if destination:
+            self.dest_bucket, prefix = _split_s3_url(destination)
+            self.prefix = prefix if not prefix or prefix.endswith('/') else f"{prefix}/"
+            data_key = f"{self.prefix}data/{filename}" if writer.file_format else f"{self.prefix}{filename}"
+            self.sink = MultipartSink(s3, self.dest_bucket, data_key)
+        else:
+            self.sink = FileSink(filename)
+        try:
+            self.writer = writer(bucket, self.sink, fields)
+        except BaseException:
+            self.sink.abort()
+            raise
+        self.rows = 0
+
+    def write(self, row):
+        self.writer.write(row)
+        self.rows += 1
+
+    def abort(self):
+        self.sink.abort()
+
+    def close(self):
+        """Finish the data file, and its manifest.json for inventory formats in S3; returns the data location"""
+        try:
+            self.writer.close()
+            self.sink.close()
+        except BaseException:
+            self.sink.abort()
+            raise
+        logger.info(f"Inventory of {self.rows} versions of {self.bucket} saved as {self.sink.location} "
+                    f"({self.sink.size} bytes)")
+        if self.destination and self.writer.file_format:
+            self._put_manifest()
+        return self.sink.location
+
+    def _put_manifest(self):
+        manifest = {
+            'sourceBucket': self.bucket,
+            'destinationBucket': f"arn:aws:s3:::{self.dest_bucket}",
+            'version': '2016-11-30',
+            'creationTimestamp': str(int(time.time() * 1000)),
+            'fileFormat': self.writer.file_format,
+            'fileSchema': self.writer.file_schema(),
+            'files': [{'key': self.sink.key, 'size': self.sink.size, 'MD5checksum': self.sink.md5()}],
+        }
+        key = f"{self.prefix}manifest.json"
+        self.s3.put_object(Bucket=self.dest_bucket, Key=key, Body=json.dumps(manifest, indent=2).encode())
+        logger.info(f"Inventory manifest saved as s3://{self.dest_bucket}/{key}")
@@ -0,0 +1,203 @@
+"""
+Crash-safe checkpoint journal of completed copy, replay and delete work.
+
+Every finished unit of work, identified by (key, version_id, etag), is
+recorded in a local SQLite database in WAL mode under a scope naming the run
+(e.g. 'copy:src-bucket->dest-bucket'). Records are buffered and committed in
+batches, at least every COMMIT_INTERVAL seconds (a timer thread commits what a
+stalled run left buffered), so journaling costs one small transaction per
+thousand units. A committed batch survives the process being
+killed (kill -9 included); at most the last uncommitted second of work is
+redone on resume.
+
+Redoing work is not free in a versioned destination: a redone copy adds
+another version and a redone delete another delete marker. For a sync that is
+a duplicate of the latest version; for a replay it would corrupt the history.
+Work that must not be redone blindly is marked with start(), committed before
+its request is sent. On resume, in_flight() returns the units started but not
+recorded as completed, for the caller to check against the destination (see
+s3_version_replay).
+
+On resume, pending() drops units already completed in the journal before any
+request is sent, checking them against the database in batches. completed()
+reads a run's units back, e.g. for s3_verify.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from itertools import groupby, islice
+from operator import itemgetter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOURNAL_PATH = os.environ.get('S3_JOURNAL', 's3-migration-journal.sqlite')
+
+# Units committed per transaction, and the longest a recorded unit waits for its commit
+COMMIT_BATCH = 1000
+COMMIT_INTERVAL = 1.0
+
+# Units looked up per query when resuming
+LOOKUP_BATCH = 500
+
+# Status of a unit whose request may have been sent but is not recorded as completed
+STARTED = 'started'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    version_id TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    status TEXT NOT NULL,
+    completed_at REAL NOT NULL, -- when started, for units still STARTED
+    PRIMARY KEY (scope, key, version_id, etag)
+) WITHOUT ROWID;
+"""
+
+
+def unit(v):
+    """(key, version_id, etag) of a listing entry, diff entry or outcome"""
+    return v['Key'], v.get('VersionId') or '', v.get('ETag') or ''
+
+
+def _completed(row):
+    key, version_id, etag, status = row
+    return {'Key': key, 'VersionId': version_id or None, 'ETag': etag or None, 'Status': status}
+
+
+class Journal:
+    def __init__(self, scope, path=DEFAULT_JOURNAL_PATH, resume=False, commit_batch=COMMIT_BATCH,
+                 commit_interval=COMMIT_INTERVAL):
+        """
+        Open the journal of one run
+
+        Args:
+            scope: Name of the run, e.g. 'copy:src-bucket->dest-bucket'
+            path: SQLite database file
+            resume: Keep the units recorded by an earlier run of scope; otherwise they are cleared
+            commit_batch: Units per commit
+            commit_interval: Seconds after which buffered units are committed regardless
+        """
+        self.scope = scope
+        self.path = path
+        self.commit_batch = commit_batch
+        self.commit_interval = commit_interval
+        self.resumed = 0
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_commit = time.monotonic()
+        self._closed = threading.Event()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # A WAL commit at synchronous=NORMAL survives a process crash; only an OS crash can lose the last batch
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        if not resume:
+            self._conn.execute('DELETE FROM units WHERE scope = ?', (scope,))
+        self._conn.commit()
+        if resume:
+            done = self._conn.execute('SELECT COUNT(*) FROM units WHERE scope = ? AND status != ?',
+                                      (scope, STARTED)).fetchone()[0]
+            logger.info(f"Resuming {scope}: {done} units already completed")
+        self._timer = threading.Thread(target=self._commit_periodically, daemon=True)
+        self._timer.start()
+
+    def record(self, v, status):
+        """Record a completed unit; committed with the next batch"""
+        key, version_id, etag = unit(v)
+        with self._lock:
+            self._pending.append((self.scope, key, version_id, etag, status, time.time()))
+            if (len(self._pending) >= self.commit_batch
+                    or time.monotonic() - self._last_commit >= self.commit_interval):
+                self._commit()
+
+    def start(self, v):
+        """Mark a unit as started, committed before returning; record() it once it completed"""
+        key, version_id, etag = unit(v)
+        with self._lock:
+            self._pending.append((self.scope, key, version_id, etag, STARTED, time.time()))
+            self._commit()
+
+    def _commit(self):
+        if self._pending:
+            self._conn.executemany('INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?, ?)', self._pending)
+            self._conn.commit()
+            self._pending = []
+        self._last_commit = time.monotonic()
+
+    def _commit_periodically(self):
+        """Commit units left buffered for commit_interval, e.g. while the run waits on a slow copy"""
+        while not self._closed.wait(self.commit_interval):
+            with self._lock:
+                if time.monotonic() - self._last_commit >= self.commit_interval:
+                    self._commit()
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def pending(self, versions):
+        """Yield the entries of versions that are not recorded as completed"""
+        versions = iter(versions)
+        while True:
+            batch = list(islice(versions, LOOKUP_BATCH))
+            if not batch:
+                return
+            units = [unit(v) for v in batch]
+            keys = list({u[0] for u in units})
+            # Looking up by key uses the primary key index; version and ETag are matched here
+            with self._lock:
+                done = set(self._conn.execute(
+                    f"SELECT key, version_id, etag FROM units WHERE scope = ? AND status != ? "
+                    f"AND key IN ({', '.join(['?'] * len(keys))})", [self.scope, STARTED] + keys))
+            for v, u in zip(batch, units):
+                if u in done:
+                    self.resumed += 1
+                else:
+                    yield v
+
+    def in_flight(self):
+        """
+        Units started by an earlier run but not recorded as completed
+
+        Returns:
+            List of {'Key', 'VersionId', 'ETag', 'Started'}, Started as a Unix timestamp
+        """
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute('SELECT key, version_id, etag, completed_at FROM units '
+                                      'WHERE scope = ? AND status = ?', (self.scope, STARTED)).fetchall()
+        return [{'Key': key, 'VersionId': version_id or None, 'ETag': etag or None, 'Started': started}
+                for key, version_id, etag, started in rows]
+
+    def completed(self, latest=True):
+        """
+        Yield the recorded units of the scope as {'Key', 'VersionId', 'ETag', 'Status'}, in key order
+
+        Args:
+            latest: Only the unit completed last for each key, i.e. what the destination key holds now
+        """
+        self.flush()
+        # A connection of its own, so reading does not hold the lock recording needs
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            rows = conn.execute('SELECT key, version_id, etag, status FROM units WHERE scope = ? AND status != ? '
+                                'ORDER BY key, completed_at', (self.scope, STARTED))
+            if not latest:
+                yield from map(_completed, rows)
+                return
+            for _, group in groupby(rows, key=itemgetter(0)):
+                *_, last = group
+                yield _completed(last)
+        finally:
+            conn.close()
+
+    def close(self):
+        self._closed.set()
+        self._timer.join()
+        self.flush()
+        if self.resumed:
+            logger.info(f"Skipped {self.resumed} units of {self.scope} completed by an earlier run")
+        self._conn.close()
@@ -0,0 +1,262 @@
+"""
+Shared S3 version listing engine.
+
+ListObjectVersions walks a bucket one page at a time, which is far too slow for
+buckets with hundreds of millions of versions. This module splits the keyspace
+into key-range shards and lists them concurrently on a bounded thread pool:
+
+  * the prefix tree is discovered with Delimiter='/' listings, and every common
+    prefix becomes a shard boundary;
+  * flat keyspaces (few or no common prefixes) are split further by probing
+    StartAfter at sampled points and snapping to the keys that actually exist.
+
+Shard i covers the keys in (boundary[i-1], boundary[i]], listed with KeyMarker,
+so shards never overlap and concatenating them in order gives the same stream
+as a serial listing.
+"""
+import heapq
+import logging
+import os
+import queue
+import string
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from s3_fast_listing import iter_version_pages, supported as fast_listing_supported
+
+logger = logging.getLogger(__name__)
+
+# Shards planned per list worker, so a slow shard does not leave workers idle
+SHARDS_PER_WORKER = 4
+# Pages buffered per shard before its worker blocks
+SHARD_QUEUE_PAGES = 4
+# Delimiter listing limits while discovering the prefix tree
+MAX_DISCOVERY_DEPTH = 3
+MAX_DISCOVERY_PAGES = 10
+# StartAfter probing of flat keyspaces
+MAX_SAMPLE_DEPTH = 3
+SAMPLE_ALPHABET = sorted(set(string.digits + string.ascii_letters + '!-._'))
+
+_DONE = object()
+
+
+def listing_order(v):
+    """Sort key matching ListObjectVersions: key ascending, newest version first"""
+    return v['Key'], -v['LastModified'].timestamp()
+
+
+def page_versions(page):
+    """Merge a page's Versions and DeleteMarkers back into listing order"""
+    delete_markers = page.get('DeleteMarkers', [])
+    for dm in delete_markers:
+        dm['DeleteMarker'] = True
+    return heapq.merge(page.get('Versions', []), delete_markers, key=listing_order)
+
+
+def _botocore_pages(s3, bucket, prefix, start, delimiter):
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if start is not None:
+        kwargs['KeyMarker'] = start
+    if delimiter is not None:
+        kwargs['Delimiter'] = delimiter
+    paginator = s3.get_paginator('list_object_versions')
+    for page in paginator.paginate(**kwargs):
+        yield list(page_versions(page))
+
+
+def _list_range(s3, bucket, prefix='', start=None, end=None, delimiter=None, fast=False):
+    """Yield pages (lists of versions) for keys in (start, end] under prefix"""
+    if fast:
+        pages = iter_version_pages(s3, bucket, prefix, key_marker=start, delimiter=delimiter)
+    else:
+        pages = _botocore_pages(s3, bucket, prefix, start, delimiter)
+    for versions in pages:
+        if end is not None and versions and versions[-1]['Key'] > end:
+            yield [v for v in versions if v['Key'] <= end]
+            return
+        yield versions
+
+
+def _common_prefixes(s3, bucket, prefix):
+    """Return the common prefixes one level below prefix"""
+    prefixes = []
+    paginator = s3.get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/')
+    for i, page in enumerate(pages):
+        prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+        if i + 1 >= MAX_DISCOVERY_PAGES:
+            break
+    return prefixes
+
+
+def discover_prefixes(s3, bucket, prefix='', target=1):
+    """Walk the delimiter prefix tree breadth-first until there are target leaves"""
+    leaves = [prefix]
+    for _ in range(MAX_DISCOVERY_DEPTH):
+        if len(leaves) >= target:
+            break
+        expanded = []
+        for leaf in leaves:
+            children = _common_prefixes(s3, bucket, leaf)
+            # Keep the parent as a leaf too, it may hold keys next to its children
+            expanded.extend([leaf] + children if children else [leaf])
+        if len(expanded) == len(leaves):
+            break
+        leaves = expanded
+    return sorted(set(leaves))
+
+
+def sample_split_points(s3, bucket, prefix='', count=1):
+    """Probe StartAfter at spread-out points under prefix and return up to count existing keys"""
+    points = set()
+    base = prefix
+    for _ in range(MAX_SAMPLE_DEPTH):
+        for c in SAMPLE_ALPHABET:
+            resp = s3.list_objects_v2(Bucket=bucket, Prefix=prefix, StartAfter=base + c, MaxKeys=1)
+            points.update(obj['Key'] for obj in resp.get('Contents', []))
+        if len(points) >= count or not points:
+            break
+        # All probes snapped into a narrower keyspace, probe again beneath it
+        common = os.path.commonprefix(sorted(points))
+        if len(common) <= len(base):
+            break
+        base = common
+    points = sorted(points)
+    if len(points) <= count:
+        return points
+    step = len(points) / count
+    return [points[int(i * step)] for i in range(count)]
+
+
+def plan_shards(s3, bucket, prefix='', target=1):
+    """Return the sorted shard boundaries splitting prefix into about target key ranges"""
+    if target <= 1:
+        return []
+    leaves = discover_prefixes(s3, bucket, prefix, target)
+    boundaries = set(leaves)
+    if len(leaves) < target:
+        per_leaf = -(-target // len(leaves))
+        with ThreadPoolExecutor(max_workers=min(len(leaves), 8)) as pool:
+            for points in pool.map(lambda leaf: sample_split_points(s3, bucket, leaf, per_leaf), leaves):
+                boundaries.update(points)
+    boundaries.discard(prefix)
+    return sorted(boundaries)
+
+
+def _put(q, item, stop):
+    """Put item on q unless the consumer has gone away"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _drain(q):
+    """Yield the pages a producer put on q until it signals completion"""
+    while True:
+        page = q.get()
+        if page is _DONE:
+            return
+        if isinstance(page, Exception):
+            raise page
+        yield page
+
+
+def prefetch(iterable, batch_size=1000, max_batches=8):
+    """Drain iterable on a producer thread, handing items over through a bounded queue"""
+    q = queue.Queue(maxsize=max_batches)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            batch = []
+            for item in iterable:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    if not _put(q, batch, stop):
+                        return
+                    batch = []
+            if batch:
+                _put(q, batch, stop)
+            _put(q, _DONE, stop)
+        except Exception as e:
+            _put(q, e, stop)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        for batch in _drain(q):
+            yield from batch
+    finally:
+        stop.set()
+
+
+def iter_concurrently(sources, workers, ordered=True):
+    """Run sources (callables returning iterables of pages) on a bounded thread pool.
+
+    Pages are yielded source by source when ordered, or as soon as any source
+    produces them otherwise. Each source buffers at most SHARD_QUEUE_PAGES pages.
+    """
+    stop = threading.Event()
+    shared = queue.Queue(maxsize=SHARD_QUEUE_PAGES * workers)
+    queues = [queue.Queue(maxsize=SHARD_QUEUE_PAGES) for _ in sources] if ordered else [shared] * len(sources)
+
+    def produce(q, source):
+        try:
+            for page in source():
+                if not _put(q, page, stop):
+                    return
+            _put(q, _DONE, stop)
+        except Exception as e:
+            _put(q, e, stop)
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        # Submitted in order, so the source being drained is always running or done
+        for q, source in zip(queues, sources):
+            pool.submit(produce, q, source)
+        if ordered:
+            for q in queues:
+                yield from _drain(q)
+        else:
+            for _ in sources:
+                yield from _drain(shared)
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_versions(s3, bucket, prefix='', list_workers=1, ordered=True, delimiter=None, fast=False):
+    """Yield all object versions and delete markers under prefix.
+
+    With list_workers > 1 the keyspace is sharded and listed concurrently.
+    When ordered, keys come out in lexicographic order and newest version first
+    within a key, exactly like a serial listing; otherwise pages are yielded as
+    soon as any shard produces them. Delete markers carry DeleteMarker=True.
+    With a delimiter only the keys directly under prefix are listed, serially.
+    With fast, pages come from the streaming XML lister in s3_fast_listing, or
+    from botocore when that cannot sign requests for the client.
+    """
+    if fast and not fast_listing_supported(s3):
+        logger.warning("The fast lister cannot sign requests for this client, listing through botocore")
+        fast = False
+    if delimiter is not None:
+        for page in _list_range(s3, bucket, prefix, delimiter=delimiter, fast=fast):
+            yield from page
+        return
+    if list_workers <= 1:
+        ranges = [(None, None)]
+    else:
+        boundaries = plan_shards(s3, bucket, prefix, list_workers * SHARDS_PER_WORKER)
+        ranges = list(zip([None] + boundaries, boundaries + [None]))
+        logger.info(f"Listing {bucket}/{prefix} in {len(ranges)} shards with {list_workers} workers")
+    if len(ranges) == 1:
+        for page in _list_range(s3, bucket, prefix, fast=fast):
+            yield from page
+        return
+    sources = [partial(_list_range, s3, bucket, prefix, start, end, fast=fast) for start, end in ranges]
+    for page in iter_concurrently(sources, list_workers, ordered):
+        yield from page
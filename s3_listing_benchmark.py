@@ -0,0 +1,131 @@
+"""
+Benchmark the botocore and fast-path (iterparse) ListObjectVersions listers.
+
+Starts a local S3 stand-in that serves synthetic ListVersionsResult pages over
+HTTP, points a regular boto3 client at it and times both listers end to end:
+
+    python s3_listing_benchmark.py --versions 500000
+
+Only listing is served; no AWS credentials or network access are needed.
+"""
+import argparse
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import boto3
+from botocore.config import Config
+
+from s3_fast_listing import iter_version_tuples
+from s3_listing import iter_versions
+
+PAGE_SIZE = 1000
+VERSIONS_PER_KEY = 3
+
+_OWNER = ('<Owner><ID>75aa57f09aa0c8caeab4f8c24e99d10f8e7faeebf76c078efc7c6caea54ba06a</ID>'
+          '<DisplayName>migration</DisplayName></Owner>')
+
+
+def _entry(key, version, is_latest, delete_marker):
+    common = (f'<Key>{key}</Key><VersionId>v{version:030d}</VersionId>'
+              f'<IsLatest>{"true" if is_latest else "false"}</IsLatest>'
+              f'<LastModified>2024-01-01T00:00:{59 - version:02d}.000Z</LastModified>')
+    if delete_marker:
+        return f'<DeleteMarker>{common}{_OWNER}</DeleteMarker>'
+    return (f'<Version>{common}<ETag>"9b2cf535f27731c974343645a3985328"</ETag><Size>{1024 * (version + 1)}</Size>'
+            f'{_OWNER}<StorageClass>STANDARD</StorageClass></Version>')
+
+
+class _Listing:
+    """Synthetic versioned bucket, rendered once so the server is not the bottleneck"""
+
+    def __init__(self, num_versions):
+        self.entries = []
+        for i in range(num_versions // VERSIONS_PER_KEY):
+            key = f'data/year=2024/month={i % 12 + 1:02d}/part-{i:09d}.parquet'
+            for version in range(VERSIONS_PER_KEY):
+                # Every tenth key is currently deleted
+                delete_marker = version == 0 and i % 10 == 0
+                self.entries.append((key, f'v{version:030d}', _entry(key, version, version == 0, delete_marker)))
+        # Stable sort keeps each key's versions newest first
+        self.entries.sort(key=lambda e: e[0])
+        self.positions = {(key, vid): i for i, (key, vid, _) in enumerate(self.entries)}
+        self.sorted_keys = [e[0] for e in self.entries]
+
+    def page(self, key_marker, version_id_marker, max_keys):
+        if key_marker and version_id_marker:
+            start = self.positions[(key_marker, version_id_marker)] + 1
+        elif key_marker:
+            start = bisect.bisect_right(self.sorted_keys, key_marker)
+        else:
+            start = 0
+        chunk = self.entries[start:start + max_keys]
+        truncated = start + max_keys < len(self.entries)
+        parts = ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<ListVersionsResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">',
+                 f'<Name>bench</Name><Prefix></Prefix><MaxKeys>{max_keys}</MaxKeys>',
+                 f'<IsTruncated>{"true" if truncated else "false"}</IsTruncated>']
+        if truncated:
+            parts.append(f'<NextKeyMarker>{chunk[-1][0]}</NextKeyMarker>'
+                         f'<NextVersionIdMarker>{chunk[-1][1]}</NextVersionIdMarker>')
+        parts.extend(e[2] for e in chunk)
+        parts.append('<EncodingType>url</EncodingType></ListVersionsResult>')
+        return ''.join(parts).encode('utf-8')
+
+
+def _serve(listing):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            query = parse_qs(urlsplit(self.path).query, keep_blank_values=True)
+            body = listing.page(query.get('key-marker', [''])[0], query.get('version-id-marker', [''])[0],
+                                int(query.get('max-keys', [PAGE_SIZE])[0]))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _time(label, versions, expected):
+    start = time.perf_counter()
+    count = sum(1 for _ in versions)
+    elapsed = time.perf_counter() - start
+    if count != expected:
+        raise RuntimeError(f"{label}: listed {count} versions, expected {expected}")
+    print(f"{label:<28} {count:>10} versions {elapsed:8.2f}s {count / elapsed:>12,.0f} versions/s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark botocore vs fast-path version listing")
+    parser.add_argument('--versions', type=int, default=300000, help="Synthetic versions to list (default: 300000)")
+    args = parser.parse_args()
+
+    listing = _Listing(args.versions)
+    server = _serve(listing)
+    s3 = boto3.client('s3', endpoint_url=f'http://127.0.0.1:{server.server_address[1]}', region_name='us-east-1',
+                      aws_access_key_id='bench', aws_secret_access_key='bench',
+                      config=Config(s3={'addressing_style': 'path'}))
+    expected = len(listing.entries)
+
+    botocore_time = _time("botocore paginator", iter_versions(s3, 'bench'), expected)
+    fast_time = _time("fast path, dicts", iter_versions(s3, 'bench', fast=True), expected)
+    tuple_time = _time("fast path, (Key, VersionId)",
+                       iter_version_tuples(s3, 'bench', fields=('Key', 'VersionId')), expected)
+    print(f"Speed-up: {botocore_time / fast_time:.1f}x with dicts, {botocore_time / tuple_time:.1f}x with tuples")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
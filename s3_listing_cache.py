@@ -0,0 +1,302 @@
+"""
+Persistent local S3 listing cache.
+
+Keeps a snapshot of every object version of a bucket in SQLite, so repeated
+diff, large-object and inventory runs read the listing locally instead of
+paying for a full ListObjectVersions pass each time.
+
+A refresh works per top-level prefix of the cached bucket/prefix. The level
+itself is listed with Delimiter='/', which returns its common prefixes
+together with the versions stored directly at that level; those direct
+versions are always relisted. Which common prefixes are listed again with
+ListObjectVersions depends on the change signal given:
+
+  * changed keys, e.g. from S3 event notifications, CloudTrail data events or
+    the delta of two inventory reports: only the prefixes holding them, at no
+    extra request cost. Event notifications also cover noncurrent versions
+    deleted or transitioned by lifecycle rules;
+  * fingerprint: every common prefix is fingerprinted with a ListObjectsV2
+    pass over its current objects (count, total bytes, newest LastModified)
+    and only the prefixes whose fingerprint moved are relisted. The pass
+    reads every current object, one request per 1000, so it costs about as
+    much as listing the current objects afresh and only pays off when
+    noncurrent versions far outnumber them. Changes that leave the current
+    objects untouched do not move the fingerprint;
+  * none: every common prefix is relisted.
+
+Prefixes the cache has never listed are relisted whatever the signal.
+"""
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from s3_listing import iter_versions, page_versions
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.environ.get('S3_LISTING_CACHE', 's3-listing-cache.sqlite')
+# Rows written per transaction while relisting
+INSERT_BATCH = 10000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    version_id TEXT NOT NULL,
+    is_latest INTEGER NOT NULL,
+    delete_marker INTEGER NOT NULL,
+    size INTEGER,
+    etag TEXT,
+    storage_class TEXT,
+    owner TEXT,
+    last_modified REAL NOT NULL,
+    PRIMARY KEY (bucket, key, version_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS prefixes (
+    bucket TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    object_count INTEGER NOT NULL,
+    total_size INTEGER NOT NULL,
+    last_modified REAL,
+    refreshed_at REAL NOT NULL,
+    PRIMARY KEY (bucket, prefix)
+) WITHOUT ROWID;
+"""
+
+_INSERT = "INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+
+def _prefix_end(prefix):
+    """Smallest string greater than every key starting with prefix"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _range_clause(prefix, column='key'):
+    """SQL condition and params selecting the values of column under prefix"""
+    if not prefix:
+        return "1", ()
+    return f"{column} >= ? AND {column} < ?", (prefix, _prefix_end(prefix))
+
+
+def _row(bucket, v):
+    delete_marker = v.get('DeleteMarker', False)
+    return (bucket, v['Key'], v['VersionId'], int(v.get('IsLatest', False)), int(delete_marker),
+            None if delete_marker else v.get('Size', 0), v.get('ETag'), v.get('StorageClass'),
+            v.get('Owner', {}).get('DisplayName'), v['LastModified'].timestamp())
+
+
+def _version(row):
+    key, version_id, is_latest, delete_marker, size, etag, storage_class, owner, last_modified = row
+    v = {
+        'Key': key,
+        'VersionId': version_id,
+        'IsLatest': bool(is_latest),
+        'LastModified': datetime.fromtimestamp(last_modified, timezone.utc),
+    }
+    if owner is not None:
+        v['Owner'] = {'DisplayName': owner}
+    if delete_marker:
+        v['DeleteMarker'] = True
+    else:
+        v.update({'Size': size, 'ETag': etag, 'StorageClass': storage_class})
+    return v
+
+
+def _level_prefix(key, prefix):
+    """Common prefix one level below prefix holding key, None for keys outside or directly at prefix"""
+    if not key.startswith(prefix):
+        return None
+    slash = key.find('/', len(prefix))
+    return key[:slash + 1] if slash >= 0 else None
+
+
+def read_changed_keys(path):
+    """
+    Read the keys changed since the last refresh from a file of bucket/key lines
+
+    Returns:
+        {bucket: [keys]}
+    """
+    changed = {}
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if '/' in line:
+                bucket, key = line.split('/', 1)
+                changed.setdefault(bucket, []).append(key)
+    return changed
+
+
+class _Fingerprint:
+    """Running (count, bytes, newest LastModified) of the current objects of a prefix"""
+
+    def __init__(self):
+        self.count = 0
+        self.size = 0
+        self.last_modified = None
+
+    def add(self, size, last_modified):
+        self.count += 1
+        self.size += size
+        ts = last_modified.timestamp()
+        if self.last_modified is None or ts > self.last_modified:
+            self.last_modified = ts
+
+    def value(self):
+        return self.count, self.size, self.last_modified
+
+
+def fingerprint_prefix(s3, bucket, prefix):
+    """Fingerprint the current objects under prefix with ListObjectsV2, one request per 1000 objects"""
+    fp = _Fingerprint()
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            fp.add(obj['Size'], obj['LastModified'])
+    return fp.value()
+
+
+class ListingCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        """
+        Open (or create) a listing cache
+
+        Args:
+            path: SQLite database file
+        """
+        self.path = path
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connection(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _store(self, conn, bucket, versions, fp=None):
+        """Insert versions in batches, feeding current objects into fp"""
+        batch = []
+        for v in versions:
+            if fp is not None and v.get('IsLatest') and not v.get('DeleteMarker'):
+                fp.add(v.get('Size', 0), v['LastModified'])
+            batch.append(_row(bucket, v))
+            if len(batch) >= INSERT_BATCH:
+                conn.executemany(_INSERT, batch)
+                conn.commit()
+                batch = []
+        if batch:
+            conn.executemany(_INSERT, batch)
+
+    def _relist_level(self, s3, bucket, prefix):
+        """Relist the versions stored directly at prefix, returning its common prefixes"""
+        clause, params = _range_clause(prefix)
+        prefixes = []
+        with self._connection() as conn:
+            conn.execute(f"DELETE FROM versions WHERE bucket = ? AND {clause} "
+                         f"AND instr(substr(key, ?), '/') = 0", (bucket, *params, len(prefix) + 1))
+            paginator = s3.get_paginator('list_object_versions')
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+                prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+                self._store(conn, bucket, page_versions(page))
+        return prefixes
+
+    def _relist_prefix(self, s3, bucket, prefix, list_workers=1):
+        """Replace every cached version under prefix and record its fingerprint"""
+        clause, params = _range_clause(prefix)
+        fp = _Fingerprint()
+        with self._connection() as conn:
+            # The fingerprint goes first, so an interrupted relist is redone next time
+            conn.execute("DELETE FROM prefixes WHERE bucket = ? AND prefix = ?", (bucket, prefix))
+            conn.execute(f"DELETE FROM versions WHERE bucket = ? AND {clause}", (bucket, *params))
+            conn.commit()
+            self._store(conn, bucket, iter_versions(s3, bucket, prefix, list_workers=list_workers), fp)
+            conn.execute("INSERT OR REPLACE INTO prefixes VALUES (?, ?, ?, ?, ?, ?)",
+                         (bucket, prefix, *fp.value(), time.time()))
+
+    def _drop_prefix(self, bucket, prefix):
+        clause, params = _range_clause(prefix)
+        with self._connection() as conn:
+            conn.execute("DELETE FROM prefixes WHERE bucket = ? AND prefix = ?", (bucket, prefix))
+            conn.execute(f"DELETE FROM versions WHERE bucket = ? AND {clause}", (bucket, *params))
+
+    def _stored_fingerprints(self, bucket, prefix):
+        """Fingerprints of the prefixes one level below prefix"""
+        clause, params = _range_clause(prefix, column='prefix')
+        with self._connection() as conn:
+            rows = conn.execute(f"SELECT prefix, object_count, total_size, last_modified FROM prefixes "
+                                f"WHERE bucket = ? AND {clause}", (bucket, *params))
+            return {p: (count, size, lm) for p, count, size, lm in rows
+                    if p != prefix and p[len(prefix):].count('/') == 1}
+
+    def refresh(self, s3, bucket, prefix='', list_workers=1, full=False, changed=None, fingerprint=False):
+        """
+        Bring the cached listing of bucket/prefix up to date
+
+        Without changed or fingerprint there is no signal of what changed, so every prefix is relisted.
+
+        Args:
+            s3: boto3 S3 client
+            bucket: Bucket name
+            prefix: Key prefix to cache, '' for the whole bucket
+            list_workers: Concurrent prefixes fingerprinted and relisted
+            full: Relist every prefix regardless of changed and fingerprint
+            changed: Keys written or deleted since the last refresh; only the prefixes holding them are relisted
+            fingerprint: Without changed, relist only the prefixes whose current objects changed. Finding them
+                lists every current object under bucket/prefix with ListObjectsV2, about the cost of a fresh
+                listing of the current objects
+
+        Returns:
+            List of prefixes that were relisted
+        """
+        start = time.time()
+        prefixes = self._relist_level(s3, bucket, prefix)
+        stored = self._stored_fingerprints(bucket, prefix)
+        for gone in set(stored) - set(prefixes):
+            self._drop_prefix(bucket, gone)
+
+        if full or (changed is None and not fingerprint):
+            relist = prefixes
+        elif changed is not None:
+            touched = {_level_prefix(key, prefix) for key in changed}
+            relist = [p for p in prefixes if p in touched or p not in stored]
+        else:
+            with ThreadPoolExecutor(max_workers=max(1, list_workers)) as pool:
+                fingerprints = pool.map(lambda p: fingerprint_prefix(s3, bucket, p), prefixes)
+                relist = [p for p, fp in zip(prefixes, fingerprints) if stored.get(p) != fp]
+
+        if relist:
+            # Spread the list workers over the relisted prefixes, sharding the big ones
+            shard_workers = max(1, list_workers // len(relist))
+            with ThreadPoolExecutor(max_workers=max(1, list_workers)) as pool:
+                list(pool.map(lambda p: self._relist_prefix(s3, bucket, p, shard_workers), relist))
+        logger.info(f"Refreshed listing cache for {bucket}/{prefix}: relisted {len(relist)} of "
+                    f"{len(prefixes)} prefixes in {time.time() - start:.1f}s")
+        return relist
+
+    def prefixes(self, bucket, prefix=''):
+        """Prefixes one level below prefix, as of the last refresh"""
+        return sorted(self._stored_fingerprints(bucket, prefix))
+
+    def iter_versions(self, bucket, prefix='', delimiter=None):
+        """Yield cached versions under prefix in listing order, shaped like ListObjectVersions entries.
+
+        With a delimiter only the keys directly under prefix are yielded.
+        """
+        clause, params = _range_clause(prefix)
+        with self._connection() as conn:
+            rows = conn.execute(f"SELECT key, version_id, is_latest, delete_marker, size, etag, storage_class, "
+                                f"owner, last_modified FROM versions WHERE bucket = ? AND {clause} "
+                                f"ORDER BY key, last_modified DESC", (bucket, *params))
+            for row in rows:
+                if delimiter is None or delimiter not in row[0][len(prefix):]:
+                    yield _version(row)
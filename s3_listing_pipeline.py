@@ -0,0 +1,117 @@
+"""
+Single-pass, multi-consumer listing pipeline.
+
+Every stage of a migration run used to list the destination bucket again.
+Here one listing is fanned out to several consumers instead. A consumer is a
+generator that receives listing entries through send() and returns its
+result when it is sent END:
+
+    def count_versions():
+        n = 0
+        while (yield) is not END:
+            n += 1
+        return n
+
+run() feeds a listing to a set of consumers and returns their results, and
+tap() passes a listing through unchanged while feeding consumers on the side,
+so the same pass can also drive a diff.
+"""
+import heapq
+from bisect import bisect_right
+
+END = object()
+
+# Upper bounds (exclusive) of the size histogram bins
+SIZE_BINS = [
+    (128 * 1024, '<128KiB'),
+    (1024 ** 2, '128KiB-1MiB'),
+    (16 * 1024 ** 2, '1MiB-16MiB'),
+    (128 * 1024 ** 2, '16MiB-128MiB'),
+    (1024 ** 3, '128MiB-1GiB'),
+    (5 * 1024 ** 3, '1GiB-5GiB'),
+    (float('inf'), '>=5GiB'),
+]
+
+
+def start(consumers):
+    """Prime consumer generators so they are ready for send()"""
+    for consumer in consumers.values():
+        next(consumer)
+    return consumers
+
+
+def finish(consumers):
+    """Send END to every consumer and return {name: result}"""
+    results = {}
+    for name, consumer in consumers.items():
+        try:
+            consumer.send(END)
+        except StopIteration as e:
+            results[name] = e.value
+        else:
+            raise RuntimeError(f"Consumer {name} did not stop at END")
+    return results
+
+
+def tap(versions, consumers, lock=None):
+    """Yield versions unchanged while also sending each one to the (started) consumers
+
+    Several listings drained on their own threads can tap the same consumers when
+    they share a lock.
+    """
+    for v in versions:
+        if lock is None:
+            for consumer in consumers.values():
+                consumer.send(v)
+        else:
+            with lock:
+                for consumer in consumers.values():
+                    consumer.send(v)
+        yield v
+
+
+def run(versions, consumers):
+    """Feed one pass over versions to every consumer and return {name: result}"""
+    start(consumers)
+    for _ in tap(versions, consumers):
+        pass
+    return finish(consumers)
+
+
+def large_objects(min_size_bytes, top_k=None):
+    """Consumer: current objects of at least min_size_bytes, only the top_k largest if given"""
+    found = []
+    while True:
+        v = yield
+        if v is END:
+            break
+        if not v.get('IsLatest') or v.get('DeleteMarker') or v.get('Size', 0) < min_size_bytes:
+            continue
+        entry = (v['Size'], v['Key'])
+        if top_k is None:
+            found.append(entry)
+        elif len(found) < top_k:
+            heapq.heappush(found, entry)
+        elif entry > found[0]:
+            heapq.heapreplace(found, entry)
+    if top_k is not None:
+        found.sort(reverse=True)
+    return [{'Key': key, 'Size': size} for size, key in found]
+
+
+def size_histogram():
+    """Consumer: count and bytes of object versions per size bin"""
+    bounds = [bound for bound, _ in SIZE_BINS]
+    counts = [0] * len(SIZE_BINS)
+    sizes = [0] * len(SIZE_BINS)
+    while True:
+        v = yield
+        if v is END:
+            break
+        if v.get('DeleteMarker'):
+            continue
+        size = v.get('Size', 0)
+        i = bisect_right(bounds, size)
+        counts[i] += 1
+        sizes[i] += size
+    return {label: {'Count': counts[i], 'Bytes': sizes[i]} for i, (_, label) in enumerate(SIZE_BINS)}
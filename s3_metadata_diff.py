@@ -0,0 +1,205 @@
+"""
+Field-level diff of two buckets from their listings alone.
+
+diff_buckets matches versions by version ID, and compare_buckets reports only
+the missing ones, so a truncated or corrupted copy, at the same key but with a
+different size or ETag, passes. The listing already carries Size, ETag,
+StorageClass and LastModified for every version, so comparing them costs no
+request beyond the listings themselves. metadata_diff merge-joins the current
+versions of both buckets key by key and puts every key in one category, the
+first that applies:
+
+    missing              the key has no current object in the destination
+    extra                the key has no current object in the source
+    size-mismatch        sizes differ: truncated or wrong object
+    etag-mismatch        single-part ETags differ at the same size
+    etag-layout          multipart ETags differ at the same size; the part layout
+                         may be all that differs, s3_verify decides from checksums
+    storage-class-drift  the destination is not in the expected storage class
+    match
+
+ETags of SSE-KMS and SSE-C objects are not MD5s of the data and differ between
+equal copies, so buckets encrypted that way need s3_verify for the ETag
+categories too.
+
+The report counts keys and bytes per category with a few sample keys, and the
+repair manifest has one JSON line per source object to copy again (missing,
+size-mismatch, etag-mismatch, storage-class-drift), in the diff entry shape
+CopyEngine.run takes plus the category and the destination fields. The
+StorageClass of a repair is the class the destination should be in, which
+CopyEngine gives the copy:
+
+    python s3_metadata_diff.py --src source-bucket --dest destination-bucket --manifest repairs.jsonl
+"""
+import argparse
+import json
+import logging
+
+import boto3
+
+from s3_listing import iter_versions, prefetch
+
+logger = logging.getLogger(__name__)
+
+CATEGORIES = ('missing', 'extra', 'size-mismatch', 'etag-mismatch', 'etag-layout', 'storage-class-drift', 'match')
+
+# Categories fixed by copying the source object again
+REPAIRABLE = ('missing', 'size-mismatch', 'etag-mismatch', 'storage-class-drift')
+
+# Keys kept per category in the report
+SAMPLE_SIZE = 10
+
+# Listings report no storage class for objects uploaded without one
+DEFAULT_STORAGE_CLASS = 'STANDARD'
+
+
+def _current(versions):
+    """Current objects of a key-ordered listing, delete markers and noncurrent versions dropped"""
+    return (v for v in versions if v.get('IsLatest', True) and not v.get('DeleteMarker'))
+
+
+def _etag(v):
+    return (v.get('ETag') or '').strip('"')
+
+
+def _storage_class(v):
+    return v.get('StorageClass') or DEFAULT_STORAGE_CLASS
+
+
+def classify(src, dest, storage_class=None):
+    """
+    Category of a key from its current source and destination objects
+
+    Args:
+        src, dest: Listing entries, None where the bucket has no current object at the key
+        storage_class: Storage class the destination should be in, by default the source's
+    """
+    if dest is None:
+        return 'missing'
+    if src is None:
+        return 'extra'
+    if src.get('Size') != dest.get('Size'):
+        return 'size-mismatch'
+    src_etag, dest_etag = _etag(src), _etag(dest)
+    if src_etag != dest_etag:
+        # Multipart ETags hash the part MD5s, so equal data copied in other parts has another ETag
+        return 'etag-layout' if '-' in src_etag or '-' in dest_etag else 'etag-mismatch'
+    if _storage_class(dest) != (storage_class or _storage_class(src)):
+        return 'storage-class-drift'
+    return 'match'
+
+
+def _entry(category, src, dest, storage_class=None):
+    v = src or dest
+    entry = {'Category': category, 'Key': v['Key'], 'VersionId': v.get('VersionId'), 'IsLatest': True,
+             'DeleteMarker': False, 'Size': v.get('Size'), 'ETag': v.get('ETag'),
+             'StorageClass': (storage_class if src is not None else None) or _storage_class(v),
+             'LastModified': v.get('LastModified')}
+    if src is not None and dest is not None:
+        entry.update({'DestVersionId': dest.get('VersionId'), 'DestSize': dest.get('Size'),
+                      'DestETag': dest.get('ETag'), 'DestStorageClass': _storage_class(dest),
+                      'DestLastModified': dest.get('LastModified')})
+    return entry
+
+
+def metadata_diff(src_versions, dest_versions, storage_class=None, matches=False):
+    """
+    Merge-join the current objects of two key-ordered listings, yielding an entry per differing key
+
+    Each listing is drained on its own producer thread, as in diff_versions.
+
+    Args:
+        storage_class: Storage class the destination should be in, by default the source's
+        matches: Also yield the keys that match
+    """
+    src = _current(prefetch(src_versions))
+    dest = _current(prefetch(dest_versions))
+    s = next(src, None)
+    d = next(dest, None)
+    while s is not None or d is not None:
+        if d is None or (s is not None and s['Key'] < d['Key']):
+            pair, s = (s, None), next(src, None)
+        elif s is None or d['Key'] < s['Key']:
+            pair, d = (None, d), next(dest, None)
+        else:
+            pair, s, d = (s, d), next(src, None), next(dest, None)
+        category = classify(*pair, storage_class)
+        if category != 'match' or matches:
+            yield _entry(category, *pair, storage_class)
+
+
+class DiffReport:
+    """Keys, bytes and sample keys per category of a metadata diff"""
+
+    def __init__(self, sample_size=SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self.categories = {}
+
+    def add(self, entry):
+        category = self.categories.setdefault(entry['Category'], {'Keys': 0, 'Bytes': 0, 'Sample': []})
+        category['Keys'] += 1
+        category['Bytes'] += entry.get('Size') or 0
+        if len(category['Sample']) < self.sample_size:
+            category['Sample'].append(entry['Key'])
+
+    def summary(self):
+        return {
+            'Differences': sum(c['Keys'] for name, c in self.categories.items() if name != 'match'),
+            'Repairs': sum(c['Keys'] for name, c in self.categories.items() if name in REPAIRABLE),
+            'Categories': {name: self.categories[name] for name in CATEGORIES if name in self.categories},
+        }
+
+
+def write_report(entries, manifest=None, report=None):
+    """
+    Count entries into a DiffReport, writing the repairable ones to a JSON lines manifest
+
+    Returns:
+        The report summary
+    """
+    report = report or DiffReport()
+    f = open(manifest, 'w') if manifest else None
+    try:
+        for entry in entries:
+            report.add(entry)
+            if f is not None and entry['Category'] in REPAIRABLE:
+                f.write(json.dumps(entry, default=str) + '\n')
+    finally:
+        if f is not None:
+            f.close()
+    summary = report.summary()
+    logger.info(f"Metadata diff: {summary['Differences']} differing keys, {summary['Repairs']} to repair"
+                + (f", repair manifest {manifest}" if manifest else ''))
+    return summary
+
+
+def read_manifest(path):
+    """Yield the entries of a repair manifest, ready for CopyEngine.run"""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Diff the current objects of two buckets on size, ETag and "
+                                                 "storage class from their listings, without extra requests")
+    parser.add_argument('--src', required=True, help="Source bucket")
+    parser.add_argument('--dest', required=True, help="Destination bucket")
+    parser.add_argument('--prefix', default='', help="Only compare keys under this prefix")
+    parser.add_argument('--storage-class', help="Storage class the destination should be in (default: the source's)")
+    parser.add_argument('--list-workers', type=int, default=4,
+                        help="Concurrent shards used when listing each bucket (default: 4)")
+    parser.add_argument('--manifest', metavar='PATH', help="Write the objects to copy again to this JSON lines file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    s3 = boto3.client('s3')
+    entries = metadata_diff(iter_versions(s3, args.src, args.prefix, list_workers=args.list_workers),
+                            iter_versions(s3, args.dest, args.prefix, list_workers=args.list_workers),
+                            args.storage_class)
+    print(json.dumps(write_report(entries, args.manifest), indent=2))
+
+
+if __name__ == '__main__':
+    main()
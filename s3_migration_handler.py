@@ -1,43 +1,315 @@
+import argparse
 import boto3
-import csv
 import os
 import time
+import threading
 import logging
 from datetime import datetime
+from itertools import chain, groupby
+from operator import itemgetter
 
-s3 = boto3.client('s3')
+from s3_autotune import ConcurrencyTuner
+from s3_copy_engine import DEFAULT_WORKERS, CopyEngine, client
+from s3_digest_tree import DEFAULT_MAX_DEPTH, DigestStore, DigestTree
+from s3_encryption import DEFAULT_WORKERS as HEAD_WORKERS
+from s3_encryption import EncryptionCache, EncryptionEnricher
+from s3_inventory import iter_inventory, load_manifest
+from s3_inventory_output import INVENTORY_FORMATS, InventoryOutput
+from s3_journal import DEFAULT_JOURNAL_PATH, Journal
+from s3_metadata_diff import classify, metadata_diff, write_report
+from s3_listing import iter_versions, prefetch
+from s3_listing_cache import ListingCache, read_changed_keys
+from s3_partition_diff import diff_unsorted
+from s3_rate_limiter import PrefixGovernor, governed_client
+from s3_sample_verify import DEFAULT_SAMPLES, SampleVerifier
+from s3_verify import DEFAULT_WORKERS as VERIFY_WORKERS
+from s3_verify import Verifier
+from s3_work_order import DEFAULT_DEPTH, WORK_ORDERS, hashed, interleave, interleaved_listings
+from s3_listing_pipeline import END, finish, large_objects, run, size_histogram, start, tap
+
+# Rate-limit HEAD, copy and delete requests per key prefix, backing off only the prefixes that answer SlowDown
+PREFIX_RATE_LIMIT = os.environ.get('PREFIX_RATE_LIMIT', 'true').lower() == 'true'
+governor = PrefixGovernor() if PREFIX_RATE_LIMIT else None
+
+s3 = governed_client(governor)
 iam = boto3.client('iam')
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
-def get_all_versions(bucket):
-    """Get all objects with version IDs and delete markers"""
-    versions = []
-    paginator = s3.get_paginator('list_object_versions')
-    for page in paginator.paginate(Bucket=bucket):
-        for obj in page.get('Versions', []):
-            versions.append(obj)
-        for dm in page.get('DeleteMarkers', []):
-            versions.append(dm)
-    return versions
+# List through the streaming XML parser in s3_fast_listing instead of botocore
+FAST_LISTING = os.environ.get('FAST_LISTING', 'false').lower() == 'true'
+
+# Concurrent server-side copies when syncing
+COPY_WORKERS = int(os.environ.get('COPY_WORKERS', DEFAULT_WORKERS))
+
+# Part copies shared by all multipart copies; large objects start first and their parts interleave with small copies
+PART_WORKERS = int(os.environ.get('PART_WORKERS', DEFAULT_WORKERS))
+
+# Reproduce the source part layout in multipart copies, so destination ETags equal the source's and
+# --verify and --metadata-diff can prove copies from metadata (see s3_copy_engine)
+PRESERVE_PARTS = os.environ.get('PRESERVE_PARTS', 'false').lower() == 'true'
+
+# Order in which diff entries are synced: 'listing', 'interleave' (round-robin across prefix scopes
+# ORDER_DEPTH levels deep) or 'hash', to spread requests across S3 partitions (see s3_work_order)
+WORK_ORDER = os.environ.get('WORK_ORDER', 'listing')
+ORDER_DEPTH = int(os.environ.get('ORDER_DEPTH', DEFAULT_DEPTH))
+
+# Tune the concurrent copies while syncing, starting from the settings saved for the bucket pair
+AUTOTUNE = os.environ.get('AUTOTUNE', 'false').lower() == 'true'
+
+# Concurrent HEADs reading the encryption of versions for the CSV inventory, and the
+# EncryptionCache keeping their results for the next run (set up from --cache when run as a script)
+INVENTORY_HEAD_WORKERS = int(os.environ.get('INVENTORY_HEAD_WORKERS', HEAD_WORKERS))
+encryption_cache = None
+
+# Report the bucket's default encryption for every object instead of HEADing it; objects
+# uploaded with their own encryption headers are then misreported
+ASSUME_DEFAULT_ENCRYPTION = os.environ.get('ASSUME_DEFAULT_ENCRYPTION', 'false').lower() == 'true'
+
+# Format of the generated inventory ('csv', 'csv.gz' or 'parquet'), and an s3://bucket/prefix/ to
+# stream it to instead of a local file (see s3_inventory_output)
+INVENTORY_FORMAT = os.environ.get('INVENTORY_FORMAT', 'csv')
+INVENTORY_DESTINATION = os.environ.get('INVENTORY_DESTINATION') or None
+
+# What tells a listing cache refresh which prefixes changed (see s3_listing_cache): {bucket: [keys]}
+# changed since the last run, read from --changed-keys; else, when CACHE_FINGERPRINT, a ListObjectsV2
+# pass over every current object, about the cost of listing them afresh; else every prefix is relisted
+CHANGED_KEYS = None
+CACHE_FINGERPRINT = os.environ.get('CACHE_FINGERPRINT', 'false').lower() == 'true'
+
+def refresh_cache(cache, bucket, list_workers=1, full=False, changed=None):
+    """Bring the cached listing of bucket up to date from changed, or the configured change signal"""
+    if changed is None and CHANGED_KEYS is not None:
+        changed = CHANGED_KEYS.get(bucket, [])
+    return cache.refresh(s3, bucket, list_workers=list_workers, full=full, changed=changed,
+                         fingerprint=CACHE_FINGERPRINT)
+
+def get_all_versions(bucket, list_workers=1, ordered=True, cache=None, prefix='', delimiter=None):
+    """Yield all object versions and delete markers, in listing order if ordered"""
+    if cache is not None:
+        return cache.iter_versions(bucket, prefix, delimiter)
+    return iter_versions(s3, bucket, prefix, list_workers=list_workers, ordered=ordered, delimiter=delimiter,
+                         fast=FAST_LISTING)
+
+def _group_by_key(versions):
+    """Yield (key, {version_id: version}) for each key of a listing"""
+    for key, group in groupby(versions, key=itemgetter('Key')):
+        yield key, {v['VersionId']: v for v in group}
+
+def _diff_entry(status, v, dest=None):
+    """Diff entry of a version; dest is the destination's current object at the key, for the sync's check"""
+    entry = {'Status': status, 'Key': v['Key'], 'VersionId': v['VersionId'], 'IsLatest': v['IsLatest'],
+             'DeleteMarker': v.get('DeleteMarker', False), 'Size': v.get('Size'), 'ETag': v.get('ETag'),
+             'LastModified': v.get('LastModified')}
+    if dest is not None and not dest.get('DeleteMarker'):
+        entry.update({'DestVersionId': dest['VersionId'], 'DestSize': dest.get('Size'),
+                      'DestETag': dest.get('ETag'), 'DestLastModified': dest.get('LastModified')})
+    return entry
+
+def _versions_match(src, dest):
+    return (src.get('DeleteMarker', False) == dest.get('DeleteMarker', False)
+            and src.get('ETag') == dest.get('ETag')
+            and src.get('Size') == dest.get('Size'))
+
+def diff_buckets(src_bucket, dest_bucket, list_workers=1, cache=None, prefix='', delimiter=None):
+    """Stream missing, extra and mismatched versions between src and dest.
 
-def compare_buckets(src_bucket, dest_bucket):
+    Both listings are fetched concurrently and merge-joined key by key, so
+    memory stays bounded by a few pages plus the versions of a single key.
+    """
+    src_versions = get_all_versions(src_bucket, list_workers, cache=cache, prefix=prefix, delimiter=delimiter)
+    dest_versions = get_all_versions(dest_bucket, list_workers, cache=cache, prefix=prefix, delimiter=delimiter)
+    return diff_versions(src_versions, dest_versions)
+
+def diff_versions(src_versions, dest_versions):
+    """Merge-join two key-ordered listings, each drained on its own producer thread"""
+    src = _group_by_key(prefetch(src_versions))
+    dest = _group_by_key(prefetch(dest_versions))
+    s = next(src, None)
+    d = next(dest, None)
+    while s is not None or d is not None:
+        if d is None or (s is not None and s[0] < d[0]):
+            for v in s[1].values():
+                yield _diff_entry('missing', v)
+            s = next(src, None)
+        elif s is None or d[0] < s[0]:
+            for v in d[1].values():
+                yield _diff_entry('extra', v)
+            d = next(dest, None)
+        else:
+            src_versions, dest_versions = s[1], d[1]
+            dest_latest = next((v for v in dest_versions.values() if v.get('IsLatest')), None)
+            for version_id, v in src_versions.items():
+                dv = dest_versions.get(version_id)
+                if dv is None:
+                    yield _diff_entry('missing', v, dest_latest)
+                elif not _versions_match(v, dv):
+                    yield _diff_entry('mismatched', v, dest_latest)
+            for version_id, v in dest_versions.items():
+                if version_id not in src_versions:
+                    yield _diff_entry('extra', v)
+            s = next(src, None)
+            d = next(dest, None)
+
+def diff_interleaved(src_bucket, dest_bucket, cache=None, consumers=None, depth=DEFAULT_DEPTH):
+    """Diff both buckets per prefix scope, interleaving the scopes' entries to spread the sync across partitions
+
+    Destination versions are also fed to consumers (started listing pipeline consumers), as by tap().
+    """
+    lock = threading.Lock()
+
+    def scope_diff(prefix, delimiter):
+        dest_versions = get_all_versions(dest_bucket, cache=cache, prefix=prefix, delimiter=delimiter)
+        if consumers:
+            dest_versions = tap(dest_versions, consumers, lock)
+        return diff_versions(get_all_versions(src_bucket, cache=cache, prefix=prefix, delimiter=delimiter),
+                             dest_versions)
+
+    return interleave(interleaved_listings(s3, [src_bucket, dest_bucket], '', scope_diff, depth))
+
+def _missing_entry(e):
+    return {'Key': e['Key'], 'VersionId': e['VersionId'], 'IsLatest': e['IsLatest']}
+
+def _collect_missing(entries):
+    return [_missing_entry(e) for e in entries if e['Status'] == 'missing']
+
+def _record_missing(entries, missing, keys=None):
+    """Pass diff entries through, appending the missing ones to missing as compare_buckets reports them
+    and, when given, the keys of all of them to keys"""
+    for e in entries:
+        if keys is not None:
+            keys.add(e['Key'])
+        if e['Status'] == 'missing':
+            missing.append(_missing_entry(e))
+        yield e
+
+def compare_buckets(src_bucket, dest_bucket, list_workers=1, cache=None):
     """Compare src and dest buckets by version ID"""
-    src_versions = get_all_versions(src_bucket)
-    dest_versions = get_all_versions(dest_bucket)
-    
-    dest_dict = {(v['Key'], v['VersionId']): True for v in dest_versions}
-    
-    missing = []
-    for v in src_versions:
-        if (v['Key'], v['VersionId']) not in dest_dict:
-            missing.append({'Key': v['Key'], 'VersionId': v['VersionId'], 'IsLatest': v['IsLatest']})
+    missing = _collect_missing(diff_buckets(src_bucket, dest_bucket, list_workers, cache))
+    logger.info(f"Found {len(missing)} missing objects in destination bucket")
+    return missing
+
+def metadata_diff_buckets(src_bucket, dest_bucket, list_workers=1, cache=None, manifest=None, storage_class=None):
+    """Classify every key by size, ETag and storage class from the listings alone, returns the report summary
+
+    Objects to copy again are written to the manifest, a JSON lines file (see s3_metadata_diff).
+    """
+    entries = metadata_diff(get_all_versions(src_bucket, list_workers, cache=cache),
+                            get_all_versions(dest_bucket, list_workers, cache=cache), storage_class)
+    return write_report(entries, manifest)
+
+def sample_verify_buckets(src_bucket, dest_bucket, list_workers=1, cache=None, src_manifest=None,
+                          samples=DEFAULT_SAMPLES, escalate=True):
+    """Verify a stratified sample of the current source objects, verifying failing strata in full
+
+    Returns the missing and mismatched objects in the compare_buckets shape, with the
+    sampling summary (error rate estimate and confidence intervals, see s3_sample_verify).
+    """
+    sampler = SampleVerifier(src_bucket, dest_bucket, samples, s3=client(VERIFY_WORKERS, governor))
+
+    def source(scopes):
+        if src_manifest:
+            return iter_inventory(s3, load_manifest(s3, src_manifest), max(list_workers, 8))
+        return chain.from_iterable(get_all_versions(src_bucket, list_workers, ordered=False, cache=cache,
+                                                    prefix=prefix, delimiter=delimiter)
+                                   for prefix, delimiter in scopes)
+
+    outcomes = sampler.run(source, escalate)
+    summary = sampler.summary()
+    logger.info(f"Sample verification: error rate {summary['ErrorRate']:.4%}, {summary['Confidence']:.0%} "
+                f"confidence interval {summary['ConfidenceInterval']}, "
+                f"{len(summary['FailingStrata'])} failing strata")
+    missing = [{'Key': o['Key'], 'VersionId': o['VersionId'], 'IsLatest': True}
+               for o in outcomes if o['Status'] == 'missing']
     logger.info(f"Found {len(missing)} missing objects in destination bucket")
+    return {
+        'missing_objects': missing,
+        'mismatched_objects': [{'Key': o['Key'], 'VersionId': o['VersionId'], 'IsLatest': True}
+                               for o in outcomes if o['Status'] == 'mismatched'],
+        'sampling': summary
+    }
+
+def digest_tree(bucket, list_workers=1, cache=None, max_depth=DEFAULT_MAX_DEPTH, digest_store=None, changed=None):
+    """Digest tree of bucket: the stored one updated from the changed prefixes when known, else built anew"""
+    def listing(prefix, delimiter):
+        return get_all_versions(bucket, list_workers, cache=cache, prefix=prefix, delimiter=delimiter)
+
+    stored = None
+    if digest_store is not None and cache is not None and changed is not None:
+        stored = digest_store.load(bucket)
+    if stored is None:
+        tree = DigestTree.build(listing('', None), max_depth)
+    else:
+        tree = DigestTree.update(stored, changed, cache.prefixes(bucket), listing, max_depth)
+        logger.info(f"Updated the digest tree of {bucket} from {len(changed)} changed prefixes")
+    if digest_store is not None:
+        digest_store.save(bucket, tree)
+    return tree
+
+def reconcile_buckets(src_bucket, dest_bucket, list_workers=1, cache=None, max_depth=DEFAULT_MAX_DEPTH,
+                      digest_store=None, changed=None):
+    """Find diverged prefixes with digest trees, then the differing versions within them only
+
+    With changed, {bucket: prefixes ListingCache.refresh() relisted}, the trees stored by the
+    last run are updated from those prefixes instead of being built from full listings.
+    """
+    changed = changed or {}
+    src_tree = digest_tree(src_bucket, list_workers, cache, max_depth, digest_store, changed.get(src_bucket))
+    dest_tree = digest_tree(dest_bucket, list_workers, cache, max_depth, digest_store, changed.get(dest_bucket))
+
+    diverged = src_tree.diverged(dest_tree)
+    differences = []
+    for prefix, scope in diverged:
+        delimiter = '/' if scope == 'direct' else None
+        differences.extend(diff_buckets(src_bucket, dest_bucket, list_workers, cache, prefix, delimiter))
+    logger.info(f"Found {len(diverged)} diverged prefixes with {len(differences)} differing versions")
+    return {
+        'diverged_prefixes': [{'Prefix': prefix, 'Scope': scope} for prefix, scope in diverged],
+        'differences': differences
+    }
+
+def diff_inventories(src_manifest, dest_manifest, workers=8, partitions=0):
+    """Stream missing, extra and mismatched versions from two S3 Inventory deliveries.
+
+    No LIST calls are made: both sides come from the inventory data files the
+    manifests point at. Inventory rows are not key-sorted, so the destination is
+    indexed in memory by (Key, VersionId) and the source streamed against it.
+    With partitions, both sides are hash-partitioned to disk instead and the
+    partition pairs diffed across all cores (see s3_partition_diff).
+    """
+    if partitions:
+        yield from diff_unsorted(iter_inventory(s3, load_manifest(s3, src_manifest), workers),
+                                 iter_inventory(s3, load_manifest(s3, dest_manifest), workers),
+                                 partitions)
+        return
+    dest = {}
+    for v in iter_inventory(s3, load_manifest(s3, dest_manifest), workers):
+        dest[(v['Key'], v['VersionId'])] = (v['IsLatest'], v.get('DeleteMarker', False), v.get('Size'), v.get('ETag'))
+    for v in iter_inventory(s3, load_manifest(s3, src_manifest), workers):
+        dv = dest.pop((v['Key'], v['VersionId']), None)
+        if dv is None:
+            yield _diff_entry('missing', v)
+        elif not _versions_match(v, {'DeleteMarker': dv[1], 'Size': dv[2], 'ETag': dv[3]}):
+            yield _diff_entry('mismatched', v)
+    for (key, version_id), dv in dest.items():
+        yield _diff_entry('extra', {'Key': key, 'VersionId': version_id, 'IsLatest': dv[0], 'DeleteMarker': dv[1],
+                                    'Size': dv[2], 'ETag': dv[3]})
+
+def compare_inventories(src_manifest, dest_manifest, workers=8, partitions=0):
+    """Compare src and dest inventory reports by version ID"""
+    missing = _collect_missing(diff_inventories(src_manifest, dest_manifest, workers, partitions))
+    logger.info(f"Found {len(missing)} missing objects in destination inventory")
     return missing
 
-def list_large_objects(bucket, min_size_bytes):
+def list_large_objects(bucket, min_size_bytes, cache=None):
     """List objects in a bucket greater than provided size"""
     large_objs = []
+    if cache is not None:
+        for v in cache.iter_versions(bucket):
+            if v['IsLatest'] and not v.get('DeleteMarker') and v['Size'] >= min_size_bytes:
+                large_objs.append({'Key': v['Key'], 'Size': v['Size']})
+        logger.info(f"Found {len(large_objs)} objects larger than {min_size_bytes} bytes in {bucket}")
+        return large_objs
     paginator = s3.get_paginator('list_objects_v2')
     for page in paginator.paginate(Bucket=bucket):
         for obj in page.get('Contents', []):
@@ -46,65 +318,97 @@ def list_large_objects(bucket, min_size_bytes):
     logger.info(f"Found {len(large_objs)} objects larger than {min_size_bytes} bytes in {bucket}")
     return large_objs
 
-def sync_buckets(src_bucket, dest_bucket):
-    """Perform aws s3 sync via CLI"""
-    import subprocess
-    cmd = [
-        'aws', 's3', 'sync',
-        f's3://{src_bucket}',
-        f's3://{dest_bucket}',
-        '--exact-timestamps',
-        '--acl', 'bucket-owner-full-control'
-    ]
-    logger.info(f"Running sync: {' '.join(cmd)}")
-    subprocess.run(cmd, check=True)
-    logger.info("Sync complete")
-
-def create_inventory(bucket):
-    """Create CSV inventory including versions, delete markers, size, encryption, metadata"""
+def _needs_sync(entry):
+    """Current source objects the destination's current object does not already hold, like `aws s3 sync` copies
+
+    A copy gets a new version ID, so the key's current objects are compared instead: on size and ETag,
+    and on LastModified where a multipart ETag makes the ETags incomparable.
+    """
+    if entry['Status'] not in ('missing', 'mismatched') or not entry['IsLatest'] or entry['DeleteMarker']:
+        return False
+    if entry.get('DestVersionId') is None:
+        return True
+    category = classify(entry, {'Size': entry['DestSize'], 'ETag': entry['DestETag']})
+    if category == 'etag-layout':
+        return not (entry['LastModified'] and entry['DestLastModified']
+                    and entry['DestLastModified'] >= entry['LastModified'])
+    return category not in ('match', 'storage-class-drift')
+
+def verify_sync(src_bucket, dest_bucket, journal, workers=VERIFY_WORKERS):
+    """Verify the versions a sync recorded in its journal from S3 metadata, returns the summary and failures"""
+    verifier = Verifier(src_bucket, dest_bucket, workers, s3=client(workers, governor))
+    failures = [o for o in verifier.run(journal.completed()) if o['Status'] != 'verified']
+    summary = verifier.stats.summary()
+    logger.info(f"Verification complete: {summary}")
+    return {**summary, 'Failures': failures}
+
+def sync_buckets(src_bucket, dest_bucket, entries, workers=None, journal=None):
+    """Server-side copy the diff entries that need syncing, returns the copy summary and failures"""
+    workers = workers or COPY_WORKERS
+    tuner = ConcurrencyTuner(f"{src_bucket}->{dest_bucket}", workers) if AUTOTUNE else None
+    engine = CopyEngine(src_bucket, dest_bucket, workers, acl='bucket-owner-full-control', journal=journal,
+                        governor=governor, tuner=tuner, part_workers=PART_WORKERS,
+                        preserve_parts=PRESERVE_PARTS)
+    failures = [o for o in engine.run(e for e in entries if _needs_sync(e)) if o['Status'] == 'failed']
+    summary = engine.stats.summary()
+    logger.info(f"Sync complete: {summary}")
+    return {**summary, 'Failures': failures}
+
+INVENTORY_FIELDS = [
+    'Key','VersionId','IsLatest','Size','ETag','StorageClass','LastModified','Owner','DeleteMarker','ServerSideEncryption'
+]
+
+def _inventory_name(bucket):
     timestamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
-    filename = f"{bucket}-{timestamp}-inventory.csv"
-    
-    with open(filename, 'w', newline='') as csvfile:
-        fieldnames = [
-            'Key','VersionId','IsLatest','Size','ETag','StorageClass','LastModified','Owner','DeleteMarker','ServerSideEncryption'
-        ]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        
-        versions = get_all_versions(bucket)
-        for v in versions:
-            key = v['Key']
-            version_id = v['VersionId']
-            size = v.get('Size', 0)
-            etag = v.get('ETag', '')
-            storage_class = v.get('StorageClass', '')
-            last_modified = v.get('LastModified', '')
-            owner = v.get('Owner', {}).get('DisplayName', '')
-            delete_marker = v.get('DeleteMarker', False)
-            
-            # Get SSE status
-            sse = ''
-            try:
-                head = s3.head_object(Bucket=bucket, Key=key, VersionId=version_id)
-                sse = head.get('ServerSideEncryption', '')
-            except Exception:
-                pass
-            
-            writer.writerow({
-                'Key': key,
-                'VersionId': version_id,
-                'IsLatest': v.get('IsLatest', False),
-                'Size': size,
-                'ETag': etag,
-                'StorageClass': storage_class,
-                'LastModified': last_modified,
-                'Owner': owner,
-                'DeleteMarker': delete_marker,
-                'ServerSideEncryption': sse
-            })
-    logger.info(f"Inventory saved as {filename}")
-    return filename
+    return f"{bucket}-{timestamp}-inventory"
+
+def _inventory_row(v, sse):
+    return {
+        'Key': v['Key'],
+        'VersionId': v['VersionId'],
+        'IsLatest': v.get('IsLatest', False),
+        'Size': v.get('Size', 0),
+        'ETag': v.get('ETag', ''),
+        'StorageClass': v.get('StorageClass', ''),
+        'LastModified': v.get('LastModified', ''),
+        'Owner': v.get('Owner', {}).get('DisplayName', ''),
+        'DeleteMarker': v.get('DeleteMarker', False),
+        'ServerSideEncryption': sse
+    }
+
+def inventory_writer(bucket, name):
+    """Pipeline consumer writing an inventory row per version, returns the file's location
+
+    Rows go out in INVENTORY_FORMAT, to a local file or streamed to INVENTORY_DESTINATION.
+    Encryption comes from the EncryptionEnricher: inventory rows, the default encryption
+    when assumed, or the cache where they answer it, concurrent HEADs otherwise.
+    """
+    output = InventoryOutput(bucket, name, INVENTORY_FORMAT, INVENTORY_DESTINATION, s3, INVENTORY_FIELDS)
+    enricher = None
+    try:
+        # The HEADs get a client of their own, its connection pool sized to the HEADs in flight
+        enricher = EncryptionEnricher(client(INVENTORY_HEAD_WORKERS, governor), bucket, INVENTORY_HEAD_WORKERS,
+                                      encryption_cache, ASSUME_DEFAULT_ENCRYPTION)
+        while True:
+            v = yield
+            if v is END:
+                break
+            for v, sse in enricher.add(v):
+                output.write(_inventory_row(v, sse))
+        for v, sse in enricher.drain():
+            output.write(_inventory_row(v, sse))
+    except BaseException:
+        output.abort()
+        raise
+    finally:
+        if enricher is not None:
+            enricher.close()
+    return output.close()
+
+def create_inventory(bucket, list_workers=1, cache=None):
+    """Create CSV inventory including versions, delete markers, size, encryption, metadata"""
+    versions = get_all_versions(bucket, list_workers, ordered=False, cache=cache)
+    return run(versions, {'inventory': inventory_writer(bucket, _inventory_name(bucket))})['inventory']
 
 def backup_bucket_policy(bucket):
     """Backup bucket policy"""
@@ -119,35 +423,207 @@ def backup_bucket_policy(bucket):
         logger.warning(f"No policy found for bucket {bucket}")
         return None
 
-def bucket_migration_handler(src_bucket, dest_bucket, min_size_bytes=0):
-    # Step 1: Compare buckets
-    missing_objects = compare_buckets(src_bucket, dest_bucket)
-    
-    # Step 2: List large objects in destination bucket
-    large_objects = list_large_objects(dest_bucket, min_size_bytes) if min_size_bytes > 0 else []
-    
-    # Step 3: Sync buckets
-    sync_buckets(src_bucket, dest_bucket)
+def bucket_migration_handler(src_bucket, dest_bucket, min_size_bytes=0, list_workers=1, cache=None,
+                             full_refresh=False, src_manifest=None, dest_manifest=None, diff_partitions=0,
+                             journal=None, verify=False):
+    # Step 0: Bring the listing cache up to date
+    if cache is not None:
+        refresh_cache(cache, src_bucket, list_workers, full_refresh)
+        refresh_cache(cache, dest_bucket, list_workers, full_refresh)
+
+    # Step 1: Compare buckets, from their inventory reports when given, and copy what is
+    # missing while the diff streams. The destination listing of the diff also feeds the
+    # large-object scan, so it is listed once.
+    pre_sync = {'large_objects': large_objects(min_size_bytes)} if min_size_bytes > 0 else {}
+    missing_objects = []
+    diff_keys = set()
+    if src_manifest and dest_manifest:
+        diff = diff_inventories(src_manifest, dest_manifest, max(list_workers, 8), diff_partitions)
+        if WORK_ORDER != 'listing':
+            # Inventory diffs have no prefix listings to interleave
+            diff = hashed(diff)
+        sync_result = sync_buckets(src_bucket, dest_bucket, _record_missing(diff, missing_objects, diff_keys),
+                                   journal=journal)
+        pre_sync_results = {}
+        if pre_sync:
+            pre_sync_results = run(get_all_versions(dest_bucket, list_workers, ordered=False, cache=cache), pre_sync)
+    else:
+        start(pre_sync)
+        if WORK_ORDER == 'interleave':
+            diff = diff_interleaved(src_bucket, dest_bucket, cache, pre_sync, ORDER_DEPTH)
+        else:
+            dest_versions = tap(get_all_versions(dest_bucket, list_workers, cache=cache), pre_sync)
+            diff = diff_versions(get_all_versions(src_bucket, list_workers, cache=cache), dest_versions)
+            if WORK_ORDER == 'hash':
+                diff = hashed(diff)
+        sync_result = sync_buckets(src_bucket, dest_bucket, _record_missing(diff, missing_objects, diff_keys),
+                                   journal=journal)
+        pre_sync_results = finish(pre_sync)
+    logger.info(f"Found {len(missing_objects)} missing objects in destination bucket")
+    # Prove the synced versions intact from metadata and checksums, reading data only when neither decides
+    verification = verify_sync(src_bucket, dest_bucket, journal) if verify and journal is not None else None
+
+    # Step 2: Large objects in destination bucket, collected during step 1
+    large_objects_found = pre_sync_results.get('large_objects', [])
+    logger.info(f"Found {len(large_objects_found)} objects larger than {min_size_bytes} bytes in {dest_bucket}")
     
-    # Step 4: Create inventory
-    inventory_file = create_inventory(dest_bucket)
+    # Step 3: Create inventory and size histogram off one fresh listing of the destination. The
+    # destination's inventory report, when given, answers the encryption of the versions it holds.
+    # Only the prefixes the sync wrote to are relisted into the cache.
+    if cache is not None:
+        refresh_cache(cache, dest_bucket, list_workers, changed=diff_keys)
+    if dest_manifest and encryption_cache is not None:
+        encryption_cache.seed(dest_bucket, iter_inventory(s3, load_manifest(s3, dest_manifest),
+                                                          max(list_workers, 8)))
+    post_sync_results = run(get_all_versions(dest_bucket, list_workers, ordered=False, cache=cache), {
+        'inventory_file': inventory_writer(dest_bucket, _inventory_name(dest_bucket)),
+        'size_histogram': size_histogram(),
+    })
     
-    # Step 5: Backup bucket policy
+    # Step 4: Backup bucket policy
     policy_file = backup_bucket_policy(dest_bucket)
     
     return {
         'missing_objects': missing_objects,
-        'large_objects': large_objects,
-        'inventory_file': inventory_file,
+        'large_objects': large_objects_found,
+        'sync': sync_result,
+        'verification': verification,
+        'inventory_file': post_sync_results['inventory_file'],
+        'size_histogram': post_sync_results['size_histogram'],
         'policy_file': policy_file
     }
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare, sync and inventory S3 buckets")
+    parser.add_argument('--list-workers', type=int, default=1,
+                        help="Concurrent shards used when listing object versions (default: 1)")
+    parser.add_argument('--cache', metavar='PATH',
+                        help="Read listings from a local SQLite listing cache, relisting the prefixes "
+                             "--changed-keys or --fingerprint find changed, or every prefix without either")
+    parser.add_argument('--full-refresh', action='store_true',
+                        help="Relist every prefix into the listing cache, even with --changed-keys or --fingerprint")
+    parser.add_argument('--changed-keys', metavar='PATH',
+                        help="With --cache, file of bucket/key lines written or deleted since the last run, e.g. "
+                             "from S3 event notifications, CloudTrail or an inventory delta; only the prefixes "
+                             "holding them are relisted")
+    parser.add_argument('--fingerprint', action='store_true',
+                        help="With --cache and no --changed-keys, relist only prefixes whose current objects "
+                             "changed. Finding them lists every current object with ListObjectsV2, about the "
+                             "cost of a fresh listing of the current objects, so it only pays off when "
+                             "noncurrent versions far outnumber them")
+    parser.add_argument('--src-manifest', metavar='PATH_OR_S3_URL',
+                        help="S3 Inventory manifest.json of the source bucket, compares without listing")
+    parser.add_argument('--dest-manifest', metavar='PATH_OR_S3_URL',
+                        help="S3 Inventory manifest.json of the destination bucket")
+    parser.add_argument('--diff-partitions', type=int, default=0,
+                        help="Diff inventory reports by hash-partitioning them to disk into this many partitions "
+                             "and comparing them across all cores, instead of in memory")
+    parser.add_argument('--reconcile', action='store_true',
+                        help="Only report diverged prefixes and their differing versions, using digest trees")
+    parser.add_argument('--metadata-diff', action='store_true',
+                        help="Only report keys missing, extra or differing in size, ETag or storage class, "
+                             "from the listings without further requests")
+    parser.add_argument('--repair-manifest', metavar='PATH',
+                        help="With --metadata-diff, write the objects to copy again to this JSON lines file")
+    parser.add_argument('--storage-class',
+                        help="With --metadata-diff, storage class the destination should be in "
+                             "(default: the source's)")
+    parser.add_argument('--sample-verify', action='store_true',
+                        help="Only verify a stratified random sample of objects per prefix and size tier, report "
+                             "the estimated error rate, and verify failing strata in full")
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES,
+                        help=f"With --sample-verify, objects sampled per stratum (default: {DEFAULT_SAMPLES})")
+    parser.add_argument('--digest-depth', type=int, default=DEFAULT_MAX_DEPTH,
+                        help=f"Directory levels kept in the digest trees (default: {DEFAULT_MAX_DEPTH})")
+    parser.add_argument('--copy-workers', type=int, default=COPY_WORKERS,
+                        help=f"Concurrent server-side copies when syncing (default: {COPY_WORKERS})")
+    parser.add_argument('--part-workers', type=int, default=PART_WORKERS,
+                        help="Part copies in flight across all multipart copies when syncing "
+                             f"(default: {PART_WORKERS})")
+    parser.add_argument('--preserve-parts', action='store_true',
+                        help="Copy multipart objects with the source's part sizes so destination ETags equal the "
+                             "source's, letting --verify and --metadata-diff match them from metadata alone")
+    parser.add_argument('--work-order', choices=WORK_ORDERS, default=WORK_ORDER,
+                        help="Order of the sync: as listed, interleaved across prefix scopes, or hashed by key, "
+                             f"to spread requests across S3 partitions (default: {WORK_ORDER})")
+    parser.add_argument('--order-depth', type=int, default=ORDER_DEPTH,
+                        help=f"Prefix levels split into scopes by --work-order interleave (default: {ORDER_DEPTH})")
+    parser.add_argument('--autotune', action='store_true',
+                        help="Hill-climb the concurrent copies toward the throughput plateau, starting from "
+                             "the settings saved by the last sync between the buckets")
+    parser.add_argument('--journal', metavar='PATH', default=DEFAULT_JOURNAL_PATH,
+                        help=f"Checkpoint journal of completed copies (default: {DEFAULT_JOURNAL_PATH})")
+    parser.add_argument('--resume', action='store_true',
+                        help="Skip copies the journal records as completed by an earlier, interrupted run. Copies "
+                             "in flight when it stopped are made again, adding a duplicate latest version in a "
+                             "versioned destination")
+    parser.add_argument('--verify', action='store_true',
+                        help="After syncing, verify the copied versions recorded in the journal with "
+                             "GetObjectAttributes ETags and checksums")
+    parser.add_argument('--head-workers', type=int, default=INVENTORY_HEAD_WORKERS,
+                        help="Concurrent HEADs reading the encryption of versions for the CSV inventory "
+                             f"(default: {INVENTORY_HEAD_WORKERS}); with --cache, results are kept for the next run")
+    parser.add_argument('--assume-default-encryption', action='store_true',
+                        help="Report the bucket's default encryption for every object in the CSV inventory "
+                             "instead of HEADing it")
+    parser.add_argument('--inventory-format', choices=INVENTORY_FORMATS, default=INVENTORY_FORMAT,
+                        help="Format of the generated inventory: CSV with a header, gzip CSV in the S3 Inventory "
+                             f"layout, or Parquet (default: {INVENTORY_FORMAT})")
+    parser.add_argument('--inventory-destination', metavar='S3_URL', default=INVENTORY_DESTINATION,
+                        help="Stream the generated inventory to s3://bucket/prefix/ in a multipart upload, with a "
+                             "manifest.json for gzip CSV and Parquet, instead of writing a local file")
+    parser.add_argument('--fast-listing', action='store_true',
+                        help="Parse ListObjectVersions responses with the streaming XML lister instead of botocore")
+    args = parser.parse_args()
+    FAST_LISTING = FAST_LISTING or args.fast_listing
+    COPY_WORKERS = args.copy_workers
+    PART_WORKERS = args.part_workers
+    PRESERVE_PARTS = PRESERVE_PARTS or args.preserve_parts
+    WORK_ORDER = args.work_order
+    ORDER_DEPTH = args.order_depth
+    AUTOTUNE = AUTOTUNE or args.autotune
+    INVENTORY_HEAD_WORKERS = args.head_workers
+    INVENTORY_FORMAT = args.inventory_format
+    INVENTORY_DESTINATION = args.inventory_destination
+    ASSUME_DEFAULT_ENCRYPTION = ASSUME_DEFAULT_ENCRYPTION or args.assume_default_encryption
+    CHANGED_KEYS = read_changed_keys(args.changed_keys) if args.changed_keys else None
+    CACHE_FINGERPRINT = CACHE_FINGERPRINT or args.fingerprint
+    encryption_cache = EncryptionCache(args.cache) if args.cache else None
+    cache = ListingCache(args.cache) if args.cache else None
+
     # Example usage
     src_bucket = input("Enter source bucket name: ")
     dest_bucket = input("Enter destination bucket name: ")
+    if args.reconcile:
+        changed = None
+        if cache is not None:
+            changed = {bucket: refresh_cache(cache, bucket, args.list_workers, args.full_refresh)
+                       for bucket in (src_bucket, dest_bucket)}
+        digest_store = DigestStore(args.cache) if args.cache else None
+        print(reconcile_buckets(src_bucket, dest_bucket, args.list_workers, cache, args.digest_depth, digest_store,
+                                changed))
+        raise SystemExit(0)
+    if args.sample_verify:
+        if cache is not None and not args.src_manifest:
+            refresh_cache(cache, src_bucket, args.list_workers, args.full_refresh)
+        print(sample_verify_buckets(src_bucket, dest_bucket, args.list_workers, cache, args.src_manifest,
+                                    args.samples))
+        raise SystemExit(0)
+    if args.metadata_diff:
+        if cache is not None:
+            refresh_cache(cache, src_bucket, args.list_workers, args.full_refresh)
+            refresh_cache(cache, dest_bucket, args.list_workers, args.full_refresh)
+        print(metadata_diff_buckets(src_bucket, dest_bucket, args.list_workers, cache, args.repair_manifest,
+                                    args.storage_class))
+        raise SystemExit(0)
     min_size_gb = float(input("Enter minimum size in GB to list (0 to skip): "))
     min_size_bytes = int(min_size_gb * 1024**3)
     
-    result = bucket_migration_handler(src_bucket, dest_bucket, min_size_bytes)
+    journal = Journal(f"sync:{src_bucket}->{dest_bucket}", args.journal, resume=args.resume)
+    try:
+        result = bucket_migration_handler(src_bucket, dest_bucket, min_size_bytes, args.list_workers, cache,
+                                          args.full_refresh, args.src_manifest, args.dest_manifest,
+                                          args.diff_partitions, journal, args.verify)
+    finally:
+        journal.close()
     print(result)
@@ -0,0 +1,141 @@
+"""
+External-sort style diff of unsorted version listings.
+
+Inventory data files and SQS-delivered change lists are not in key order, so
+they cannot be merge-joined, and indexing a billion-version destination in one
+dict does not fit in memory. Instead both sides are hash-partitioned by key
+into N spill files on local disk; a key always lands in the same partition on
+both sides, so every partition pair can be diffed on its own. Pairs are
+compared in a process pool, one destination partition in memory per worker at
+a time, which keeps memory bounded and uses every core.
+
+Results have the diff_buckets entry shape, {'Status': 'missing' | 'extra' |
+'mismatched', 'Key', 'VersionId', 'IsLatest', 'DeleteMarker', 'Size', 'ETag',
+'LastModified'}, plus the Dest* fields of the destination's current object on
+missing and mismatched entries, and come out grouped by partition, not in key
+order.
+"""
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PARTITIONS = 256
+
+# Records buffered per partition before they are appended to its spill file
+SPILL_BATCH = 2000
+
+
+def _record(v):
+    return (v['Key'], v['VersionId'], v.get('IsLatest', False), v.get('DeleteMarker', False),
+            v.get('Size'), v.get('ETag'), v.get('LastModified'))
+
+
+def partition_of(key, partitions):
+    """Stable partition number of a key (the same in every process)"""
+    return zlib.crc32(key.encode('utf-8')) % partitions
+
+
+def spill(versions, directory, partitions):
+    """
+    Hash-partition listing entries into spill files
+
+    Args:
+        versions: Iterable of listing-shaped dicts, in any order
+        directory: Directory for the partition files, one per partition
+        partitions: Number of partitions
+
+    Returns:
+        (list of partition file paths, number of records spilled)
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = [os.path.join(directory, f"part-{i:05d}.pickle") for i in range(partitions)]
+    files = [open(path, 'wb') for path in paths]
+    buffers = [[] for _ in range(partitions)]
+    count = 0
+    try:
+        for v in versions:
+            i = partition_of(v['Key'], partitions)
+            buffers[i].append(_record(v))
+            if len(buffers[i]) >= SPILL_BATCH:
+                pickle.dump(buffers[i], files[i], pickle.HIGHEST_PROTOCOL)
+                buffers[i] = []
+            count += 1
+        for f, buffer in zip(files, buffers):
+            if buffer:
+                pickle.dump(buffer, f, pickle.HIGHEST_PROTOCOL)
+    finally:
+        for f in files:
+            f.close()
+    return paths, count
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield from pickle.load(f)
+            except EOFError:
+                return
+
+
+def _entry(status, record, dest=None):
+    key, version_id, is_latest, delete_marker, size, etag, last_modified = record
+    entry = {'Status': status, 'Key': key, 'VersionId': version_id, 'IsLatest': is_latest,
+             'DeleteMarker': delete_marker, 'Size': size, 'ETag': etag, 'LastModified': last_modified}
+    if dest is not None and not dest[3]:
+        entry.update({'DestVersionId': dest[1], 'DestSize': dest[4], 'DestETag': dest[5],
+                      'DestLastModified': dest[6]})
+    return entry
+
+
+def diff_partition(src_path, dest_path):
+    """Diff one partition pair; the destination partition is held in memory"""
+    dest = {(r[0], r[1]): r for r in _read(dest_path)}
+    latest = {r[0]: r for r in dest.values() if r[2]}
+    result = []
+    for r in _read(src_path):
+        d = dest.pop((r[0], r[1]), None)
+        if d is None:
+            result.append(_entry('missing', r, latest.get(r[0])))
+        elif r[3:6] != d[3:6]:
+            result.append(_entry('mismatched', r, latest.get(r[0])))
+    result.extend(_entry('extra', d) for d in dest.values())
+    return result
+
+
+def diff_unsorted(src_versions, dest_versions, partitions=DEFAULT_PARTITIONS, workers=None, directory=None):
+    """
+    Stream missing, extra and mismatched versions between two unsorted listings
+
+    Args:
+        src_versions: Source listing-shaped dicts, in any order
+        dest_versions: Destination listing-shaped dicts, in any order
+        partitions: Spill partitions; size them so one destination partition fits in a worker
+        workers: Diff processes, os.cpu_count() when None
+        directory: Parent directory for the spill files, the system temp directory when None
+    """
+    spill_dir = tempfile.mkdtemp(prefix='s3-partition-diff-', dir=directory)
+    try:
+        # Both sides are spilled at the same time; readers like iter_inventory do their own I/O in threads
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            src_future = pool.submit(spill, src_versions, os.path.join(spill_dir, 'src'), partitions)
+            dest_future = pool.submit(spill, dest_versions, os.path.join(spill_dir, 'dest'), partitions)
+            src_paths, src_count = src_future.result()
+            dest_paths, dest_count = dest_future.result()
+        logger.info(f"Spilled {src_count} source and {dest_count} destination versions into {partitions} partitions")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(diff_partition, s, d) for s, d in zip(src_paths, dest_paths)]
+            try:
+                for future in as_completed(futures):
+                    yield from future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
@@ -0,0 +1,345 @@
+"""
+Per-prefix request governor for S3.
+
+S3 scales request rates per key prefix (partition): about 3,500 writes and
+5,500 reads per second each, answering 503 SlowDown above that. botocore's
+retry loop backs off the whole client when that happens, so one hot prefix
+stalls every worker. The governor instead keeps a token bucket per (bucket,
+prefix, read/write), and adapts each bucket's rate on its own with AIMD:
+every success adds a little rate back (about `increase` requests/s per second
+at full speed), every SlowDown halves it. admit() holds back work for a prefix
+that already has requests queued for its tokens, so a bounded pool's workers
+move on to other prefixes: hot prefixes slow down alone while the others keep
+full speed.
+
+governed_client(governor) makes a client whose copy, HEAD and delete calls go
+through the governor:
+
+    governor = PrefixGovernor()
+    engine = CopyEngine(src, dest, s3=governed_client(governor, Config(max_pool_connections=64)))
+
+SlowDown and other retryable errors are retried by the governor, so those
+calls go to a client made with botocore retries off (GOVERNED_RETRIES);
+otherwise botocore would retry a SlowDown before the governor saw it, and the
+prefix's rate would never come down. Listings and bucket-level calls, which
+the governor does not rate-limit, go to a second client that keeps botocore's
+retries.
+"""
+import logging
+import threading
+import time
+from collections import Counter, deque
+from functools import partial
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, HTTPClientError
+
+logger = logging.getLogger(__name__)
+
+# Documented S3 request rates per partitioned prefix
+WRITE_RATE = 3500
+READ_RATE = 5500
+
+# Key segments ('/'-separated) forming the prefix a limiter is kept for
+PREFIX_DEPTH = 1
+
+MIN_RATE = 10
+MAX_ATTEMPTS = 8
+
+# Botocore retries of the calls a governor rate-limits: none, the governor retries them itself
+GOVERNED_RETRIES = {'mode': 'standard', 'total_max_attempts': 1}
+
+# Requests allowed to wait for a prefix's tokens before admit() holds back its further work,
+# and the most items it holds back before admitting them regardless
+MAX_WAITING = 4
+MAX_PARKED = 100000
+
+_END = object()
+
+_SLOWDOWN_CODES = {'SlowDown', 'ServiceUnavailable', '503'}
+_RETRYABLE_CODES = {'InternalError', 'RequestTimeout', 'RequestTimeTooSkewed'}
+
+# Client method -> whether it counts as a read or a write of its Key
+_OPERATIONS = {
+    'head_object': 'read',
+    'get_object': 'read',
+    'get_object_attributes': 'read',
+    'get_object_tagging': 'read',
+    'copy_object': 'write',
+    'upload_part_copy': 'write',
+    'create_multipart_upload': 'write',
+    'complete_multipart_upload': 'write',
+    'abort_multipart_upload': 'write',
+    'put_object': 'write',
+    'delete_object': 'write',
+    'delete_objects': 'write',
+}
+
+
+def prefix_of(key, depth=PREFIX_DEPTH):
+    """First depth '/'-separated segments of key, including the trailing '/'"""
+    end = -1
+    for _ in range(depth):
+        end = key.find('/', end + 1)
+        if end < 0:
+            return key[:key.rfind('/') + 1]
+    return key[:end + 1]
+
+
+class TokenBucket:
+    def __init__(self, rate, max_rate, min_rate=MIN_RATE, increase=50, decrease=0.5, cooldown=1.0):
+        """
+        AIMD token bucket
+
+        Args:
+            rate: Starting requests per second, also the burst size
+            max_rate: Ceiling for additive increase
+            min_rate: Floor for multiplicative decrease
+            increase: Requests/s regained per second of successful requests at full speed
+            decrease: Factor applied to the rate on SlowDown
+            cooldown: Seconds after a decrease during which further SlowDowns (from requests
+                already in flight) do not decrease again
+        """
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.slowdowns = 0
+        self.waiting = 0
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, count=1):
+        """Wait until count requests may be sent; larger counts go into debt paid off by later waits"""
+        waiting = False
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens > 0:
+                    self._tokens -= count
+                    if waiting:
+                        self.waiting -= 1
+                    return
+                if not waiting:
+                    waiting = True
+                    self.waiting += 1
+                wait = -self._tokens / self.rate + 1 / self.rate
+            time.sleep(wait)
+
+    def hold(self, delta):
+        with self._lock:
+            self.waiting += delta
+
+    def success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def slowdown(self):
+        with self._lock:
+            self.slowdowns += 1
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._refill(now)
+            self._tokens = min(self._tokens, 0)
+
+
+def _error_code(e):
+    if isinstance(e, ClientError):
+        return e.response.get('Error', {}).get('Code'), e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return None, None
+
+
+class PrefixGovernor:
+    def __init__(self, write_rate=WRITE_RATE, read_rate=READ_RATE, depth=PREFIX_DEPTH, max_attempts=MAX_ATTEMPTS,
+                 **bucket_args):
+        """
+        Token buckets per (bucket, prefix, read/write), created on first use
+
+        Args:
+            write_rate: Starting and maximum writes/s per prefix
+            read_rate: Starting and maximum reads/s per prefix
+            depth: Key segments forming a prefix
+            max_attempts: Attempts per request on SlowDown and other retryable errors
+            bucket_args: Further TokenBucket arguments (increase, decrease, min_rate, cooldown)
+        """
+        self.rates = {'write': write_rate, 'read': read_rate}
+        self.depth = depth
+        self.max_attempts = max_attempts
+        self.bucket_args = bucket_args
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, kind, bucket, key):
+        ident = (bucket, prefix_of(key, self.depth), kind)
+        limiter = self._limiters.get(ident)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.setdefault(
+                    ident, TokenBucket(self.rates[kind], self.rates[kind], **self.bucket_args))
+        return limiter
+
+    def congested(self, requests):
+        """Whether any of requests would queue behind MAX_WAITING others for its prefix's tokens"""
+        return any(self.limiter(kind, bucket, key).waiting >= MAX_WAITING for kind, bucket, key in requests)
+
+    def admit(self, items, requests, max_parked=MAX_PARKED):
+        """
+        Yield items, holding back those whose prefix is congested until it has tokens to spare
+
+        Pulled by a bounded pool (run_bounded), this keeps workers on prefixes below their
+        rate instead of every worker queueing behind one throttled prefix.
+
+        Args:
+            items: Work items, e.g. listing entries
+            requests: Function of an item returning its [(kind, bucket, key)]
+            max_parked: Items held back at most; beyond that congested items are admitted anyway
+        """
+        parked = {}
+        held = 0
+        items = iter(items)
+        while True:
+            released = next((group for group, queued in parked.items() if not self.congested(queued[0][1])), None)
+            if released is not None:
+                item, _ = parked[released].popleft()
+                if not parked[released]:
+                    del parked[released]
+                held -= 1
+                yield item
+                continue
+            item = next(items, _END)
+            if item is _END:
+                break
+            item_requests = requests(item)
+            if held < max_parked and self.congested(item_requests):
+                group = tuple((kind, bucket, prefix_of(key, self.depth)) for kind, bucket, key in item_requests)
+                parked.setdefault(group, deque()).append((item, item_requests))
+                held += 1
+            else:
+                yield item
+        # Input exhausted: the held back items are all that is left
+        for queued in parked.values():
+            for item, _ in queued:
+                yield item
+
+    def call(self, fn, requests, **kwargs):
+        """
+        Call fn(**kwargs) once tokens are available for every request it makes
+
+        Args:
+            fn: Client method
+            requests: [(kind, bucket, key)], one per object the call reads or writes
+        """
+        counts = Counter((kind, bucket, prefix_of(key, self.depth)) for kind, bucket, key in requests)
+        limiters = [(self.limiter(kind, bucket, prefix), count) for (kind, bucket, prefix), count in counts.items()]
+        for attempt in range(1, self.max_attempts + 1):
+            for limiter, count in limiters:
+                limiter.acquire(count)
+            try:
+                result = fn(**kwargs)
+            except (ClientError, BotocoreConnectionError, HTTPClientError) as e:
+                code, status = _error_code(e)
+                if attempt == self.max_attempts:
+                    raise
+                if code in _SLOWDOWN_CODES or status == 503:
+                    for limiter, _ in limiters:
+                        limiter.slowdown()
+                elif isinstance(e, ClientError) and code not in _RETRYABLE_CODES and (status or 0) < 500:
+                    raise
+                # Backing off counts as waiting for the prefix, so admit() holds back its further work meanwhile
+                for limiter, _ in limiters:
+                    limiter.hold(1)
+                time.sleep(min(0.1 * 2 ** attempt, 5))
+                for limiter, _ in limiters:
+                    limiter.hold(-1)
+                continue
+            for limiter, _ in limiters:
+                limiter.success()
+            return result
+
+    def summary(self):
+        """{'bucket/prefix (kind)': {'Rate', 'SlowDowns'}} for prefixes that were throttled"""
+        return {f"{bucket}/{prefix} ({kind})": {'Rate': round(limiter.rate), 'SlowDowns': limiter.slowdowns}
+                for (bucket, prefix, kind), limiter in list(self._limiters.items()) if limiter.slowdowns}
+
+
+def _requests(name, kwargs):
+    kind = _OPERATIONS[name]
+    if name == 'delete_objects':
+        requests = [(kind, kwargs['Bucket'], o['Key']) for o in kwargs['Delete']['Objects']]
+    else:
+        requests = [(kind, kwargs['Bucket'], kwargs['Key'])]
+    source = kwargs.get('CopySource')
+    if isinstance(source, dict):
+        requests.append(('read', source['Bucket'], source['Key']))
+    return requests
+
+
+class GovernedClient:
+    """S3 client proxy sending object reads, writes and deletes through a PrefixGovernor"""
+
+    def __init__(self, s3, governor, other=None):
+        """
+        Args:
+            s3: Client for the governed calls, made with GOVERNED_RETRIES
+            other: Client for every other call, by default s3
+        """
+        self._s3 = s3
+        self._other = other or s3
+        self.governor = governor
+
+    def _call(self, name, **kwargs):
+        return self.governor.call(getattr(self._s3, name), _requests(name, kwargs), **kwargs)
+
+    def __getattr__(self, name):
+        if name in _OPERATIONS:
+            return partial(self._call, name)
+        return getattr(self._other, name)
+
+
+def _retries_off(s3):
+    retries = s3.meta.config.retries or {}
+    return retries.get('total_max_attempts') == 1 or retries.get('max_attempts') == 0
+
+
+def governed(s3, governor):
+    """
+    Wrap an S3 client so its object requests are rate-limited per prefix
+
+    s3 should be made with retries=GOVERNED_RETRIES; governed_client() makes such a client, and
+    another one for the calls the governor does not rate-limit.
+    """
+    if governor is None or isinstance(s3, GovernedClient):
+        return s3
+    if not _retries_off(s3):
+        logger.warning("The governed S3 client retries on its own, so SlowDown is retried before the governor "
+                       "slows the prefix down; make it with governed_client()")
+    return GovernedClient(s3, governor)
+
+
+def governed_client(governor, config=None, session=None):
+    """
+    S3 client whose object requests are rate-limited per prefix, with botocore retries only on the others
+
+    Args:
+        governor: PrefixGovernor, None for a plain client
+        config: botocore Config of both clients, e.g. Config(max_pool_connections=64)
+        session: boto3.Session to make the clients with, by default the default session
+    """
+    make = (session or boto3).client
+    config = config or Config()
+    if governor is None:
+        return make('s3', config=config)
+    return GovernedClient(make('s3', config=config.merge(Config(retries=GOVERNED_RETRIES))), governor,
+                          other=make('s3', config=config))
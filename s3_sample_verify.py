@@ -0,0 +1,295 @@
+"""
+Sampling verification with confidence bounds.
+
+Verifying every object of a 2B-object migration is too expensive to repeat
+daily, so SampleVerifier verifies a stratified random sample instead and
+estimates the error rate of the whole population from it:
+
+1. One pass over a source listing or inventory counts the current objects of
+   every stratum, (prefix PREFIX_DEPTH levels deep, size tier), and keeps a
+   uniform random sample of up to `samples` of them per stratum (reservoir
+   sampling, so memory is bounded by strata x samples).
+2. The sample is deep-verified with s3_verify.Verifier(deep=True): equal ETags
+   are not trusted, only checksums or SHA-256 hashes of the data of both sides.
+3. Per stratum the error rate is bounded with a Wilson score interval; the
+   population estimate weighs the strata by their share of objects (stratified
+   estimator, with finite population correction).
+4. Strata with a missing or mismatched sample are verified in full, just as
+   deeply, from a second listing of their prefixes only.
+
+Size tiers follow the copy paths: 'small' (< 1 MiB), 'medium' (CopyObject),
+'large' (multipart) and 'huge' (multipart only, > 5 GiB), so a broken copy path
+shows up as a failing tier.
+
+    python s3_sample_verify.py --src source-bucket --dest destination-bucket [--samples 100] \\
+        [--src-manifest s3://inventory-bucket/.../manifest.json]
+"""
+import argparse
+import json
+import logging
+import random
+import statistics
+from itertools import chain
+
+from s3_copy_engine import MAX_COPY_OBJECT_SIZE, MULTIPART_THRESHOLD, client
+from s3_inventory import iter_inventory, load_manifest
+from s3_listing import iter_versions
+from s3_rate_limiter import prefix_of
+from s3_verify import DEFAULT_WORKERS, Verifier
+
+logger = logging.getLogger(__name__)
+
+# Objects sampled per stratum, and the confidence level of the reported intervals
+DEFAULT_SAMPLES = 100
+DEFAULT_CONFIDENCE = 0.95
+
+# Prefix levels a stratum spans
+PREFIX_DEPTH = 1
+
+# (upper size bound, name) of the size tiers
+SIZE_TIERS = ((1024 ** 2, 'small'), (MULTIPART_THRESHOLD, 'medium'), (MAX_COPY_OBJECT_SIZE, 'large'), (None, 'huge'))
+
+# Outcomes that make a stratum fail and escalate to full verification
+FAILING = ('missing', 'mismatched')
+
+
+def size_tier(size):
+    for limit, name in SIZE_TIERS:
+        if limit is None or size < limit:
+            return name
+
+
+def stratum_of(v, depth=PREFIX_DEPTH):
+    """(prefix, size tier) of a listing or inventory entry"""
+    return prefix_of(v['Key'], depth), size_tier(v.get('Size') or 0)
+
+
+def wilson_interval(failures, n, z):
+    """Wilson score interval of a binomial proportion, (0, 1) without trials"""
+    if not n:
+        return 0.0, 1.0
+    p = failures / n
+    center = (p + z * z / (2 * n)) / (1 + z * z / n)
+    half = z / (1 + z * z / n) * (p * (1 - p) / n + z * z / (4 * n * n)) ** 0.5
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+class Stratum:
+    """Population count and uniform reservoir sample of one stratum"""
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.population = 0
+        self.sample = []
+        self.failures = 0
+        self.verified = 0
+        self.unverified = 0
+        self.outcomes = []
+
+    def add(self, v, rng):
+        self.population += 1
+        if len(self.sample) < self.samples:
+            self.sample.append(v)
+        else:
+            i = rng.randrange(self.population)
+            if i < self.samples:
+                self.sample[i] = v
+
+    def record(self, outcome):
+        if outcome['Status'] == 'verified':
+            self.verified += 1
+            return
+        if outcome['Status'] in FAILING:
+            self.failures += 1
+        else:
+            self.unverified += 1
+        self.outcomes.append(outcome)
+
+    @property
+    def checked(self):
+        """Sampled objects with a verdict; errors leave an object unchecked"""
+        return self.failures + self.verified
+
+
+class SampleVerifier:
+    def __init__(self, src_bucket, dest_bucket, samples=DEFAULT_SAMPLES, confidence=DEFAULT_CONFIDENCE,
+                 depth=PREFIX_DEPTH, workers=DEFAULT_WORKERS, s3=None, seed=None):
+        """
+        Verify a stratified random sample of the current source objects
+
+        Args:
+            samples: Objects sampled per stratum
+            confidence: Confidence level of the intervals, e.g. 0.95
+            depth: Prefix levels a stratum spans
+            workers: Concurrent verifications
+            s3: S3 client, by default one with a connection pool sized to workers
+            seed: Seed of the sample, to draw the same one again
+        """
+        self.src_bucket = src_bucket
+        self.dest_bucket = dest_bucket
+        self.samples = samples
+        self.confidence = confidence
+        self.z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+        self.depth = depth
+        self.workers = workers
+        self.s3 = s3 or client(workers)
+        self.rng = random.Random(seed)
+        self.strata = {}
+        self.escalated = {}
+
+    def draw(self, versions):
+        """Count and sample the current objects of a listing or inventory, in any order"""
+        for v in versions:
+            if v.get('IsLatest', True) and not v.get('DeleteMarker'):
+                key = stratum_of(v, self.depth)
+                stratum = self.strata.get(key)
+                if stratum is None:
+                    stratum = self.strata[key] = Stratum(self.samples)
+                stratum.add(v, self.rng)
+        logger.info(f"Sampled {sum(len(s.sample) for s in self.strata.values())} of "
+                    f"{sum(s.population for s in self.strata.values())} objects in {len(self.strata)} strata")
+
+    def verify_sample(self):
+        """Deep-verify the sample, returns the strata with a missing or mismatched object"""
+        verifier = Verifier(self.src_bucket, self.dest_bucket, self.workers, self.s3, deep=True)
+        strata = {(v['Key'], v.get('VersionId')): key for key, s in self.strata.items() for v in s.sample}
+        for outcome in verifier.run(v for s in self.strata.values() for v in s.sample):
+            self.strata[strata[(outcome['Key'], outcome['VersionId'])]].record(outcome)
+        return sorted(key for key, s in self.strata.items() if s.failures)
+
+    def scopes(self, strata):
+        """(prefix, delimiter) listing scopes holding the objects of strata"""
+        # A prefix of fewer than depth levels only holds the keys directly under it
+        return sorted({(prefix, '/' if prefix.count('/') < self.depth else None) for prefix, _ in strata})
+
+    def escalate(self, strata, versions):
+        """
+        Verify every current object of strata in full, yielding the outcomes that are not verified
+
+        Args:
+            versions: Entries covering the strata in any order, e.g. listings of scopes(strata); entries of
+                other strata are skipped
+        """
+        strata = set(strata)
+        # As deep as the sample: a failure equal ETags hide would otherwise pass again
+        verifier = Verifier(self.src_bucket, self.dest_bucket, self.workers, self.s3, deep=True)
+        objects = (v for v in versions if v.get('IsLatest', True) and not v.get('DeleteMarker')
+                   and stratum_of(v, self.depth) in strata)
+        for outcome in verifier.run(objects):
+            if outcome['Status'] != 'verified':
+                yield outcome
+        self.escalated = verifier.stats.summary()
+
+    def run(self, source, escalate=True):
+        """
+        Sample, deep-verify the sample and verify failing strata in full
+
+        Args:
+            source: Function of a list of (prefix, delimiter) scopes returning the source entries under
+                them, e.g. chained listings
+            escalate: Verify failing strata in full; otherwise only the sample's outcomes are returned
+
+        Returns:
+            Outcomes that are not verified: those of the full verification for failing strata, the
+            sample's for the others
+        """
+        self.draw(source([('', None)]))
+        failing = self.verify_sample()
+        if not failing or not escalate:
+            return [o for s in self.strata.values() for o in s.outcomes]
+        logger.info(f"Escalating {len(failing)} failing strata to full verification")
+        outcomes = [o for key, s in self.strata.items() if key not in failing for o in s.outcomes]
+        return outcomes + list(self.escalate(failing, source(self.scopes(failing))))
+
+    def _stratum_summary(self, key, s):
+        low, high = wilson_interval(s.failures, s.checked, self.z)
+        return {'Prefix': key[0], 'Tier': key[1], 'Population': s.population, 'Sampled': len(s.sample),
+                'Failures': s.failures, 'Unverified': s.unverified,
+                'ErrorRate': round(s.failures / s.checked, 6) if s.checked else None,
+                'ConfidenceInterval': [round(low, 6), round(high, 6)]}
+
+    def estimate(self):
+        """
+        Stratified estimate of the population error rate and its confidence interval
+
+        Strata without failures are counted with half a failure in the variance, so that a clean sample still
+        bounds the error rate from above instead of claiming it is exactly zero.
+        """
+        population = sum(s.population for s in self.strata.values())
+        rate = variance = 0.0
+        for s in self.strata.values():
+            if not s.checked:
+                continue
+            weight = s.population / population
+            rate += weight * s.failures / s.checked
+            adjusted = (s.failures + 0.5) / (s.checked + 1)
+            variance += (weight ** 2 * (1 - s.checked / s.population)
+                         * adjusted * (1 - adjusted) / s.checked)
+        half = self.z * variance ** 0.5
+        return rate, max(0.0, rate - half), min(1.0, rate + half)
+
+    def summary(self):
+        rate, low, high = self.estimate()
+        failing = [key for key, s in self.strata.items() if s.failures]
+        return {
+            'Population': sum(s.population for s in self.strata.values()),
+            'Sampled': sum(len(s.sample) for s in self.strata.values()),
+            'Failures': sum(s.failures for s in self.strata.values()),
+            'Unverified': sum(s.unverified for s in self.strata.values()),
+            'ErrorRate': round(rate, 6),
+            'ConfidenceInterval': [round(low, 6), round(high, 6)],
+            'Confidence': self.confidence,
+            'FailingStrata': [{'Prefix': prefix, 'Tier': tier} for prefix, tier in sorted(failing)],
+            'Escalated': self.escalated,
+            'Strata': [self._stratum_summary(key, s) for key, s in sorted(self.strata.items())],
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify a stratified random sample of copied objects and "
+                                                 "estimate the error rate, verifying failing strata in full")
+    parser.add_argument('--src', required=True, help="Source bucket")
+    parser.add_argument('--dest', required=True, help="Destination bucket")
+    parser.add_argument('--prefix', default='', help="Only sample keys under this prefix")
+    parser.add_argument('--src-manifest', metavar='PATH_OR_S3_URL',
+                        help="Draw the sample from this S3 Inventory manifest.json of the source instead of listing")
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES,
+                        help=f"Objects sampled per stratum (default: {DEFAULT_SAMPLES})")
+    parser.add_argument('--confidence', type=float, default=DEFAULT_CONFIDENCE,
+                        help=f"Confidence level of the intervals (default: {DEFAULT_CONFIDENCE})")
+    parser.add_argument('--depth', type=int, default=PREFIX_DEPTH,
+                        help=f"Prefix levels a stratum spans (default: {PREFIX_DEPTH})")
+    parser.add_argument('--seed', type=int, help="Seed of the sample, to draw the same one again")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f"Concurrent verifications (default: {DEFAULT_WORKERS})")
+    parser.add_argument('--list-workers', type=int, default=4,
+                        help="Concurrent shards or inventory files read at once (default: 4)")
+    parser.add_argument('--no-escalate', action='store_true', help="Only report failing strata")
+    parser.add_argument('--failures', metavar='PATH', help="Write unverified outcomes to this JSON file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    sampler = SampleVerifier(args.src, args.dest, args.samples, args.confidence, args.depth, args.workers,
+                             seed=args.seed)
+
+    def source(scopes):
+        if args.src_manifest:
+            versions = iter_inventory(sampler.s3, load_manifest(sampler.s3, args.src_manifest), args.list_workers)
+        else:
+            versions = chain.from_iterable(
+                iter_versions(sampler.s3, args.src, max(scope_prefix, args.prefix, key=len),
+                              list_workers=args.list_workers, ordered=False, delimiter=delimiter)
+                for scope_prefix, delimiter in scopes)
+        return (v for v in versions if v['Key'].startswith(args.prefix))
+
+    failures = sampler.run(source, escalate=not args.no_escalate)
+    print(json.dumps(sampler.summary(), indent=2))
+    if args.failures:
+        with open(args.failures, 'w') as f:
+            json.dump(failures, f, indent=2)
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""
+Post-copy verification from S3-side metadata.
+
+Proving a copy intact used to mean downloading both sides. Here every copied
+version is checked with GetObjectAttributes instead, on a concurrent pool, and
+data is only read when metadata cannot decide:
+
+1. the destination's ETag equals the source ETag recorded at copy time (one
+   request; holds for single-part and layout-preserving copies of SSE-S3 and
+   unencrypted objects)
+2. otherwise the source attributes are fetched: a size difference is a
+   mismatch, and a checksum both objects carry (CRC64NVME, CRC32C, CRC32,
+   SHA256, SHA1) decides; full-object checksums are compared as is, composite
+   ones only prove a match since they depend on the part layout
+3. only objects without a usable checksum (e.g. SSE-KMS multipart copies of
+   objects uploaded without checksums) are hashed from ranged GETs of both sides
+
+Keys whose last replayed step was a delete marker are verified to have no
+current version. Outcomes:
+
+    {'Key', 'VersionId', 'Status': 'verified' | 'mismatched' | 'missing' | 'failed',
+     'Method': 'etag' | 'checksum:<algorithm>' | 'size' | 'stream' | 'delete-marker' | None, 'Error'}
+
+    python s3_verify.py --src source-bucket --dest destination-bucket \\
+        [--journal s3-migration-journal.sqlite --scope 'sync:source-bucket->destination-bucket']
+"""
+import argparse
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from s3_copy_engine import client, run_bounded
+from s3_journal import DEFAULT_JOURNAL_PATH, Journal
+from s3_listing import iter_versions
+
+logger = logging.getLogger(__name__)
+
+# Verifications in flight: most need a single small GetObjectAttributes request, so latency is what limits a pool
+DEFAULT_WORKERS = 256
+
+# Checksum fields of GetObjectAttributes, preferred first
+CHECKSUM_FIELDS = ('ChecksumCRC64NVME', 'ChecksumCRC32C', 'ChecksumCRC32', 'ChecksumSHA256', 'ChecksumSHA1')
+
+# Ranged GETs of the streaming fallback, and the chunk size they are read in
+RANGE_SIZE = 64 * 1024 ** 2
+CHUNK_SIZE = 1024 ** 2
+
+_ATTRIBUTES = ['ETag', 'Checksum', 'ObjectParts', 'ObjectSize']
+_NOT_FOUND = {'NoSuchKey', 'NoSuchVersion', '404', 'NotFound', 'MethodNotAllowed', '405'}
+
+
+def object_attributes(s3, bucket, key, version_id=None):
+    """ETag, Checksum, part count and size of an object, None if it (or its current version) does not exist"""
+    kwargs = {'Bucket': bucket, 'Key': key, 'ObjectAttributes': _ATTRIBUTES, 'MaxParts': 1}
+    if version_id:
+        kwargs['VersionId'] = version_id
+    try:
+        return s3.get_object_attributes(**kwargs)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in _NOT_FOUND:
+            return None
+        raise
+
+
+def _etag(value):
+    return value.strip('"') if value else None
+
+
+def _parts(attributes):
+    return attributes.get('ObjectParts', {}).get('TotalPartsCount')
+
+
+def _checksums(attributes):
+    checksum = attributes.get('Checksum', {})
+    # Objects from before ChecksumType was reported: multipart checksums are composite
+    checksum_type = checksum.get('ChecksumType') or ('COMPOSITE' if _parts(attributes) else 'FULL_OBJECT')
+    return {field: checksum[field] for field in CHECKSUM_FIELDS if checksum.get(field)}, checksum_type
+
+
+def compare_checksums(src, dest):
+    """
+    Compare the checksums two objects both carry
+
+    Returns:
+        The algorithm proving them equal, False if a full-object checksum differs,
+        None when no checksum can decide
+    """
+    src_sums, src_type = _checksums(src)
+    dest_sums, dest_type = _checksums(dest)
+    for field in CHECKSUM_FIELDS:
+        if field not in src_sums or field not in dest_sums:
+            continue
+        if src_sums[field] == dest_sums[field]:
+            return field[len('Checksum'):]
+        if src_type == dest_type == 'FULL_OBJECT':
+            return False
+        # Composite checksums of different part layouts differ for equal data
+    return None
+
+
+def stream_digest(s3, bucket, key, version_id, size, range_size=RANGE_SIZE):
+    """SHA-256 of an object read with ranged GETs"""
+    digest = hashlib.sha256()
+    for first in range(0, size, range_size):
+        kwargs = {'Bucket': bucket, 'Key': key, 'Range': f"bytes={first}-{min(first + range_size, size) - 1}"}
+        if version_id:
+            kwargs['VersionId'] = version_id
+        for chunk in s3.get_object(**kwargs)['Body'].iter_chunks(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class VerifyStats:
+    """Aggregate outcome counts, methods and streamed bytes of a verification run"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counts = {}
+        self.methods = {}
+        self.bytes_streamed = 0
+
+    def add(self, outcome, bytes_streamed=0):
+        with self._lock:
+            self.counts[outcome['Status']] = self.counts.get(outcome['Status'], 0) + 1
+            if outcome['Method']:
+                self.methods[outcome['Method']] = self.methods.get(outcome['Method'], 0) + 1
+            self.bytes_streamed += bytes_streamed
+
+    def summary(self):
+        seconds = max(time.monotonic() - self.started, 1e-9)
+        objects = sum(self.counts.values())
+        return {
+            'Objects': objects,
+            **{status.capitalize(): count for status, count in sorted(self.counts.items())},
+            'Methods': dict(sorted(self.methods.items())),
+            'BytesStreamed': self.bytes_streamed,
+            'Seconds': round(seconds, 3),
+            'ObjectsPerSecond': round(objects / seconds, 1),
+        }
+
+
+class Verifier:
+    def __init__(self, src_bucket, dest_bucket, workers=DEFAULT_WORKERS, s3=None, range_size=RANGE_SIZE,
+                 deep=False):
+        """
+        Verify copies of source versions at the same keys of a destination bucket
+
+        Args:
+            workers: Concurrent verifications
+            s3: S3 client, by default one with a connection pool sized to workers
+            range_size: Bytes per ranged GET when an object has to be hashed
+            deep: Do not trust equal ETags; decide from checksums, or hash the data of both sides
+        """
+        self.src_bucket = src_bucket
+        self.dest_bucket = dest_bucket
+        self.workers = workers
+        self.s3 = s3 or client(workers)
+        self.range_size = range_size
+        self.deep = deep
+        self.stats = VerifyStats()
+
+    def _check(self, v):
+        """(status, method, bytes streamed) of one entry"""
+        key, version_id = v['Key'], v.get('VersionId')
+        dest = object_attributes(self.s3, self.dest_bucket, key)
+        if v.get('DeleteMarker') or v.get('Status') == 'deleted':
+            return ('verified' if dest is None else 'mismatched'), 'delete-marker', 0
+        if dest is None:
+            return 'missing', None, 0
+        if not self.deep and v.get('ETag') and _etag(v['ETag']) == _etag(dest.get('ETag')):
+            return 'verified', 'etag', 0
+        src = object_attributes(self.s3, self.src_bucket, key, version_id)
+        if src is None:
+            raise ValueError(f"Source version of {key} no longer exists")
+        if src.get('ObjectSize') != dest.get('ObjectSize'):
+            return 'mismatched', 'size', 0
+        if not self.deep and _etag(src.get('ETag')) == _etag(dest.get('ETag')):
+            return 'verified', 'etag', 0
+        algorithm = compare_checksums(src, dest)
+        if algorithm is False:
+            return 'mismatched', 'checksum', 0
+        if algorithm:
+            return 'verified', f"checksum:{algorithm}", 0
+        size = src['ObjectSize']
+        equal = (stream_digest(self.s3, self.src_bucket, key, version_id, size, self.range_size)
+                 == stream_digest(self.s3, self.dest_bucket, key, None, size, self.range_size))
+        return ('verified' if equal else 'mismatched'), 'stream', 2 * size
+
+    def _outcome(self, v):
+        outcome = {'Key': v['Key'], 'VersionId': v.get('VersionId'), 'Status': None, 'Method': None, 'Error': None}
+        streamed = 0
+        try:
+            outcome['Status'], outcome['Method'], streamed = self._check(v)
+        except Exception as e:
+            logger.error(f"Failed to verify {v['Key']} version {v.get('VersionId')}: {e}")
+            outcome['Status'] = 'failed'
+            outcome['Error'] = str(e)
+        self.stats.add(outcome, streamed)
+        return outcome
+
+    def run(self, versions):
+        """
+        Verify every entry, yielding outcomes in completion order
+
+        Args:
+            versions: Entries with Key, VersionId and, when known, ETag: Journal.completed(), the
+                current versions of a source listing, or diff entries that were synced
+        """
+        yield from run_bounded(self._outcome, versions, self.workers)
+        logger.info(f"Verify {self.src_bucket} -> {self.dest_bucket}: {self.stats.summary()}")
+
+
+def _current_versions(versions):
+    return (v for v in versions if v['IsLatest'] and not v.get('DeleteMarker'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify copied objects from S3 metadata and checksums, "
+                                                 "reading data only for objects without a usable checksum")
+    parser.add_argument('--src', required=True, help="Source bucket")
+    parser.add_argument('--dest', required=True, help="Destination bucket")
+    parser.add_argument('--prefix', default='', help="Only verify keys under this prefix, when listing the source")
+    parser.add_argument('--journal', metavar='PATH',
+                        help="Verify the units a copy or replay run recorded in this journal instead of listing "
+                             f"the source (e.g. {DEFAULT_JOURNAL_PATH})")
+    parser.add_argument('--scope', help="Journal scope of the run, e.g. 'sync:source-bucket->destination-bucket'")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f"Concurrent verifications (default: {DEFAULT_WORKERS})")
+    parser.add_argument('--list-workers', type=int, default=4,
+                        help="Concurrent shards used when listing the source (default: 4)")
+    parser.add_argument('--failures', metavar='PATH', help="Write unverified outcomes to this JSON file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.journal and not args.scope:
+        parser.error("--journal needs --scope")
+
+    verifier = Verifier(args.src, args.dest, args.workers)
+    journal = Journal(args.scope, args.journal, resume=True) if args.journal else None
+    try:
+        if journal is not None:
+            versions = journal.completed()
+        else:
+            versions = _current_versions(iter_versions(verifier.s3, args.src, args.prefix,
+                                                       list_workers=args.list_workers))
+        failures = [o for o in verifier.run(versions) if o['Status'] != 'verified']
+    finally:
+        if journal is not None:
+            journal.close()
+    print(json.dumps(verifier.stats.summary()))
+    if args.failures:
+        with open(args.failures, 'w') as f:
+            json.dump(failures, f, indent=2)
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+Membership indexes of (key, version_id) for the missing-object checkers.
+
+VersionIndex keeps the destination in memory as one set of version IDs per
+key, so each lookup is O(1) however many versions a key has.
+
+SpilledVersionIndex is for buckets whose destination does not fit in Lambda
+memory. Every version goes into a Bloom filter, backed by an mmap'd file on
+local disk when a directory is given, and into an exact SQLite table on the
+same disk. Lookups are answered in batches: the Bloom filter settles the
+definitely-absent ones without touching disk, and only the maybe-present ones
+are confirmed with one SQLite query per batch. Results are exact either way;
+the Bloom filter only saves disk reads.
+
+build_index() fills either kind, and event_flag() reads the boolean fields of
+the checkers' events.
+
+The SQLite table is WITHOUT ROWID, which needs SQLite 3.8.2; older builds get
+a plain table with the same primary key. The confirming queries use nothing
+newer, so any SQLite Python ships with works.
+"""
+import hashlib
+import math
+import mmap
+import os
+import sqlite3
+
+# Lookups confirmed against SQLite per query; each binds two variables, and SQLite builds before 3.32
+# allow at most 999
+CONFIRM_BATCH = 499
+
+_WITHOUT_ROWID = ' WITHOUT ROWID' if sqlite3.sqlite_version_info >= (3, 8, 2) else ''
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01, path=None):
+        """
+        Create an empty Bloom filter
+
+        Args:
+            capacity: Expected number of items; more still works with a higher error rate
+            error_rate: False positive rate at capacity
+            path: File to mmap the bit array from, kept in memory when None
+        """
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        size = (self.num_bits + 7) // 8
+        self.path = path
+        if path is None:
+            self._bits = bytearray(size)
+        else:
+            with open(path, 'wb') as f:
+                f.truncate(size)
+            self._file = open(path, 'r+b')
+            self._bits = mmap.mmap(self._file.fileno(), size)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def close(self):
+        if self.path is not None:
+            self._bits.close()
+            self._file.close()
+            os.remove(self.path)
+
+
+def _item(key, version_id):
+    return f"{key}\0{version_id}".encode('utf-8')
+
+
+class VersionIndex:
+    """Exact in-memory index: {key: set(version_ids)}"""
+
+    def __init__(self):
+        self._versions = {}
+
+    def add(self, key, version_id):
+        self._versions.setdefault(key, set()).add(version_id)
+
+    def finish(self):
+        pass
+
+    def find_missing(self, pairs):
+        """Return the (key, version_id) pairs that are not in the index"""
+        return [(key, vid) for key, vid in pairs if vid not in self._versions.get(key, ())]
+
+    def close(self):
+        self._versions.clear()
+
+
+class SpilledVersionIndex:
+    def __init__(self, directory, capacity, error_rate=0.01, insert_batch=10000):
+        """
+        Create an empty disk-backed index
+
+        Args:
+            directory: Local directory for the SQLite table and Bloom bit array (e.g. /tmp)
+            capacity: Expected number of versions, sizes the Bloom filter
+            error_rate: Bloom false positive rate at capacity
+            insert_batch: Versions written per SQLite transaction
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._db_path = os.path.join(directory, f"version-index-{os.getpid()}-{id(self)}.sqlite")
+        self.bloom = BloomFilter(capacity, error_rate, path=self._db_path + '.bloom')
+        self._conn = sqlite3.connect(self._db_path)
+        self._conn.execute('PRAGMA journal_mode=OFF')
+        self._conn.execute('PRAGMA synchronous=OFF')
+        self._conn.execute('CREATE TABLE versions (key TEXT, version_id TEXT, PRIMARY KEY (key, version_id))'
+                           + _WITHOUT_ROWID)
+        self._insert_batch = insert_batch
+        self._pending = []
+        self.confirmations = 0
+
+    def add(self, key, version_id):
+        self.bloom.add(_item(key, version_id))
+        self._pending.append((key, version_id))
+        if len(self._pending) >= self._insert_batch:
+            self._flush()
+
+    def _flush(self):
+        self._conn.executemany('INSERT OR IGNORE INTO versions VALUES (?, ?)', self._pending)
+        self._conn.commit()
+        self._pending = []
+
+    def finish(self):
+        """Write out buffered versions; call once every destination version was added"""
+        self._flush()
+
+    def find_missing(self, pairs):
+        """Return the (key, version_id) pairs that are not in the index"""
+        missing = []
+        maybe = []
+        for pair in pairs:
+            (maybe if _item(*pair) in self.bloom else missing).append(pair)
+        for i in range(0, len(maybe), CONFIRM_BATCH):
+            batch = maybe[i:i + CONFIRM_BATCH]
+            # OR'd equalities rather than row values, which need SQLite 3.15; each is a primary key lookup
+            where = ' OR '.join(['(key = ? AND version_id = ?)'] * len(batch))
+            found = set(self._conn.execute(
+                f'SELECT key, version_id FROM versions WHERE {where}',
+                [part for pair in batch for part in pair]))
+            missing.extend(pair for pair in batch if pair not in found)
+            self.confirmations += len(batch)
+        return missing
+
+    def close(self):
+        self._conn.close()
+        os.remove(self._db_path)
+        self.bloom.close()
+
+
+def build_index(versions, spill_dir=None, capacity=None):
+    """
+    Index (key, version_id) pairs, in memory or spilled to disk behind a Bloom filter
+
+    Args:
+        versions: (key, version_id) pairs
+        spill_dir: Local directory to spill to (e.g. /tmp), in memory when None
+        capacity: Expected number of versions when spilling, sizes the Bloom filter
+
+    Returns:
+        VersionIndex or SpilledVersionIndex; when indexing fails it is closed, removing any spilled files
+    """
+    index = SpilledVersionIndex(spill_dir, capacity) if spill_dir else VersionIndex()
+    try:
+        for key, vid in versions:
+            index.add(key, vid)
+        index.finish()
+    except BaseException:
+        index.close()
+        raise
+    return index
+
+
+def event_flag(value):
+    """Boolean event field, which event JSON may carry as a string such as 'false'"""
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1', 'yes')
+    return bool(value)
@@ -0,0 +1,334 @@
+"""
+Replay the version stacks of a source bucket into a destination bucket.
+
+A versioned destination only ends up with the source's version history if
+every key's versions and delete markers are written in the order they were
+created. This streams the source listing, groups it per key and replays each
+key's stack oldest first: versions are server-side copied (CopyEngine, so
+large versions use parallel part copies) and delete markers are recreated with
+DeleteObject. Keys are replayed concurrently; within a key every step waits for
+the previous one, and once a step fails the rest of that key's stack is skipped
+so the destination history is never reordered. A delete marker at the top of a
+stack (a currently deleted key, by far the most common case) has nothing after
+it, so once the rest of its stack is replayed it is handed to a bulk deleter
+that recreates markers 1,000 keys per DeleteObjects request.
+
+    python s3_version_replay.py --src source-bucket --dest destination-bucket \\
+        --acl bucket-owner-full-control --sse AES256 [--since 2026-02-01T00:00:00]
+
+Outcomes use the CopyEngine shape, with Status 'copied', 'deleted', 'failed'
+or 'skipped'.
+
+Redoing a step after an interruption would add a second copy of a version, or
+a second delete marker, to the destination's history. So with a journal every
+step is marked started (one synchronous SQLite commit) before its request is
+sent, and a resumed run first checks each step left in flight against the
+newest version of its key in the destination: a version of the step's kind
+written since the step started (to the second, LastModified's precision) means
+it landed and is recorded as replayed; otherwise it is replayed again.
+"""
+import argparse
+import json
+import logging
+import math
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from itertools import groupby
+from operator import itemgetter
+
+from s3_bulk_delete import DEFAULT_WORKERS as DEFAULT_DELETE_WORKERS
+from s3_bulk_delete import MAX_KEYS_PER_REQUEST, delete_objects
+from s3_autotune import ConcurrencyTuner
+from s3_copy_engine import DEFAULT_WORKERS, CopyEngine
+from s3_journal import DEFAULT_JOURNAL_PATH, Journal
+from s3_listing import iter_versions, page_versions
+from s3_rate_limiter import GovernedClient, PrefixGovernor
+from s3_work_order import DEFAULT_DEPTH, WORK_ORDERS, hashed, interleave, interleaved_listings
+
+logger = logging.getLogger(__name__)
+
+
+def version_stacks(versions, since=None):
+    """
+    Yield (key, versions oldest first) from a key-ordered listing
+
+    Args:
+        versions: Listing in key order, newest version first within a key (iter_versions ordered=True)
+        since: Only replay versions and delete markers last modified at or after this datetime
+    """
+    for key, group in groupby(versions, key=itemgetter('Key')):
+        # Listing order is newest first; reversing before the stable sort keeps equal timestamps in creation order
+        stack = sorted(reversed(list(group)), key=itemgetter('LastModified'))
+        if since is not None:
+            stack = [v for v in stack if v['LastModified'] >= since]
+        if stack:
+            yield key, stack
+
+
+def _outcome(v, status, started, error=None):
+    return {'Key': v['Key'], 'VersionId': v['VersionId'], 'Status': status, 'Size': v.get('Size'),
+            'Seconds': round(time.monotonic() - started, 3), 'Error': error}
+
+
+def replay_stack(engine, stack, defer_marker=None):
+    """
+    Replay one key's stack in order, returns its outcomes
+
+    A trailing delete marker is passed to defer_marker, when given, instead of
+    being deleted here; the caller reports its outcome.
+    """
+    outcomes = []
+    for i, v in enumerate(stack):
+        started = time.monotonic()
+        try:
+            if v.get('DeleteMarker') and defer_marker is not None and i == len(stack) - 1:
+                defer_marker(v)
+                continue
+            if engine.journal is not None:
+                engine.journal.start(v)
+            if v.get('DeleteMarker'):
+                engine.s3.delete_object(Bucket=engine.dest_bucket, Key=v['Key'])
+                status = 'deleted'
+            else:
+                v = {**v, 'Size': engine.copy(v)}
+                status = 'copied'
+            outcomes.append(_outcome(v, status, started))
+            if engine.journal is not None:
+                engine.journal.record(v, status)
+        except Exception as e:
+            logger.error(f"Failed to replay {v['Key']} version {v['VersionId']}, skipping the rest of its stack: {e}")
+            outcomes.append(_outcome(v, 'failed', started, str(e)))
+            outcomes.extend(_outcome(rest, 'skipped', time.monotonic()) for rest in stack[i + 1:])
+            break
+    for outcome in outcomes:
+        engine.record(outcome)
+    return outcomes
+
+
+class _MarkerDeleter:
+    """Recreates deferred trailing delete markers with bulk DeleteObjects on a background thread
+
+    An exception on the thread is re-raised by ready() and remaining(), and defer() fails fast once
+    the thread has died, instead of the replay waiting on it forever.
+    """
+
+    def __init__(self, engine, workers):
+        self.engine = engine
+        self.pending = {}
+        self.error = None
+        self._lock = threading.Lock()
+        self._keys = queue.Queue(maxsize=MAX_KEYS_PER_REQUEST * workers)
+        self._outcomes = queue.Queue()
+        self._thread = threading.Thread(target=self._run, args=(workers,), daemon=True)
+        self._thread.start()
+
+    def _raise(self):
+        if self.error is not None:
+            raise self.error
+
+    def _put(self, key):
+        """Queue a key for the thread, False once it has died"""
+        while self._thread.is_alive():
+            try:
+                self._keys.put(key, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def defer(self, v):
+        self._raise()
+        with self._lock:
+            self.pending[v['Key']] = v
+        if self.engine.journal is not None:
+            self.engine.journal.start(v)
+        if not self._put(v['Key']):
+            self._raise()
+            raise RuntimeError("The delete marker thread has stopped")
+
+    def _run(self, workers):
+        try:
+            for deleted in delete_objects(self.engine.s3, self.engine.dest_bucket, iter(self._keys.get, None),
+                                          workers):
+                with self._lock:
+                    v = self.pending.pop(deleted['Key'])
+                outcome = {'Key': v['Key'], 'VersionId': v['VersionId'], 'Status': deleted['Status'], 'Size': None,
+                           'Seconds': None, 'Error': deleted['Error']}
+                self.engine.stats.add(outcome)
+                if self.engine.journal is not None and outcome['Status'] == 'deleted':
+                    self.engine.journal.record(v, 'deleted')
+                self._outcomes.put(outcome)
+        except Exception as e:
+            logger.error(f"Recreating delete markers in {self.engine.dest_bucket} failed: {e}")
+            self.error = e
+        finally:
+            self._outcomes.put(None)
+
+    def ready(self):
+        """Outcomes available without waiting"""
+        outcomes = []
+        while True:
+            try:
+                outcome = self._outcomes.get_nowait()
+            except queue.Empty:
+                return outcomes
+            if outcome is None:
+                self._outcomes.put(None)
+                self._raise()
+                return outcomes
+            outcomes.append(outcome)
+
+    def stop(self):
+        """No more markers; the remaining ones are still flushed"""
+        self._put(None)
+
+    def remaining(self):
+        """Wait for the remaining outcomes, after stop()"""
+        yield from iter(self._outcomes.get, None)
+        self._raise()
+
+
+def _landed(s3, bucket, u):
+    """Whether the newest version of u's key in bucket is of u's kind and written since u started"""
+    page = s3.list_object_versions(Bucket=bucket, Prefix=u['Key'], MaxKeys=1)
+    newest = next((v for v in page_versions(page) if v['Key'] == u['Key']), None)
+    if newest is None or newest['LastModified'].timestamp() < math.floor(u['Started']):
+        return False
+    # Delete markers are journaled without an ETag
+    return bool(newest.get('DeleteMarker')) == (u['ETag'] is None)
+
+
+def settle_in_flight(engine):
+    """
+    Record the steps an interrupted run left in flight that landed in the destination as replayed
+
+    The others stay pending and are replayed again.
+
+    Returns:
+        Number of in-flight steps that had landed
+    """
+    landed = 0
+    for u in engine.journal.in_flight():
+        if _landed(engine.s3, engine.dest_bucket, u):
+            engine.journal.record(u, 'copied' if u['ETag'] is not None else 'deleted')
+            landed += 1
+    engine.journal.flush()
+    return landed
+
+
+def _stacks(engine, versions, since):
+    # A journal drops versions recorded as replayed before grouping, so a resumed run continues every stack
+    if engine.journal is not None:
+        versions = engine.journal.pending(versions)
+    return version_stacks(versions, since)
+
+
+def replay(engine, versions, since=None, delete_workers=DEFAULT_DELETE_WORKERS, order='listing'):
+    """Replay every key's stack from a key-ordered listing, yielding outcomes as keys finish
+
+    With a journal on the engine, versions it records as replayed are dropped
+    before grouping, so a resumed run continues every stack where it stopped;
+    steps left in flight are first checked against the destination.
+    With order 'interleave', versions is an iterable of key-ordered listings (one
+    per prefix scope, see s3_work_order.interleaved_listings) whose stacks are
+    replayed round-robin; with 'hash', stacks are taken in hashed key order.
+    """
+    if engine.journal is not None:
+        landed = settle_in_flight(engine)
+        if landed:
+            logger.info(f"{landed} steps in flight when the last run stopped had landed in {engine.dest_bucket}")
+    if order == 'interleave':
+        stacks = interleave(_stacks(engine, listing, since) for listing in versions)
+    else:
+        stacks = _stacks(engine, versions, since)
+        if order == 'hash':
+            stacks = hashed(stacks, key=itemgetter(0))
+    if isinstance(engine.s3, GovernedClient):
+        stacks = engine.s3.governor.admit(stacks, lambda item: engine._requests(item[1][0]))
+    deleter = _MarkerDeleter(engine, delete_workers)
+    try:
+        for outcomes in engine.bounded(lambda item: replay_stack(engine, item[1], deleter.defer), stacks):
+            yield from outcomes
+            yield from deleter.ready()
+    finally:
+        deleter.stop()
+    yield from deleter.remaining()
+    logger.info(f"Replay {engine.src_bucket} -> {engine.dest_bucket}: {engine.stats.summary()}")
+    if engine.tuner is not None:
+        engine.tuner.save()
+
+
+def _parse_since(value):
+    since = datetime.fromisoformat(value)
+    return since if since.tzinfo else since.replace(tzinfo=timezone.utc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay source version stacks (versions and delete markers) "
+                                                 "into a destination bucket in LastModified order")
+    parser.add_argument('--src', required=True, help="Source bucket")
+    parser.add_argument('--dest', required=True, help="Destination bucket")
+    parser.add_argument('--prefix', default='', help="Only replay keys under this prefix")
+    parser.add_argument('--since', type=_parse_since,
+                        help="Only replay versions and delete markers modified at or after this time (UTC ISO 8601)")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f"Keys replayed concurrently (default: {DEFAULT_WORKERS})")
+    parser.add_argument('--list-workers', type=int, default=4,
+                        help="Concurrent shards used when listing the source (default: 4)")
+    parser.add_argument('--delete-workers', type=int, default=DEFAULT_DELETE_WORKERS,
+                        help="Concurrent DeleteObjects requests recreating delete markers "
+                             f"(default: {DEFAULT_DELETE_WORKERS})")
+    parser.add_argument('--acl', help="Canned ACL of the copies, e.g. bucket-owner-full-control")
+    parser.add_argument('--sse', help="ServerSideEncryption of the copies, e.g. AES256")
+    parser.add_argument('--preserve-parts', action='store_true',
+                        help="Copy multipart versions with the source's part sizes so destination ETags equal "
+                             "the source's")
+    parser.add_argument('--journal', metavar='PATH', default=DEFAULT_JOURNAL_PATH,
+                        help=f"Checkpoint journal of replayed versions (default: {DEFAULT_JOURNAL_PATH})")
+    parser.add_argument('--resume', action='store_true',
+                        help="Skip versions the journal records as replayed by an earlier, interrupted run; "
+                             "versions it left in flight are checked against the destination first")
+    parser.add_argument('--work-order', choices=WORK_ORDERS, default='listing',
+                        help="Replay keys as listed, interleaved across prefix scopes, or hashed by key, to spread "
+                             "requests across S3 partitions (default: listing)")
+    parser.add_argument('--order-depth', type=int, default=DEFAULT_DEPTH,
+                        help=f"Prefix levels split into scopes by --work-order interleave (default: {DEFAULT_DEPTH})")
+    parser.add_argument('--autotune', action='store_true',
+                        help="Hill-climb the keys replayed concurrently toward the throughput plateau, starting "
+                             "from the settings saved by the last run between the buckets")
+    parser.add_argument('--no-rate-limit', action='store_true',
+                        help="Leave SlowDown to botocore's retries instead of rate-limiting requests per key prefix")
+    parser.add_argument('--failures', metavar='PATH', help="Write failed and skipped outcomes to this JSON file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    journal = Journal(f"replay:{args.src}/{args.prefix}->{args.dest}", args.journal, resume=args.resume)
+    tuner = ConcurrencyTuner(f"{args.src}->{args.dest}", args.workers) if args.autotune else None
+    engine = CopyEngine(args.src, args.dest, args.workers, acl=args.acl,
+                        extra_args={'ServerSideEncryption': args.sse} if args.sse else None, journal=journal,
+                        governor=None if args.no_rate_limit else PrefixGovernor(), tuner=tuner,
+                        preserve_parts=args.preserve_parts)
+    if args.work_order == 'interleave':
+        versions = interleaved_listings(engine.s3, [args.src], args.prefix,
+                                        lambda prefix, delimiter: iter_versions(engine.s3, args.src, prefix,
+                                                                                delimiter=delimiter),
+                                        args.order_depth)
+    else:
+        versions = iter_versions(engine.s3, args.src, args.prefix, list_workers=args.list_workers)
+    try:
+        failures = [o for o in replay(engine, versions, args.since, args.delete_workers, args.work_order)
+                    if o['Status'] in ('failed', 'skipped')]
+    finally:
+        journal.close()
+    print(json.dumps(engine.stats.summary()))
+    if args.failures:
+        with open(args.failures, 'w') as f:
+            json.dump(failures, f, indent=2)
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""
+Compact columnar store for S3 version listings.
+
+A listing entry kept as the botocore response dict (nested Owner dict,
+datetime, ETag and StorageClass strings) costs around 1 KB. VersionStore keeps
+only the fields the caller projects, column by column:
+
+  * keys are stored once per run of consecutive versions of the same key, and
+    each row points at its key with a 4-byte index;
+  * version IDs and ETags are packed into one bytearray per column;
+  * sizes, timestamps and IsLatest/DeleteMarker flags live in typed arrays;
+  * storage classes are one-byte codes.
+
+Rows are read back through VersionRecord, a __slots__ view that supports the
+same v['Key'] / v.get('Size') access as the botocore dicts, so existing code can
+consume either. When filled in listing order, find() looks up a version by
+binary search without any hash index.
+"""
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timezone
+
+from s3_listing import iter_versions
+
+ALL_FIELDS = ('Key', 'VersionId', 'IsLatest', 'DeleteMarker', 'Size', 'LastModified', 'ETag', 'StorageClass')
+# Fields that only exist on object versions, not on delete markers
+_OBJECT_FIELDS = frozenset(('Size', 'ETag', 'StorageClass'))
+
+_IS_LATEST = 1
+_DELETE_MARKER = 2
+
+
+class _StringColumn:
+    """Variable-length strings packed into one bytearray"""
+    __slots__ = ('_data', '_offsets')
+
+    def __init__(self):
+        self._data = bytearray()
+        self._offsets = array('Q', [0])
+
+    def append(self, value):
+        self._data += (value or '').encode('utf-8')
+        self._offsets.append(len(self._data))
+
+    def __getitem__(self, i):
+        return self._data[self._offsets[i]:self._offsets[i + 1]].decode('utf-8')
+
+    def nbytes(self):
+        return len(self._data) + self._offsets.itemsize * len(self._offsets)
+
+
+class _CodeColumn:
+    """Low-cardinality strings stored as one-byte codes"""
+    __slots__ = ('_values', '_codes', '_column')
+
+    def __init__(self):
+        self._values = []
+        self._codes = {}
+        self._column = array('B')
+
+    def append(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self._values)
+            self._values.append(value)
+        self._column.append(code)
+
+    def __getitem__(self, i):
+        return self._values[self._column[i]]
+
+    def nbytes(self):
+        return len(self._column)
+
+
+class VersionRecord:
+    """Read-only view of one row of a VersionStore"""
+    __slots__ = ('_store', '_row')
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    def __getitem__(self, field):
+        return self._store.field(self._row, field)
+
+    def get(self, field, default=None):
+        try:
+            return self._store.field(self._row, field)
+        except KeyError:
+            return default
+
+    def __contains__(self, field):
+        return self.get(field) is not None
+
+    def to_dict(self):
+        return {f: self[f] for f in ALL_FIELDS if f in self}
+
+    def __repr__(self):
+        return f"VersionRecord({self.to_dict()!r})"
+
+
+class VersionStore:
+    def __init__(self, fields=ALL_FIELDS):
+        """
+        Create an empty store
+
+        Args:
+            fields: Listing fields to keep; Key, IsLatest and DeleteMarker are always kept
+        """
+        unknown = set(fields) - set(ALL_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown listing fields: {sorted(unknown)}")
+        self.fields = frozenset(fields) | {'Key', 'IsLatest', 'DeleteMarker'}
+        self.is_sorted = True
+        self._keys = []
+        self._key_starts = array('Q')
+        self._key_ids = array('I')
+        self._flags = array('B')
+        self._version_ids = _StringColumn() if 'VersionId' in self.fields else None
+        self._sizes = array('q') if 'Size' in self.fields else None
+        self._last_modified = array('d') if 'LastModified' in self.fields else None
+        self._etags = _StringColumn() if 'ETag' in self.fields else None
+        self._storage_classes = _CodeColumn() if 'StorageClass' in self.fields else None
+
+    def append(self, v):
+        """Add one listing entry, keeping only the projected fields"""
+        key = v['Key']
+        if not self._keys or self._keys[-1] != key:
+            if self._keys and key < self._keys[-1]:
+                self.is_sorted = False
+            self._keys.append(key)
+            self._key_starts.append(len(self._key_ids))
+        self._key_ids.append(len(self._keys) - 1)
+        delete_marker = v.get('DeleteMarker', False)
+        self._flags.append((_IS_LATEST if v.get('IsLatest') else 0) | (_DELETE_MARKER if delete_marker else 0))
+        if self._version_ids is not None:
+            self._version_ids.append(v['VersionId'])
+        if self._sizes is not None:
+            self._sizes.append(v.get('Size', 0))
+        if self._last_modified is not None:
+            self._last_modified.append(v['LastModified'].timestamp())
+        if self._etags is not None:
+            self._etags.append(v.get('ETag'))
+        if self._storage_classes is not None:
+            self._storage_classes.append(v.get('StorageClass'))
+
+    def extend(self, versions):
+        for v in versions:
+            self.append(v)
+        return self
+
+    def field(self, row, name):
+        """Return field name of row, raising KeyError when it is not stored"""
+        flags = self._flags[row]
+        if name == 'Key':
+            return self._keys[self._key_ids[row]]
+        if name == 'IsLatest':
+            return bool(flags & _IS_LATEST)
+        if name == 'DeleteMarker':
+            return bool(flags & _DELETE_MARKER)
+        if name not in self.fields or (name in _OBJECT_FIELDS and flags & _DELETE_MARKER):
+            raise KeyError(name)
+        if name == 'VersionId':
+            return self._version_ids[row]
+        if name == 'Size':
+            return self._sizes[row]
+        if name == 'LastModified':
+            return datetime.fromtimestamp(self._last_modified[row], timezone.utc)
+        if name == 'ETag':
+            return self._etags[row]
+        return self._storage_classes[row]
+
+    def __len__(self):
+        return len(self._key_ids)
+
+    def __getitem__(self, row):
+        if not -len(self) <= row < len(self):
+            raise IndexError(row)
+        return VersionRecord(self, row % len(self))
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield VersionRecord(self, row)
+
+    def find(self, key, version_id):
+        """Return the record of key/version_id, or None; needs VersionId kept and a store filled in listing order"""
+        if self._version_ids is None:
+            raise ValueError("find() needs VersionId among the store's fields")
+        if not self.is_sorted:
+            raise ValueError("find() needs a store filled in listing order")
+        i = bisect_left(self._keys, key)
+        if i == len(self._keys) or self._keys[i] != key:
+            return None
+        end = self._key_starts[i + 1] if i + 1 < len(self._keys) else len(self)
+        for row in range(self._key_starts[i], end):
+            if self._version_ids[row] == version_id:
+                return VersionRecord(self, row)
+        return None
+
+    def __contains__(self, key_version):
+        return self.find(*key_version) is not None
+
+    def nbytes(self):
+        """Approximate memory held by the columns, excluding the key strings themselves"""
+        total = 8 * len(self._keys)
+        for column in (self._key_starts, self._key_ids, self._flags, self._sizes, self._last_modified):
+            if column is not None:
+                total += column.itemsize * len(column)
+        for column in (self._version_ids, self._etags, self._storage_classes):
+            if column is not None:
+                total += column.nbytes()
+        return total
+
+
+def load_versions(s3, bucket, fields=ALL_FIELDS, prefix='', list_workers=1, ordered=True):
+    """List bucket/prefix straight into a VersionStore holding only the given fields"""
+    return VersionStore(fields).extend(iter_versions(s3, bucket, prefix, list_workers=list_workers,
+                                                     ordered=ordered))
@@ -0,0 +1,127 @@
+"""
+Work ordering that spreads requests across S3 index partitions.
+
+Listings come back in key order, so copying or deleting in listing order sends
+every request of the moment to the same narrow key range, i.e. the same S3
+partition, and date-partitioned buckets hit one partition at a time. Two
+orderings spread the load (s3-local-synctos3-multiprocess.sh shuffles its
+folders for the same reason):
+
+- 'interleave': the keyspace is split into prefix scopes down to a depth (each
+  prefix holding children contributes its direct keys, listed with a '/'
+  delimiter, and its children), and up to `width` scopes, spaced evenly across
+  the keyspace, are listed at once and consumed round-robin, item by item.
+  Every scope keeps its own key order, so per-prefix merge-joins and version
+  stacks still work within it.
+- 'hash': any stream is reordered by a hash of the key within windows of
+  `window` items. It needs no listing, so it also applies to inventory
+  diffs, but only spreads requests across the keys a window holds.
+
+'listing' leaves the order alone.
+"""
+import logging
+import math
+import zlib
+from collections import deque
+from itertools import islice
+from operator import itemgetter
+
+logger = logging.getLogger(__name__)
+
+WORK_ORDERS = ('listing', 'interleave', 'hash')
+
+# Prefix levels split into scopes, and scopes consumed at once
+DEFAULT_DEPTH = 2
+DEFAULT_WIDTH = 32
+
+# Items reordered together by 'hash'
+HASH_WINDOW = 100000
+
+_END = object()
+
+
+def _child_prefixes(s3, bucket, prefix):
+    prefixes = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+    return prefixes
+
+
+def prefix_scopes(s3, buckets, prefix='', depth=DEFAULT_DEPTH):
+    """
+    Split the keyspace under prefix into disjoint (prefix, delimiter) scopes
+
+    A prefix with children becomes a (prefix, '/') scope of its direct keys, and
+    its children are split further down to depth levels; the prefixes left are
+    (prefix, None) scopes of everything under them. Child prefixes are taken from
+    all buckets, so the scopes cover every key of each.
+
+    Returns:
+        Scopes in key order
+    """
+    scopes = []
+    level = [prefix]
+    for _ in range(depth):
+        deeper = []
+        for parent in level:
+            children = sorted({child for bucket in buckets for child in _child_prefixes(s3, bucket, parent)})
+            if children:
+                scopes.append((parent, '/'))
+                deeper.extend(children)
+            else:
+                scopes.append((parent, None))
+        level = deeper
+        if not level:
+            break
+    scopes.extend((p, None) for p in level)
+    logger.info(f"Split {', '.join(buckets)} under '{prefix}' into {len(scopes)} prefix scopes")
+    return sorted(scopes)
+
+
+def spread(scopes, width=DEFAULT_WIDTH):
+    """Reorder scopes so that any width consecutive ones are spaced evenly across the keyspace"""
+    stride = max(1, math.ceil(len(scopes) / width))
+    return [scopes[i] for offset in range(stride) for i in range(offset, len(scopes), stride)]
+
+
+def interleave(streams, width=DEFAULT_WIDTH):
+    """Yield items round-robin from up to width of streams at a time, opening the next stream when one ends"""
+    streams = iter(streams)
+    active = deque(iter(stream) for stream in islice(streams, width))
+    while active:
+        items = active.popleft()
+        item = next(items, _END)
+        if item is _END:
+            following = next(streams, None)
+            if following is not None:
+                active.append(iter(following))
+            continue
+        yield item
+        active.append(items)
+
+
+def _hash(key):
+    return zlib.crc32(key.encode())
+
+
+def hashed(items, key=itemgetter('Key'), window=HASH_WINDOW):
+    """Yield items in order of a hash of key(item), window items at a time"""
+    items = iter(items)
+    while True:
+        batch = list(islice(items, window))
+        if not batch:
+            return
+        batch.sort(key=lambda item: _hash(key(item)))
+        yield from batch
+
+
+def interleaved_listings(s3, buckets, prefix, listing, depth=DEFAULT_DEPTH, width=DEFAULT_WIDTH):
+    """
+    Lazily open listing(prefix, delimiter) for every scope, spread across the keyspace
+
+    Args:
+        listing: Function of (prefix, delimiter) returning a key-ordered stream for the scope
+        buckets: Buckets whose prefixes the scopes are taken from
+    """
+    return (listing(scope_prefix, delimiter)
+            for scope_prefix, delimiter in spread(prefix_scopes(s3, buckets, prefix, depth), width))
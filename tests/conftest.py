@@ -0,0 +1,7 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# s3_migration_handler builds its clients at import time
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+import pytest
+
+import s3_autotune
+from s3_autotune import MIN_SAMPLES, PROBE_AFTER, ConcurrencyTuner
+from s3_copy_engine import CopyEngine
+
+WINDOW = 10.0
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def tuner(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(s3_autotune, 'time', SimpleNamespace(monotonic=clock.monotonic))
+    tuner = ConcurrencyTuner('src->dest', workers=16, window=WINDOW, path=str(tmp_path / 'autotune.json'))
+    tuner.clock = clock
+    return tuner
+
+
+def _windows(tuner, rates, error_rate=0.0):
+    """Feed one measurement window per rate of copies/s, returning the decisions and the workers after each"""
+    steps = []
+    for rate in rates:
+        count = max(MIN_SAMPLES, round(rate * WINDOW))
+        errors = round(count * error_rate)
+        for i in range(count):
+            if i == count - 1:
+                tuner.clock.now += WINDOW
+            tuner.record({'Status': 'failed' if i < errors else 'copied', 'Size': 1024, 'Seconds': 0.1})
+        steps.append((tuner.history[-1]['Decision'], tuner.workers))
+    return steps
+
+
+def test_engine_pool_covers_the_tuners_range_and_the_part_copies(tmp_path):
+    tuner = ConcurrencyTuner('src->dest', workers=16, max_workers=100, path=str(tmp_path / 'autotune.json'))
+    engine = CopyEngine('src', 'dest', tuner=tuner, part_workers=32)
+    assert engine.s3.meta.config.max_pool_connections == 132
+
+
+def test_saved_settings_restart_from_the_workers_reached(tmp_path):
+    path = str(tmp_path / 'autotune.json')
+    tuner = ConcurrencyTuner('src->dest', workers=16, path=path)
+    tuner.workers = 48
+    tuner.history.append({})
+    assert set(tuner.save()) == {'Workers', 'ObjectsPerSecond', 'BytesPerSecond', 'UpdatedAt'}
+    assert ConcurrencyTuner('src->dest', workers=16, path=path).workers == 48
+
+
+def test_tuner_steps_up_while_throughput_gains(tuner):
+    assert _windows(tuner, [100, 150, 220]) == [('climb', 24), ('climb', 36), ('climb', 54)]
+
+
+def test_tuner_reverses_with_a_smaller_step_on_a_loss(tuner):
+    # 36 / 1.5 ** 0.5 rounds to 29
+    assert _windows(tuner, [100, 150, 100]) == [('climb', 24), ('climb', 36), ('reverse', 29)]
+
+
+def test_tuner_settles_and_holds_at_the_plateau_then_probes(tuner):
+    steps = _windows(tuner, [100, 150, 152] + [151] * PROBE_AFTER)
+    assert steps[:3] == [('climb', 24), ('climb', 36), ('settle', 24)]
+    assert steps[3:-1] == [('hold', 24)] * (PROBE_AFTER - 1)
+    # 24 * 1.1 rounds to 26
+    assert steps[-1] == ('probe', 26)
+
+
+def test_tuner_backs_off_on_errors(tuner):
+    assert _windows(tuner, [100, 150]) == [('climb', 24), ('climb', 36)]
+    # 36 * 0.75
+    assert _windows(tuner, [200], error_rate=0.1) == [('back off', 27)]
@@ -0,0 +1,154 @@
+from concurrent.futures import Future
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError, EndpointConnectionError, ParamValidationError, ReadTimeoutError
+
+import s3_copy_engine
+from s3_copy_engine import _retryable, multipart_copy, source_part_sizes, upload_directory
+
+MIB = 1024 ** 2
+
+
+class FakeS3:
+    def __init__(self, head, tags=()):
+        self.head = head
+        self.tags = list(tags)
+        self.calls = []
+
+    def head_object(self, **kwargs):
+        self.calls.append(('head_object', kwargs))
+        return self.head
+
+    def get_object_tagging(self, **kwargs):
+        self.calls.append(('get_object_tagging', kwargs))
+        return {'TagSet': self.tags}
+
+    def create_multipart_upload(self, **kwargs):
+        self.calls.append(('create_multipart_upload', kwargs))
+        return {'UploadId': 'upload'}
+
+    def upload_part_copy(self, **kwargs):
+        self.calls.append(('upload_part_copy', kwargs))
+        return {'CopyPartResult': {'ETag': f'"{kwargs["PartNumber"]}"'}}
+
+    def complete_multipart_upload(self, **kwargs):
+        self.calls.append(('complete_multipart_upload', kwargs))
+
+    def abort_multipart_upload(self, **kwargs):
+        self.calls.append(('abort_multipart_upload', kwargs))
+
+    def called(self, name):
+        return [kwargs for call, kwargs in self.calls if call == name]
+
+
+SOURCE = {'Bucket': 'src', 'Key': 'big', 'VersionId': 'v1'}
+
+
+def test_multipart_copy_keeps_tags_headers_and_object_lock():
+    retain = datetime(2030, 1, 1, tzinfo=timezone.utc)
+    s3 = FakeS3({'ContentLength': 130 * MIB, 'ContentType': 'text/plain', 'CacheControl': 'max-age=60',
+                 'Expires': datetime(2027, 1, 1, tzinfo=timezone.utc), 'WebsiteRedirectLocation': '/other',
+                 'StorageClass': 'STANDARD_IA', 'ObjectLockMode': 'GOVERNANCE', 'ObjectLockRetainUntilDate': retain,
+                 'ObjectLockLegalHoldStatus': 'ON', 'Metadata': {'owner': 'data'}, 'TagCount': 2},
+                tags=[{'Key': 'team', 'Value': 'data eng'}, {'Key': 'tier', 'Value': 'a&b'}])
+
+    assert multipart_copy(s3, SOURCE, 'dest', 'big', 130 * MIB) == 3
+
+    create, = s3.called('create_multipart_upload')
+    assert create['Tagging'] == 'team=data%20eng&tier=a%26b'
+    assert create['Metadata'] == {'owner': 'data'}
+    assert create['StorageClass'] == 'STANDARD_IA'
+    assert create['ObjectLockRetainUntilDate'] == retain
+    for field in ('ContentType', 'CacheControl', 'Expires', 'WebsiteRedirectLocation', 'ObjectLockMode',
+                  'ObjectLockLegalHoldStatus'):
+        assert create[field] == s3.head[field]
+    assert len(s3.called('complete_multipart_upload')) == 1
+
+
+def test_multipart_copy_skips_tagging_request_for_untagged_objects():
+    s3 = FakeS3({'ContentLength': 100 * MIB})
+    multipart_copy(s3, SOURCE, 'dest', 'big', 100 * MIB)
+    assert not s3.called('get_object_tagging')
+    assert 'Tagging' not in s3.called('create_multipart_upload')[0]
+
+
+class PartsS3(FakeS3):
+    """Multipart source whose part sizes are only known to HeadObject PartNumber"""
+
+    def __init__(self, part_sizes):
+        super().__init__({'ContentLength': sum(part_sizes), 'ETag': f'"abc-{len(part_sizes)}"'})
+        self.part_sizes = part_sizes
+
+    def get_object_attributes(self, **kwargs):
+        return {'ObjectParts': {}}
+
+    def head_object(self, PartNumber=None, **kwargs):
+        self.calls.append(('head_object', {'PartNumber': PartNumber, **kwargs}))
+        return {'ContentLength': self.part_sizes[PartNumber - 1]}
+
+
+def test_uneven_middle_parts_are_read_from_every_part():
+    # First and last parts alone would suggest three 8 MiB parts and a 4 MiB one
+    part_sizes = [8 * MIB, 5 * MIB, 11 * MIB, 4 * MIB]
+    s3 = PartsS3(part_sizes)
+    assert source_part_sizes(s3, SOURCE, sum(part_sizes), s3.head['ETag']) == part_sizes
+    assert sorted(kwargs['PartNumber'] for kwargs in s3.called('head_object')) == [1, 2, 3, 4]
+
+
+def test_unproven_layout_falls_back_to_default_parts():
+    s3 = PartsS3([8 * MIB, 8 * MIB])
+    sizes = source_part_sizes(s3, SOURCE, 100 * MIB, s3.head['ETag'])
+    assert sizes == [64 * MIB, 36 * MIB]
+
+
+def test_multipart_copy_with_shared_pool_starts_no_threads(monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError('multipart_copy started a pool of its own')
+
+    def submit(fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+    monkeypatch.setattr(s3_copy_engine, 'ThreadPoolExecutor', no_pool)
+    s3 = FakeS3({'ContentLength': 130 * MIB})
+    assert multipart_copy(s3, SOURCE, 'dest', 'big', 130 * MIB, submit=submit) == 3
+
+
+def _client_error(code, status):
+    return ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, 'UploadPartCopy')
+
+
+def test_only_transient_errors_are_retried():
+    assert _retryable(_client_error('SlowDown', 503))
+    assert _retryable(_client_error('InternalError', 500))
+    assert _retryable(EndpointConnectionError(endpoint_url='https://s3.amazonaws.com'))
+    assert _retryable(ReadTimeoutError(endpoint_url='https://s3.amazonaws.com'))
+    assert not _retryable(_client_error('AccessDenied', 403))
+    assert not _retryable(ParamValidationError(report='bad CopySourceRange'))
+    assert not _retryable(TypeError('bug'))
+
+
+class UploadS3:
+    def __init__(self):
+        self.configs = []
+
+    def get_paginator(self, operation):
+        class Paginator:
+            def paginate(self, **kwargs):
+                yield {}
+        return Paginator()
+
+    def upload_file(self, path, bucket, key, Config=None):
+        self.configs.append(Config)
+
+
+def test_upload_directory_bounds_part_uploads_per_file(tmp_path):
+    for name in ('a', 'b'):
+        (tmp_path / name).write_bytes(b'data')
+    s3 = UploadS3()
+
+    outcomes, summary = upload_directory(str(tmp_path), 'bucket', workers=4, s3=s3, part_workers=2)
+
+    assert summary['Uploaded'] == 2
+    assert [config.max_concurrency for config in s3.configs] == [2, 2]
@@ -0,0 +1,47 @@
+import threading
+import time
+
+from s3_copy_scheduler import LARGE_LOOKAHEAD, SizeTieredScheduler
+
+
+class FakeEngine:
+    """Copies every version as one part, each part waiting for the gate"""
+
+    workers = 4
+
+    def __init__(self):
+        self.gate = threading.Event()
+
+    def small_limit(self):
+        return 2 * self.workers
+
+    def multipart(self, v):
+        return True
+
+    def _outcome(self, v, submit):
+        submit(self.gate.wait).result()
+        return {'Key': v['Key'], 'Status': 'copied'}
+
+
+def test_multipart_versions_held_are_bounded():
+    engine = FakeEngine()
+    read = []
+
+    def versions():
+        for i in range(1000):
+            read.append(i)
+            yield {'Key': f'key{i:04d}', 'Size': 1000 + i}
+
+    outcomes = []
+    thread = threading.Thread(target=lambda: outcomes.extend(SizeTieredScheduler(engine, 2, 4).run(versions())),
+                              daemon=True)
+    thread.start()
+    try:
+        time.sleep(1.0)
+        # The heap, the copies started, and the version that filled the heap
+        assert len(read) <= LARGE_LOOKAHEAD + 4 + 1
+    finally:
+        engine.gate.set()
+    thread.join(60)
+    assert not thread.is_alive()
+    assert len(outcomes) == 1000
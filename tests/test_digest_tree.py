@@ -0,0 +1,66 @@
+from s3_digest_tree import DigestStore, DigestTree
+
+
+def _version(key, version_id='v1', size=1):
+    return {'Key': key, 'VersionId': version_id, 'ETag': f'"{key}"', 'Size': size, 'IsLatest': True}
+
+
+KEYS = ['a.txt', 'a/1', 'a/b/2', 'a0', 'b/1', 'b/c/d/3', 'c/1', 'z']
+
+
+class Listing:
+    """Key-ordered listing of a fixed set of versions that records what was listed"""
+
+    def __init__(self, versions):
+        self.versions = sorted(versions, key=lambda v: v['Key'])
+        self.calls = []
+
+    def __call__(self, prefix, delimiter):
+        self.calls.append((prefix, delimiter))
+        return iter([v for v in self.versions if v['Key'].startswith(prefix)
+                     and (delimiter is None or delimiter not in v['Key'][len(prefix):])])
+
+    def prefixes(self):
+        return sorted({v['Key'][:v['Key'].find('/') + 1] for v in self.versions if '/' in v['Key']})
+
+
+def test_unchanged_bucket_is_not_relisted(tmp_path):
+    listing = Listing([_version(key) for key in KEYS])
+    store = DigestStore(str(tmp_path / 'cache.db'))
+    store.save('bucket', DigestTree.build(listing('', None)))
+    listing.calls = []
+
+    tree = DigestTree.update(store.load('bucket'), [], listing.prefixes(), listing)
+
+    assert listing.calls == [('', '/')]
+    assert tree.nodes == DigestTree.build(listing('', None)).nodes
+
+
+def test_update_relists_changed_prefixes_only():
+    before = Listing([_version(key) for key in KEYS])
+    stored = DigestTree.build(before('', None))
+    after = Listing([_version(key) for key in KEYS if key != 'a/b/2'] + [_version('b/c/d/3', 'v2', size=2)])
+
+    tree = DigestTree.update(stored, ['a/', 'b/'], after.prefixes(), after)
+
+    assert sorted(after.calls) == [('', '/'), ('a/', None), ('b/', None)]
+    assert tree.nodes == DigestTree.build(after('', None)).nodes
+    assert tree.diverged(stored) and not tree.diverged(DigestTree.build(after('', None)))
+
+
+def test_update_drops_removed_prefixes():
+    before = Listing([_version(key) for key in KEYS])
+    stored = DigestTree.build(before('', None))
+    after = Listing([_version(key) for key in KEYS if not key.startswith('c/')])
+
+    tree = DigestTree.update(stored, [], after.prefixes(), after)
+
+    assert 'c/' not in tree.nodes
+    assert tree.nodes == DigestTree.build(after('', None)).nodes
+
+
+def test_update_without_stored_tree_builds_from_full_listing():
+    listing = Listing([_version(key) for key in KEYS])
+    tree = DigestTree.update(None, [], listing.prefixes(), listing)
+    assert listing.calls == [('', None)]
+    assert tree.nodes == DigestTree.build(listing('', None)).nodes
@@ -0,0 +1,83 @@
+import io
+
+import boto3
+import pytest
+
+import s3_fast_listing
+from s3_fast_listing import FastListingError, iter_version_pages, iter_version_tuples, supported
+
+LISTING = b"""<?xml version="1.0" encoding="UTF-8"?>
+<ListVersionsResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">
+<IsTruncated>false</IsTruncated>
+<Version><Key>a</Key><VersionId>v1</VersionId><IsLatest>true</IsLatest><Size>3</Size></Version>
+</ListVersionsResult>"""
+
+SLOWDOWN = b"<Error><Code>SlowDown</Code><Message>Please reduce your request rate.</Message></Error>"
+
+
+class Response(io.BytesIO):
+    def __init__(self, status, body):
+        super().__init__(body)
+        self.status = status
+        self.data = body
+
+    def release_conn(self):
+        pass
+
+
+class Http:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = 0
+
+    def request(self, method, url, headers=None, preload_content=True):
+        self.requests += 1
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setattr(s3_fast_listing.time, 'sleep', lambda seconds: None)
+    return boto3.client('s3', region_name='us-east-1', aws_access_key_id='AKID', aws_secret_access_key='secret')
+
+
+def test_slowdown_is_retried(s3, monkeypatch):
+    http = Http([Response(503, SLOWDOWN), Response(500, b''), Response(200, LISTING)])
+    monkeypatch.setattr(s3_fast_listing, '_http', http)
+    assert list(iter_version_tuples(s3, 'bucket', fields=('Key', 'VersionId', 'Size'))) == [('a', 'v1', 3)]
+    assert http.requests == 3
+
+
+def test_client_errors_are_not_retried(s3, monkeypatch):
+    http = Http([Response(403, b"<Error><Code>AccessDenied</Code></Error>")])
+    monkeypatch.setattr(s3_fast_listing, '_http', http)
+    with pytest.raises(FastListingError):
+        list(iter_version_tuples(s3, 'bucket'))
+    assert http.requests == 1
+
+
+def test_retries_give_up_after_max_attempts(s3, monkeypatch):
+    http = Http([Response(503, SLOWDOWN)] * s3_fast_listing.MAX_ATTEMPTS)
+    monkeypatch.setattr(s3_fast_listing, '_http', http)
+    with pytest.raises(FastListingError):
+        list(iter_version_tuples(s3, 'bucket'))
+    assert http.requests == s3_fast_listing.MAX_ATTEMPTS
+
+
+def test_unsupported_client_is_detected(s3):
+    assert supported(s3)
+    assert not supported(object())
+
+
+def test_owner_survives_the_fast_path(s3, monkeypatch):
+    from s3_listing_benchmark import _Listing
+    from s3_migration_handler import _inventory_row
+    monkeypatch.setattr(s3_fast_listing, '_http', Http([Response(200, _Listing(30).page(None, None, 1000))]))
+
+    versions = [v for page in iter_version_pages(s3, 'bench') for v in page]
+
+    assert len(versions) == 30 and any(v.get('DeleteMarker') for v in versions)
+    for v in versions:
+        assert v['Owner']['DisplayName'] == 'migration'
+        assert v['Owner']['ID'].startswith('75aa57f0')
+        assert _inventory_row(v, '')['Owner'] == 'migration'
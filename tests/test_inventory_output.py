@@ -0,0 +1,125 @@
+import csv
+import gzip
+import io
+from datetime import datetime, timezone
+
+import pytest
+
+import s3_inventory_output
+from s3_inventory_output import InventoryOutput, MultipartSink, ParquetWriter
+
+T0 = datetime(2026, 1, 2, 3, 4, 5, 678000, tzinfo=timezone.utc)
+
+ROWS = [
+    {'Key': 'a b/c.txt', 'VersionId': 'v1', 'IsLatest': True, 'Size': 10, 'ETag': '"e1"', 'StorageClass': 'STANDARD',
+     'LastModified': T0, 'Owner': 'me', 'DeleteMarker': False, 'ServerSideEncryption': 'AES256'},
+    {'Key': 'a b/c.txt', 'VersionId': 'v0', 'IsLatest': False, 'Size': None, 'ETag': '', 'StorageClass': '',
+     'LastModified': T0, 'Owner': 'me', 'DeleteMarker': True, 'ServerSideEncryption': ''},
+]
+
+
+class FakeS3:
+    def __init__(self, fail_part=None):
+        self.fail_part = fail_part
+        self.parts = {}
+        self.completed = []
+        self.aborted = []
+
+    def create_multipart_upload(self, **kwargs):
+        return {'UploadId': 'upload'}
+
+    def upload_part(self, PartNumber, Body, **kwargs):
+        if PartNumber == self.fail_part:
+            raise RuntimeError('part failed')
+        self.parts[PartNumber] = Body
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, **kwargs):
+        self.completed.append(kwargs['MultipartUpload']['Parts'])
+
+    def abort_multipart_upload(self, **kwargs):
+        self.aborted.append(kwargs['UploadId'])
+
+
+def test_part_size_grows_with_the_parts_uploaded(monkeypatch):
+    monkeypatch.setattr(s3_inventory_output, 'PART_SIZE_DOUBLING', 2)
+    s3 = FakeS3()
+    sink = MultipartSink(s3, 'bucket', 'key', part_size=5)
+    data = bytes(range(100))
+    for i in range(0, len(data), 7):
+        sink.write(data[i:i + 7])
+    sink.close()
+    assert [len(s3.parts[n]) for n in sorted(s3.parts)] == [5, 5, 10, 10, 20, 20, 30]
+    assert b''.join(s3.parts[n] for n in sorted(s3.parts)) == data
+
+
+def test_close_is_idempotent():
+    s3 = FakeS3()
+    sink = MultipartSink(s3, 'bucket', 'key', part_size=5)
+    sink.write(b'abcdefg')
+    sink.close()
+    sink.close()
+    assert len(s3.completed) == 1
+    assert [len(s3.parts[n]) for n in sorted(s3.parts)] == [5, 2]
+
+
+def test_failed_part_aborts_the_upload():
+    s3 = FakeS3(fail_part=2)
+    sink = MultipartSink(s3, 'bucket', 'key', part_size=5)
+    sink.write(b'abcdefg')
+    with pytest.raises(RuntimeError, match='part failed'):
+        sink.close()
+    assert s3.aborted == ['upload'] and not s3.completed
+    sink.abort()
+    assert s3.aborted == ['upload']
+
+
+def test_failed_writer_close_aborts_the_upload(monkeypatch):
+    s3 = FakeS3(fail_part=1)
+    output = InventoryOutput('bucket', 'inventory', 'csv.gz', 's3://dest/prefix/', s3)
+    for row in ROWS:
+        output.write(row)
+    with pytest.raises(RuntimeError):
+        output.close()
+    assert s3.aborted == ['upload']
+
+
+def test_csv_gz_rows_follow_the_inventory_layout(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    output = InventoryOutput('bucket', 'inventory', 'csv.gz')
+    for row in ROWS:
+        output.write(row)
+    path = output.close()
+    with gzip.open(tmp_path / path, 'rt', newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows == [
+        ['bucket', 'a%20b/c.txt', 'v1', 'true', 'false', '10', '2026-01-02T03:04:05.678Z', 'e1', 'STANDARD', 'SSE-S3'],
+        ['bucket', 'a%20b/c.txt', 'v0', 'false', 'true', '', '2026-01-02T03:04:05.678Z', '', '', ''],
+    ]
+
+
+def test_parquet_rows_round_trip(tmp_path, monkeypatch):
+    pq = pytest.importorskip('pyarrow.parquet')
+    monkeypatch.chdir(tmp_path)
+    output = InventoryOutput('bucket', 'inventory', 'parquet')
+    for row in ROWS:
+        output.write(row)
+    table = pq.read_table(tmp_path / output.close())
+    assert table.schema.equals(output.writer.schema)
+    assert table.to_pylist() == [
+        {'bucket': 'bucket', 'key': 'a b/c.txt', 'version_id': 'v1', 'is_latest': True, 'is_delete_marker': False,
+         'size': 10, 'last_modified_date': T0, 'e_tag': 'e1', 'storage_class': 'STANDARD',
+         'encryption_status': 'SSE-S3'},
+        {'bucket': 'bucket', 'key': 'a b/c.txt', 'version_id': 'v0', 'is_latest': False, 'is_delete_marker': True,
+         'size': None, 'last_modified_date': T0, 'e_tag': None, 'storage_class': None, 'encryption_status': None},
+    ]
+
+
+def test_parquet_file_schema_is_the_written_message_type():
+    pytest.importorskip('pyarrow.parquet')
+    writer = ParquetWriter('bucket', io.BytesIO())
+    assert writer.file_schema() == (
+        'message s3.inventory { required binary bucket (UTF8); required binary key (UTF8); '
+        'optional binary version_id (UTF8); optional boolean is_latest; optional boolean is_delete_marker; '
+        'optional int64 size; optional int64 last_modified_date (TIMESTAMP_MILLIS); optional binary e_tag (UTF8); '
+        'optional binary storage_class (UTF8); optional binary encryption_status (UTF8); }')
@@ -0,0 +1,59 @@
+import sqlite3
+import time
+
+from s3_journal import Journal
+
+
+def _committed(path, scope):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM units WHERE scope = ?', (scope,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_buffered_units_are_committed_on_a_timer(tmp_path):
+    path = str(tmp_path / 'journal.sqlite')
+    journal = Journal('copy:a->b', path, commit_interval=0.05)
+    try:
+        journal.record({'Key': 'a', 'VersionId': 'v1', 'ETag': '"e"'}, 'copied')
+        journal.record({'Key': 'b', 'VersionId': 'v1', 'ETag': '"e"'}, 'copied')
+        deadline = time.monotonic() + 5
+        while _committed(path, 'copy:a->b') < 2 and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert _committed(path, 'copy:a->b') == 2
+    finally:
+        journal.close()
+
+
+def test_close_commits_buffered_units(tmp_path):
+    path = str(tmp_path / 'journal.sqlite')
+    journal = Journal('copy:a->b', path, commit_interval=3600)
+    journal.record({'Key': 'a', 'VersionId': 'v1', 'ETag': '"e"'}, 'copied')
+    journal.record({'Key': 'b', 'VersionId': 'v1', 'ETag': '"e"'}, 'copied')
+    assert _committed(path, 'copy:a->b') == 0
+    journal.close()
+    assert _committed(path, 'copy:a->b') == 2
+    resumed = Journal('copy:a->b', path, resume=True)
+    assert [u['Key'] for u in resumed.completed()] == ['a', 'b']
+    resumed.close()
+
+
+def test_started_units_are_in_flight_until_recorded(tmp_path):
+    path = str(tmp_path / 'journal.sqlite')
+    journal = Journal('replay:a->b', path, commit_interval=3600)
+    journal.start({'Key': 'a', 'VersionId': 'v1', 'ETag': '"e"'})
+    journal.record({'Key': 'a', 'VersionId': 'v1', 'ETag': '"e"'}, 'copied')
+    journal.start({'Key': 'b', 'VersionId': 'v1'})
+    # Started units are committed at once, with no close()
+    resumed = Journal('replay:a->b', path, resume=True)
+    in_flight = resumed.in_flight()
+    pending = [v['Key'] for v in resumed.pending([{'Key': 'a', 'VersionId': 'v1', 'ETag': '"e"'},
+                                                  {'Key': 'b', 'VersionId': 'v1'}])]
+    completed = [u['Key'] for u in resumed.completed()]
+    journal.close()
+    resumed.close()
+
+    assert [(u['Key'], u['ETag']) for u in in_flight] == [('b', None)]
+    assert pending == ['b']
+    assert completed == ['a']
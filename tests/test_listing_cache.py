@@ -0,0 +1,76 @@
+from datetime import datetime, timezone
+
+from s3_listing_cache import ListingCache, read_changed_keys
+
+NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+class Paginator:
+    def __init__(self, s3, operation):
+        self.s3 = s3
+        self.operation = operation
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None, **kwargs):
+        self.s3.calls.append((self.operation, Prefix, Delimiter))
+        keys = sorted(k for k in self.s3.objects if k.startswith(Prefix))
+        prefixes = []
+        if Delimiter:
+            prefixes = sorted({k[:k.index('/', len(Prefix)) + 1] for k in keys if '/' in k[len(Prefix):]})
+            keys = [k for k in keys if '/' not in k[len(Prefix):]]
+        if self.operation == 'list_objects_v2':
+            yield {'Contents': [{'Key': k, 'Size': self.s3.objects[k], 'LastModified': NOW} for k in keys]}
+            return
+        yield {'Versions': [{'Key': k, 'VersionId': 'v1', 'IsLatest': True, 'Size': self.s3.objects[k],
+                             'ETag': '"e"', 'StorageClass': 'STANDARD', 'LastModified': NOW} for k in keys],
+               'CommonPrefixes': [{'Prefix': p} for p in prefixes]}
+
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = dict(objects)
+        self.calls = []
+
+    def get_paginator(self, operation):
+        return Paginator(self, operation)
+
+
+def _cached_keys(cache):
+    return [v['Key'] for v in cache.iter_versions('bucket')]
+
+
+def test_refresh_without_signal_relists_every_prefix(tmp_path):
+    s3 = FakeS3({'a/1': 1, 'b/1': 1, 'top': 1})
+    cache = ListingCache(str(tmp_path / 'cache.db'))
+    cache.refresh(s3, 'bucket')
+    s3.calls = []
+
+    assert cache.refresh(s3, 'bucket') == ['a/', 'b/']
+    assert not any(op == 'list_objects_v2' for op, _, _ in s3.calls)
+
+
+def test_refresh_with_changed_keys_relists_their_prefixes_only(tmp_path):
+    s3 = FakeS3({'a/1': 1, 'b/1': 1, 'top': 1})
+    cache = ListingCache(str(tmp_path / 'cache.db'))
+    cache.refresh(s3, 'bucket')
+    s3.objects.update({'b/2': 2, 'c/1': 1})
+    s3.calls = []
+
+    assert cache.refresh(s3, 'bucket', changed=['b/2']) == ['b/', 'c/']
+    assert _cached_keys(cache) == ['a/1', 'b/1', 'b/2', 'c/1', 'top']
+    assert not any(op == 'list_objects_v2' for op, _, _ in s3.calls)
+
+
+def test_refresh_with_fingerprint_relists_moved_prefixes(tmp_path):
+    s3 = FakeS3({'a/1': 1, 'b/1': 1})
+    cache = ListingCache(str(tmp_path / 'cache.db'))
+    cache.refresh(s3, 'bucket')
+    s3.objects['a/1'] = 5
+
+    assert cache.refresh(s3, 'bucket', fingerprint=True) == ['a/']
+
+
+def test_read_changed_keys(tmp_path):
+    path = tmp_path / 'changed.txt'
+    path.write_text('src/a/1\nsrc/b/c/2\ndest/x\n\n')
+
+    assert read_changed_keys(str(path)) == {'src': ['a/1', 'b/c/2'], 'dest': ['x']}
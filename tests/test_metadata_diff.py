@@ -0,0 +1,47 @@
+from datetime import datetime, timezone
+
+from s3_copy_engine import CopyEngine
+from s3_metadata_diff import metadata_diff
+
+T0 = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def _object(key, storage_class=None, etag='e'):
+    v = {'Key': key, 'VersionId': f'{key}-1', 'IsLatest': True, 'Size': 1, 'ETag': f'"{etag}"', 'LastModified': T0}
+    if storage_class:
+        v['StorageClass'] = storage_class
+    return v
+
+
+class FakeS3:
+    def __init__(self):
+        self.copies = []
+
+    def copy_object(self, **kwargs):
+        self.copies.append(kwargs)
+        return {}
+
+
+def test_storage_class_drift_is_repaired_in_the_expected_class():
+    src = [_object('a', 'STANDARD_IA'), _object('b')]
+    dest = [_object('a'), _object('b')]
+    entries = list(metadata_diff(src, dest, storage_class='GLACIER_IR'))
+    assert [(e['Key'], e['Category'], e['StorageClass']) for e in entries] == [
+        ('a', 'storage-class-drift', 'GLACIER_IR'), ('b', 'storage-class-drift', 'GLACIER_IR')]
+
+    s3 = FakeS3()
+    engine = CopyEngine('src', 'dest', s3=s3)
+    for entry in entries:
+        engine.copy(entry)
+    assert [c['StorageClass'] for c in s3.copies] == ['GLACIER_IR', 'GLACIER_IR']
+
+
+def test_repairs_default_to_the_source_storage_class():
+    entries = list(metadata_diff([_object('a', 'STANDARD_IA', etag='x')], [_object('a')]))
+    assert entries[0]['Category'] == 'etag-mismatch' and entries[0]['StorageClass'] == 'STANDARD_IA'
+
+
+def test_extra_args_take_precedence_over_the_entry_storage_class():
+    s3 = FakeS3()
+    CopyEngine('src', 'dest', s3=s3, extra_args={'StorageClass': 'ONEZONE_IA'}).copy(_object('a', 'STANDARD_IA'))
+    assert s3.copies[0]['StorageClass'] == 'ONEZONE_IA'
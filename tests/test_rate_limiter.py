@@ -0,0 +1,36 @@
+import logging
+
+import boto3
+from botocore.config import Config
+
+from s3_copy_engine import client
+from s3_rate_limiter import GovernedClient, PrefixGovernor, governed, governed_client
+
+
+def _total_attempts(s3):
+    return s3.meta.config.retries.get('total_max_attempts')
+
+
+def test_governed_calls_are_not_retried_by_botocore():
+    s3 = governed_client(PrefixGovernor(), Config(max_pool_connections=16))
+    assert isinstance(s3, GovernedClient)
+    assert _total_attempts(s3._s3) == 1
+    assert s3._s3.meta.config.max_pool_connections == 16
+    # Listings and bucket calls keep botocore's retries
+    assert _total_attempts(s3._other) != 1
+    assert s3.meta is s3._other.meta
+
+
+def test_copy_engine_client_is_governed_without_retries():
+    s3 = client(8, PrefixGovernor())
+    assert _total_attempts(s3._s3) == 1
+
+
+def test_wrapping_a_retrying_client_warns(caplog):
+    with caplog.at_level(logging.WARNING):
+        governed(boto3.client('s3'), PrefixGovernor())
+    assert 'governed_client' in caplog.text
+    caplog.clear()
+    with caplog.at_level(logging.WARNING):
+        governed(boto3.client('s3', config=Config(retries={'total_max_attempts': 1})), PrefixGovernor())
+    assert not caplog.text
@@ -0,0 +1,97 @@
+import hashlib
+import itertools
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import s3_copy_engine
+import s3_migration_handler as handler
+
+T0 = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeS3:
+    """Two in-memory versioned buckets; copies get a new version ID, and multipart sources a plain ETag"""
+
+    def __init__(self):
+        self.buckets = {'src': {}, 'dest': {}}
+        self.copies = []
+        self.clock = itertools.count(1)
+        self.ids = itertools.count(1)
+
+    def put(self, bucket, key, size, etag):
+        versions = self.buckets[bucket].setdefault(key, [])
+        for v in versions:
+            v['IsLatest'] = False
+        versions.insert(0, {'Key': key, 'VersionId': f'{bucket}-{next(self.ids)}', 'IsLatest': True, 'Size': size,
+                            'ETag': f'"{etag}"', 'LastModified': T0 + timedelta(minutes=next(self.clock))})
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self.copies.append(Key)
+        source = next(v for v in self.buckets[CopySource['Bucket']][CopySource['Key']]
+                      if v['VersionId'] == CopySource['VersionId'])
+        etag = source['ETag'].strip('"')
+        if '-' in etag:
+            etag = hashlib.md5(etag.encode()).hexdigest()
+        self.put(Bucket, Key, source['Size'], etag)
+        return {}
+
+    def listing(self, bucket):
+        return [v for key in sorted(self.buckets[bucket]) for v in self.buckets[bucket][key]]
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    fake = FakeS3()
+    monkeypatch.setattr(s3_copy_engine, 'client', lambda workers=None, governor=None: fake)
+    monkeypatch.setattr(handler, 'governor', None)
+    monkeypatch.setattr(handler, 'AUTOTUNE', False)
+    return fake
+
+
+def sync(s3):
+    s3.copies = []
+    diff = handler.diff_versions(s3.listing('src'), s3.listing('dest'))
+    result = handler.sync_buckets('src', 'dest', diff, workers=4)
+    assert not result['Failures']
+    return sorted(s3.copies)
+
+
+def test_second_sync_copies_nothing(s3):
+    s3.put('src', 'a', 10, 'aaaa')
+    s3.put('src', 'big', 20, 'bbbb-2')
+    s3.put('src', 'c', 30, 'cccc')
+    s3.put('dest', 'c', 30, 'cccc')
+
+    assert sync(s3) == ['a', 'big']
+    assert sync(s3) == []
+
+
+def test_changed_objects_are_copied_again(s3):
+    s3.put('src', 'a', 10, 'aaaa')
+    s3.put('src', 'big', 20, 'bbbb-2')
+    s3.put('src', 'same-size', 5, 'eeee')
+    sync(s3)
+
+    s3.put('src', 'a', 11, 'aaab')
+    s3.put('src', 'big', 20, 'dddd-2')
+    s3.put('src', 'same-size', 5, 'ffff')
+    assert sync(s3) == ['a', 'big', 'same-size']
+    assert sync(s3) == []
+
+
+def test_preserve_parts_reaches_the_copy_engine(s3, monkeypatch):
+    engines = []
+
+    class RecordingEngine(handler.CopyEngine):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            engines.append(self)
+
+    monkeypatch.setattr(handler, 'CopyEngine', RecordingEngine)
+    monkeypatch.setattr(handler, 'PRESERVE_PARTS', True)
+    s3.put('src', 'a', 10, 'aaaa')
+
+    handler.sync_buckets('src', 'dest', handler.diff_versions(s3.listing('src'), s3.listing('dest')), workers=4)
+
+    assert [engine.preserve_parts for engine in engines] == [True]
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+from s3_version_index import SpilledVersionIndex, VersionIndex, build_index, event_flag
+
+PAIRS = [('a', 'v1'), ('a', 'v2'), ('b/c', 'v1')]
+
+
+@pytest.mark.parametrize('spill', [False, True])
+def test_find_missing(tmp_path, spill):
+    index = build_index(PAIRS, str(tmp_path) if spill else None, capacity=100)
+    try:
+        assert isinstance(index, SpilledVersionIndex if spill else VersionIndex)
+        assert index.find_missing([('a', 'v2'), ('a', 'v3'), ('b/c', 'v1'), ('d', 'v1')]) == [('a', 'v3'),
+                                                                                             ('d', 'v1')]
+    finally:
+        index.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_build_index_removes_spilled_files_when_listing_fails(tmp_path):
+    def versions():
+        yield from PAIRS
+        raise RuntimeError('listing failed')
+
+    with pytest.raises(RuntimeError):
+        build_index(versions(), str(tmp_path), capacity=100)
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize('value, expected', [(True, True), (False, False), ('false', False), ('False', False),
+                                             ('true', True), ('1', True), ('', False), (0, False)])
+def test_event_flag(value, expected):
+    assert event_flag(value) is expected
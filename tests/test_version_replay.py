@@ -0,0 +1,99 @@
+import threading
+from datetime import datetime, timedelta, timezone
+
+import s3_version_replay
+from s3_copy_engine import CopyEngine
+from s3_journal import Journal
+from s3_version_replay import _MarkerDeleter, replay, settle_in_flight
+
+T0 = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeS3:
+    def copy_object(self, **kwargs):
+        return {}
+
+
+def _listing(keys):
+    versions = []
+    for key in keys:
+        versions.append({'Key': key, 'VersionId': f'{key}-2', 'IsLatest': True, 'DeleteMarker': True,
+                         'LastModified': T0 + timedelta(minutes=1)})
+        versions.append({'Key': key, 'VersionId': f'{key}-1', 'IsLatest': False, 'Size': 1, 'ETag': '"e"',
+                         'LastModified': T0})
+    return versions
+
+
+def _failing_delete_objects(s3, bucket, objects, workers):
+    next(objects)
+    raise RuntimeError('boom')
+    yield
+
+
+def _run(fn):
+    """Run fn on a thread, returning its exception; fails the test if it hangs"""
+    errors = []
+
+    def target():
+        try:
+            fn()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive(), 'replay hung'
+    return errors[0] if errors else None
+
+
+def test_deleter_failure_is_raised_instead_of_hanging(monkeypatch):
+    monkeypatch.setattr(s3_version_replay, 'delete_objects', _failing_delete_objects)
+    engine = CopyEngine('src', 'dest', workers=2, s3=FakeS3())
+    error = _run(lambda: list(replay(engine, _listing([f'key{i:04d}' for i in range(50)]), delete_workers=1)))
+    assert isinstance(error, RuntimeError) and str(error) == 'boom'
+
+
+def test_defer_fails_fast_once_the_thread_died(monkeypatch):
+    monkeypatch.setattr(s3_version_replay, 'delete_objects', _failing_delete_objects)
+    deleter = _MarkerDeleter(CopyEngine('src', 'dest', workers=1, s3=FakeS3()), workers=1)
+    versions = _listing([f'key{i:05d}' for i in range(2000)])[::2]
+    error = _run(lambda: [deleter.defer(v) for v in versions])
+    assert isinstance(error, RuntimeError) and str(error) == 'boom'
+
+
+class DestS3(FakeS3):
+    """Destination whose newest version of every key is given"""
+
+    def __init__(self, newest):
+        self.newest = newest
+
+    def list_object_versions(self, Bucket, Prefix, MaxKeys):
+        v = self.newest.get(Prefix)
+        if v is None:
+            return {}
+        return {'DeleteMarkers': [v]} if v.get('DeleteMarker') else {'Versions': [v]}
+
+
+def test_resume_records_in_flight_steps_that_landed(tmp_path):
+    path = str(tmp_path / 'journal.sqlite')
+    journal = Journal('replay', path)
+    copy = {'Key': 'copied', 'VersionId': 'v1', 'ETag': '"e"'}
+    lost = {'Key': 'lost', 'VersionId': 'v1', 'ETag': '"e"'}
+    marker = {'Key': 'deleted', 'VersionId': 'v2'}
+    for v in (copy, lost, marker):
+        journal.start(v)
+    journal.close()
+    after = datetime.now(timezone.utc) + timedelta(seconds=1)
+    before = T0
+    s3 = DestS3({'copied': {'Key': 'copied', 'VersionId': 'd1', 'ETag': '"e"', 'LastModified': after},
+                 'lost': {'Key': 'lost', 'VersionId': 'd0', 'ETag': '"e"', 'LastModified': before},
+                 'deleted': {'Key': 'deleted', 'VersionId': 'd2', 'DeleteMarker': True, 'LastModified': after}})
+
+    resumed = Journal('replay', path, resume=True)
+    try:
+        assert settle_in_flight(CopyEngine('src', 'dest', workers=1, s3=s3, journal=resumed)) == 2
+        assert [u['Key'] for u in resumed.in_flight()] == ['lost']
+        assert [u['Status'] for u in resumed.completed()] == ['copied', 'deleted']
+    finally:
+        resumed.close()
@@ -0,0 +1,27 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from s3_version_store import VersionStore
+
+NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def _version(key, version_id, is_latest=True):
+    return {'Key': key, 'VersionId': version_id, 'IsLatest': is_latest, 'Size': 1, 'LastModified': NOW}
+
+
+def test_find_looks_up_versions_in_listing_order():
+    store = VersionStore().extend([_version('a', 'v2'), _version('a', 'v1', False), _version('b', 'v1')])
+
+    assert store.find('a', 'v1')['IsLatest'] is False
+    assert store.find('b', 'v1')['Key'] == 'b'
+    assert store.find('b', 'v2') is None
+    assert ('c', 'v1') not in store
+
+
+def test_find_rejects_a_store_without_version_ids():
+    store = VersionStore(fields=('Key', 'Size')).extend([_version('a', 'v1')])
+
+    with pytest.raises(ValueError):
+        store.find('a', 'v1')